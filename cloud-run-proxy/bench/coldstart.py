@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+コールドスタートのベンチマーク（ローカルのみ、GCP不要）
+- bench/fakes.py の代替サーバーを起動し、proxy.py のプロセスを繰り返し起動
+- プロセス起動から以下までの時間を計測
+    - ポートが接続を受け付けるまで
+    - /ready が 200 を返すまで
+    - 最初のプロキシ済みレスポンス（/ws/{name}/）の1バイト目まで
+- プロキシ自身が記録した import / bind / ready の時間もログから集計
+
+使い方:
+    python bench/coldstart.py --runs 10
+    python bench/coldstart.py --runs 10 --env STARTUP_PREFETCH_TOKEN=false
+    python bench/coldstart.py --runs 10 --script   # python proxy.py で起動（バイトコードキャッシュなし）
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+import aiohttp
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROXY_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+import fakes  # noqa: E402
+from loadtest import free_port  # noqa: E402
+
+
+async def wait_for_port(port: int, started: float) -> float:
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return time.perf_counter() - started
+        except OSError:
+            await asyncio.sleep(0.002)
+
+
+async def one_run(args, env, run: int) -> dict:
+    port = free_port()
+    log_path = os.path.join(args.directory, f'proxy-{run}.log')
+    command = [sys.executable, 'proxy.py'] if args.script else [sys.executable, '-m', 'proxy']
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        command, cwd=PROXY_DIR, env={**env, 'PORT': str(port)},
+        stdout=open(log_path, 'w'), stderr=subprocess.STDOUT,
+    )
+    try:
+        result = {"port_ms": await wait_for_port(port, started) * 1000}
+        async with aiohttp.ClientSession() as session:
+            # 最初のユーザーリクエスト（新しいWorkstation名なのでトークン取得から）
+            async with session.get(f'http://127.0.0.1:{port}/ws/cold-{run}/') as resp:
+                await resp.content.read(1)
+                result["first_byte_ms"] = (time.perf_counter() - started) * 1000
+                await resp.read()
+            while True:
+                async with session.get(f'http://127.0.0.1:{port}/ready') as resp:
+                    if resp.status == 200:
+                        break
+                await asyncio.sleep(0.005)
+            result["ready_probe_ms"] = (time.perf_counter() - started) * 1000
+    finally:
+        process.terminate()
+        await asyncio.to_thread(process.wait, 30)
+
+    with open(log_path) as f:
+        for line in f:
+            if '"ready_ms"' in line:
+                record = json.loads(line)
+                for key in ('import_ms', 'bind_ms', 'ready_ms'):
+                    if key in record:
+                        result[f"proxy_{key}"] = record[key]
+    return result
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE')
+    parser.add_argument('--script', action='store_true', help='python -m proxy ではなく python proxy.py で起動')
+    parser.add_argument('--api-latency', type=float, default=0.03, help='メタデータサーバー/Workstations APIの擬似遅延（秒）')
+    args = parser.parse_args()
+    args.directory = tempfile.mkdtemp(prefix='proxy-coldstart-')
+
+    cert, key = fakes.make_cert(args.directory)
+    api_port, upstream_port = free_port(), free_port()
+    api = fakes.FakeWorkstationsAPI(latency=args.api_latency)
+    runners = [
+        await fakes.start_site(fakes.make_gcp_app(api), api_port),
+        await fakes.start_site(fakes.make_upstream_app(), upstream_port, fakes.make_server_ssl_context(cert, key)),
+    ]
+    env = {
+        **os.environ,
+        **fakes.proxy_env(api_port, upstream_port, cert),
+        'LOG_FORMAT': 'json',
+        **dict(item.split('=', 1) for item in args.env),
+    }
+    # バイトコードキャッシュを作っておく（Dockerfile の compileall と同じ状態）
+    subprocess.run([sys.executable, '-m', 'compileall', '-q', os.path.join(PROXY_DIR, 'proxy.py')], check=True)
+
+    results = []
+    try:
+        for run in range(args.runs):
+            results.append(await one_run(args, env, run))
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+    keys = [k for k in results[0] if all(k in r for r in results)]
+    print(f"{'metric':<24}{'p50 ms':>10}{'min ms':>10}{'max ms':>10}")
+    for k in keys:
+        values = [r[k] for r in results]
+        print(f"{k:<24}{statistics.median(values):>10.1f}{min(values):>10.1f}{max(values):>10.1f}")
+    print(f"\nlogs: {args.directory}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
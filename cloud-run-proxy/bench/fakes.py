@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+GCP・Workstationのローカル代替サーバー（ベンチマーク/負荷試験用、GCP不要）
+- メタデータサーバー: METADATA_TOKEN_URL の代わりにGCPアクセストークンを返す
+- Workstations API: generateAccessToken / get / start / stop（状態遷移あり）
+- Workstation (TLS): VS Code風のHTML・静的リソース・大きなファイル・エコーWebSocket
+
+単体で起動して手動確認にも使える:
+    python bench/fakes.py --api-port 18090 --upstream-port 18443
+    # 表示された環境変数を設定して proxy.py を起動
+"""
+
+import os
+import sys
+import ssl
+import time
+import json
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+from aiohttp import web, WSMsgType
+
+# VS Code (code-oss) のリソースパスを模したコミットID
+COMMIT = "0123456789abcdef0123456789abcdef01234567"
+
+FAKE_GCP_TOKEN = "fake-gcp-token"
+FAKE_WS_TOKEN_PREFIX = "fake-ws-token-"
+
+
+def make_cert(directory: str) -> tuple[str, str]:
+    """自己署名証明書を作成（openssl コマンドを使用）。CA兼サーバー証明書として使う"""
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run(
+        [
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-keyout', key, '-out', cert, '-subj', '/CN=fake-workstation',
+            '-addext', 'subjectAltName=DNS:*.cluster.bench.test,DNS:*.cluster2.bench.test,DNS:localhost',
+            '-addext', 'basicConstraints=critical,CA:TRUE',
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return cert, key
+
+
+def asset_body(path: str, size: int) -> bytes:
+    """パスから決まる内容（ETagが安定するように決定的に生成）"""
+    line = f"// {path}\n".encode()
+    return (line * (size // len(line) + 1))[:size]
+
+
+# === メタデータサーバー + Workstations API ===
+
+class FakeWorkstationsAPI:
+    """Workstations API の最小限の代替（状態はメモリ上）"""
+
+    def __init__(self, start_delay: float = 2.0, stop_delay: float = 1.0, latency: float = 0.0, configs: dict = None):
+        self.start_delay = start_delay
+        self.stop_delay = stop_delay
+        self.latency = latency  # 実APIの往復時間を模した遅延
+        # {"cluster/config": [name, ...]} を渡すと、そこにある名前だけが存在する（なければどの名前も存在する）
+        self.configs = configs
+        self.workstations = {}  # name -> {"state", "until", "next"}
+        self.calls = {}
+
+    def exists(self, request, name: str) -> bool:
+        if self.configs is None:
+            return True
+        key = f"{request.match_info['cluster']}/{request.match_info['config']}"
+        return name in self.configs.get(key, ())
+
+    def state(self, name: str) -> str:
+        # "stopped-" で始まる名前は停止状態から始める
+        ws = self.workstations.setdefault(name, {
+            "state": "STATE_STOPPED" if name.startswith('stopped-') else "STATE_RUNNING",
+            "until": 0,
+            "next": None,
+        })
+        if ws["next"] and time.monotonic() >= ws["until"]:
+            ws["state"], ws["next"] = ws["next"], None
+        return ws["state"]
+
+    def transition(self, name: str, via: str, to: str, delay: float):
+        ws = self.workstations[name]
+        ws["state"], ws["next"], ws["until"] = via, to, time.monotonic() + delay
+
+    async def handle(self, request):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if request.headers.get('Authorization') != f"Bearer {FAKE_GCP_TOKEN}":
+            return web.json_response({"error": "unauthenticated"}, status=401)
+
+        name, _, action = request.match_info['name'].partition(':')
+        action = action or 'get'
+        self.calls[action] = self.calls.get(action, 0) + 1
+        if not self.exists(request, name):
+            return web.json_response({"error": "not found"}, status=404)
+        state = self.state(name)
+
+        if action == 'get':
+            return web.json_response({"name": name, "state": state})
+        if action == 'generateAccessToken':
+            body = await request.json()
+            return web.json_response({
+                "accessToken": f"{FAKE_WS_TOKEN_PREFIX}{name}",
+                "expireTime": body.get("expireTime"),
+            })
+        if action == 'start':
+            if state == 'STATE_STOPPED':
+                self.transition(name, 'STATE_STARTING', 'STATE_RUNNING', self.start_delay)
+            elif state != 'STATE_RUNNING':
+                return web.json_response({"error": "conflict"}, status=409)
+            return web.json_response({"name": f"operations/start-{name}"})
+        if action == 'stop':
+            if state == 'STATE_RUNNING':
+                self.transition(name, 'STATE_STOPPING', 'STATE_STOPPED', self.stop_delay)
+            elif state != 'STATE_STOPPED':
+                return web.json_response({"error": "conflict"}, status=409)
+            return web.json_response({"name": f"operations/stop-{name}"})
+        return web.json_response({"error": f"unknown action {action}"}, status=400)
+
+    async def handle_list(self, request):
+        """list: これまでに参照されたWorkstation（configs を渡した場合はそのConfigのもの）を pageSize 件ずつ返す"""
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if request.headers.get('Authorization') != f"Bearer {FAKE_GCP_TOKEN}":
+            return web.json_response({"error": "unauthenticated"}, status=401)
+        self.calls['list'] = self.calls.get('list', 0) + 1
+        if self.configs is None:
+            names = sorted(self.workstations)
+        else:
+            names = sorted(self.configs.get(f"{request.match_info['cluster']}/{request.match_info['config']}", ()))
+        size = int(request.query.get('pageSize', '100'))
+        offset = int(request.query.get('pageToken') or 0)
+        page = {"workstations": [
+            {"name": f"{request.path}/{name}", "state": self.state(name)} for name in names[offset:offset + size]
+        ]}
+        if offset + size < len(names):
+            page["nextPageToken"] = str(offset + size)
+        return web.json_response(page)
+
+
+async def handle_metadata_token(request):
+    """メタデータサーバーのトークンエンドポイント"""
+    if request.headers.get('Metadata-Flavor') != 'Google':
+        return web.Response(status=403, text="Missing Metadata-Flavor header")
+    request.app['calls']['metadata_token'] = request.app['calls'].get('metadata_token', 0) + 1
+    return web.json_response({"access_token": FAKE_GCP_TOKEN, "expires_in": 3599, "token_type": "Bearer"})
+
+
+def make_gcp_app(api: FakeWorkstationsAPI) -> web.Application:
+    app = web.Application()
+    app['calls'] = api.calls
+    app.router.add_get('/computeMetadata/v1/instance/service-accounts/default/token', handle_metadata_token)
+    prefix = '/v1/projects/{project}/locations/{region}/workstationClusters/{cluster}/workstationConfigs/{config}'
+    app.router.add_get(prefix + '/workstations', api.handle_list)
+    app.router.add_route('*', prefix + '/workstations/{name}', api.handle)
+    return app
+
+
+# === Workstation (TLS) ===
+
+def check_auth(request):
+    if not request.headers.get('Authorization', '').startswith(f"Bearer {FAKE_WS_TOKEN_PREFIX}"):
+        raise web.HTTPUnauthorized(text="missing workstation token")
+
+
+async def handle_workbench(request):
+    """IDEのトップページ（静的リソースへの参照を含むHTML）"""
+    check_auth(request)
+    if request.headers.get('Upgrade', '').lower() == 'websocket':
+        return await handle_echo(request)
+    n = request.app['assets']
+    scripts = "\n".join(
+        f'<script src="/stable-{COMMIT}/static/out/vs/module{i}.js"></script>' for i in range(n)
+    )
+    return web.Response(text=f"<!DOCTYPE html><html><head>{scripts}</head><body></body></html>",
+                        content_type='text/html', headers={'Cache-Control': 'no-store'})
+
+
+async def handle_static(request):
+    """code-ossの静的リソース（不変・長期キャッシュ可）"""
+    check_auth(request)
+    path = request.match_info['path']
+    # ファイル名の番号でサイズを変える（小さいものが大半、たまに大きいもの）
+    digits = ''.join(c for c in path if c.isdigit())
+    size = 200_000 if digits and int(digits) % 10 == 0 else 8_000
+    body = asset_body(path, size)
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    headers = {'ETag': etag, 'Cache-Control': 'public, max-age=31536000, immutable'}
+    if request.headers.get('If-None-Match') == etag:
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type='application/javascript', headers=headers)
+
+
+async def handle_large(request):
+    """大きなダウンロード（?mb=）をチャンクで送信"""
+    check_auth(request)
+    mb = int(request.query.get('mb', '32'))
+    response = web.StreamResponse(headers={'Content-Length': str(mb * 1024 * 1024)})
+    response.content_type = 'application/octet-stream'
+    await response.prepare(request)
+    chunk = b'\0' * (1024 * 1024)
+    try:
+        for _ in range(mb):
+            await response.write(chunk)
+        await response.write_eof()
+    except ConnectionError:
+        pass  # クライアント（プロキシ）が途中で切断
+    return response
+
+
+async def handle_echo(request):
+    """エコーWebSocket（拡張機能ホスト/ターミナルの代わり）"""
+    check_auth(request)
+    ws = web.WebSocketResponse(max_msg_size=0)
+    await ws.prepare(request)
+    async for msg in ws:
+        if msg.type == WSMsgType.TEXT:
+            await ws.send_str(msg.data)
+        elif msg.type == WSMsgType.BINARY:
+            await ws.send_bytes(msg.data)
+    return ws
+
+
+def make_upstream_app(assets: int = 60, api: FakeWorkstationsAPI = None) -> web.Application:
+    """api を渡すと、RUNNING でないWorkstation（Hostの先頭のラベル）へのリクエストは 503"""
+    middlewares = []
+    if api is not None:
+        @web.middleware
+        async def require_running(request, handler):
+            name = request.host.split('.', 1)[0]
+            if api.state(name) != 'STATE_RUNNING':
+                return web.Response(status=503, text="workstation is not running")
+            return await handler(request)
+        middlewares.append(require_running)
+    app = web.Application(middlewares=middlewares)
+    app['assets'] = assets
+    app.router.add_get(f'/stable-{COMMIT}/static/{{path:.*}}', handle_static)
+    app.router.add_get('/large', handle_large)
+    app.router.add_get('/echo', handle_echo)
+    app.router.add_get('/{tail:.*}', handle_workbench)
+    return app
+
+
+def make_server_ssl_context(cert: str, key: str) -> ssl.SSLContext:
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+async def start_site(app, port, ssl_context=None, host='127.0.0.1'):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port, ssl_context=ssl_context)
+    await site.start()
+    return runner
+
+
+def proxy_env(api_port: int, upstream_port: int, cert: str) -> dict:
+    """proxy.py を代替サーバーに向けるための環境変数"""
+    return {
+        'METADATA_TOKEN_URL': f"http://127.0.0.1:{api_port}/computeMetadata/v1/instance/service-accounts/default/token",
+        'WORKSTATIONS_API_URL': f"http://127.0.0.1:{api_port}",
+        'CLUSTER_HOSTNAME': 'cluster.bench.test',
+        'UPSTREAM_CONNECT_ADDRESS': f"127.0.0.1:{upstream_port}",
+        'UPSTREAM_CA_FILE': cert,
+    }
+
+
+async def serve(args):
+    directory = tempfile.mkdtemp(prefix='proxy-bench-')
+    cert, key = make_cert(directory)
+    api = FakeWorkstationsAPI(start_delay=args.start_delay, latency=args.api_latency)
+    runners = [
+        await start_site(make_gcp_app(api), args.api_port),
+        await start_site(make_upstream_app(api=api), args.upstream_port, make_server_ssl_context(cert, key)),
+    ]
+    for key_, value in proxy_env(args.api_port, args.upstream_port, cert).items():
+        print(f"export {key_}={value}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+        print(json.dumps(api.calls), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--api-port', type=int, default=18090)
+    parser.add_argument('--upstream-port', type=int, default=18443)
+    parser.add_argument('--start-delay', type=float, default=2.0)
+    parser.add_argument('--api-latency', type=float, default=0.02)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+"""
+proxy.py の負荷試験（ローカルのみ、GCP不要）
+- bench/fakes.py のメタデータサーバー・Workstations API・TLS Workstationを起動
+- proxy.py を別プロセスで起動し、環境変数で接続先を代替サーバーに向ける
+- シナリオごとに requests/sec, p50/p99レイテンシ, WebSocketスループット,
+  プロキシプロセスのピークRSSと1リクエストあたりCPU時間を計測
+- 結果は bench/results/ にJSONで保存し、--compare で前回と比較
+
+使い方:
+    python bench/loadtest.py                        # 全シナリオ
+    python bench/loadtest.py --scenario small_assets --scenario websockets
+    python bench/loadtest.py --env RESPONSE_CACHE=false --label no-cache
+    python bench/loadtest.py --compare last         # 直前の結果との比較を表示
+
+Linux専用（/proc からプロキシプロセスのCPU・メモリを読む）。openssl コマンドが必要。
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import aiohttp
+from aiohttp import WSMsgType
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+import fakes  # noqa: E402
+
+PROXY_PATH = os.path.join(os.path.dirname(BENCH_DIR), 'proxy.py')
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def read_stat(pid) -> list:
+    with open(f'/proc/{pid}/stat') as f:
+        # プロセス名に空白が含まれても良いように ')' 以降を分割
+        return f.read().rsplit(')', 1)[1].split()
+
+
+class ProcessMonitor:
+    """/proc からプロキシプロセス（ワーカーモードでは子プロセスも含む）のCPU時間とRSSを取得"""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.peak_rss = 0
+        self._task = None
+
+    def pids(self) -> list:
+        pids = [self.pid]
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    # ppid は ')' 以降の 2 番目
+                    if int(read_stat(entry)[1]) == self.pid:
+                        pids.append(int(entry))
+                except (OSError, IndexError):
+                    pass
+        return pids
+
+    def cpu_seconds(self) -> float:
+        total = 0
+        for pid in self.pids():
+            try:
+                fields = read_stat(pid)
+            except OSError:
+                continue
+            # utime, stime は ')' 以降の 12, 13 番目
+            total += int(fields[11]) + int(fields[12])
+        return total / CLOCK_TICKS
+
+    def rss_bytes(self) -> int:
+        total = 0
+        for pid in self.pids():
+            try:
+                with open(f'/proc/{pid}/status') as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1]) * 1024
+                            break
+            except OSError:
+                pass
+        return total
+
+    async def _sample(self):
+        while True:
+            self.peak_rss = max(self.peak_rss, self.rss_bytes())
+            await asyncio.sleep(0.05)
+
+    def start(self):
+        self.peak_rss = self.rss_bytes()
+        self._task = asyncio.create_task(self._sample())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+class Recorder:
+    """1シナリオ分の計測値"""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.bytes = 0
+        self.messages = 0
+
+    async def get(self, session, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            async with session.get(url, **kwargs) as resp:
+                async for chunk in resp.content.iter_any():
+                    self.bytes += len(chunk)
+                if resp.status >= 400:
+                    self.errors += 1
+                    return None
+                self.latencies.append(time.perf_counter() - start)
+                return resp
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.errors += 1
+            return None
+
+
+async def run_pool(concurrency: int, total: int, job):
+    """total 回の job(i) を concurrency 並列で実行"""
+    counter = iter(range(total))
+
+    async def worker():
+        for i in counter:
+            await job(i)
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+
+def client_session(base, limit=0, cookies=False):
+    return aiohttp.ClientSession(
+        base_url=base,
+        connector=aiohttp.TCPConnector(limit=limit),
+        cookie_jar=aiohttp.CookieJar(unsafe=True) if cookies else aiohttp.DummyCookieJar(),
+        timeout=aiohttp.ClientTimeout(total=120),
+    )
+
+
+# === シナリオ ===
+
+async def scenario_cold_ide(base, args, rec):
+    """
+    初回のIDE読み込み: 未使用のWorkstation名ごとに新しいブラウザ（Cookieなし）で
+    ページとそこから参照される静的リソースを取得（ブラウザ同様に6並列）
+    """
+    run_id = int(time.time() * 1000) % 1_000_000
+    page_loads = []
+
+    async def user(i):
+        name = f"cold-{run_id}-{i}"
+        start = time.perf_counter()
+        async with client_session(base, limit=6, cookies=True) as session:
+            resp = await rec.get(session, f'/ws/{name}/')
+            if resp is None:
+                return
+            assets = [f'/stable-{fakes.COMMIT}/static/out/vs/module{j}.js' for j in range(args.assets)]
+            await run_pool(6, len(assets), lambda j: rec.get(session, assets[j]))
+        page_loads.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[user(i) for i in range(args.cold_users)])
+    return {
+        "page_load_p50_ms": percentile(page_loads, 0.5) * 1000,
+        "page_load_p99_ms": percentile(page_loads, 0.99) * 1000,
+    }
+
+
+async def scenario_status_then_open(base, args, rec):
+    """
+    ステータスページを開いてから少し後に "Open Workstation" を押す流れ
+    最初の /ws/{name}/ の時間を計測（WARMUP_ENABLED=false と比較する）
+    """
+    run_id = int(time.time() * 1000) % 1_000_000
+
+    async def user(i):
+        name = f"open-{run_id}-{i}"
+        async with client_session(base, cookies=True) as session:
+            if await rec.get(session, f'/status/{name}') is None:
+                return
+            await asyncio.sleep(args.think_time)
+            start = time.perf_counter()
+            if await rec.get(session, f'/ws/{name}/') is not None:
+                first_loads.append(time.perf_counter() - start)
+
+    first_loads = []
+    await asyncio.gather(*[user(i) for i in range(args.cold_users)])
+    return {
+        "first_load_p50_ms": percentile(first_loads, 0.5) * 1000,
+        "first_load_p99_ms": percentile(first_loads, 0.99) * 1000,
+    }
+
+
+async def scenario_small_assets(base, args, rec):
+    """キャッシュ可能な小さい静的リソースを大量に取得"""
+    async with client_session(base) as session:
+        await run_pool(args.concurrency, args.requests, lambda i: rec.get(
+            session, f'/ws/bench/stable-{fakes.COMMIT}/static/out/vs/module{i % 100 * 10 + 1}.js'))
+
+
+async def scenario_small_dynamic(base, args, rec):
+    """キャッシュされない小さいレスポンス（毎回Workstationまで往復）"""
+    async with client_session(base) as session:
+        await run_pool(args.concurrency, args.requests, lambda i: rec.get(session, f'/ws/bench/page{i}'))
+
+
+async def scenario_large_download(base, args, rec):
+    """大きなファイルの並列ダウンロード"""
+    async with client_session(base) as session:
+        await run_pool(args.download_concurrency, args.downloads,
+                       lambda i: rec.get(session, f'/ws/bench/large?mb={args.download_mb}'))
+
+
+async def scenario_websockets(base, args, rec):
+    """多数のWebSocketで同時にメッセージを往復"""
+    payload = b'x' * args.ws_size
+
+    async def socket_client(session):
+        try:
+            async with session.ws_connect('/ws/bench/echo', max_msg_size=0) as ws:
+                sent_at = []
+                received = 0
+                while received < args.ws_messages:
+                    while len(sent_at) < args.ws_messages and len(sent_at) - received < args.ws_window:
+                        sent_at.append(time.perf_counter())
+                        await ws.send_bytes(payload)
+                    msg = await ws.receive()
+                    if msg.type != WSMsgType.BINARY:
+                        rec.errors += 1
+                        return
+                    rec.latencies.append(time.perf_counter() - sent_at[received])
+                    rec.messages += 1
+                    rec.bytes += len(msg.data)
+                    received += 1
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            rec.errors += 1
+
+    async with client_session(base) as session:
+        await asyncio.gather(*[socket_client(session) for _ in range(args.ws_sockets)])
+
+
+async def scenario_noisy_neighbor(base, args, rec):
+    """
+    1つのWorkstationが大量の取得と大きなダウンロードを続ける間、
+    別のWorkstationの小さいリクエストのレイテンシを計測（受付制御・帯域の分配の確認用）
+    rec には静かな側のリクエストだけを記録
+    """
+    noisy = Recorder()
+    done = asyncio.Event()
+
+    async def flood(session, path):
+        while not done.is_set():
+            await noisy.get(session, path)
+
+    async with client_session(base) as noisy_session, client_session(base) as quiet_session:
+        flooders = [asyncio.create_task(flood(noisy_session, '/ws/noisy/page'))
+                    for _ in range(args.concurrency)]
+        flooders += [asyncio.create_task(flood(noisy_session, f'/ws/noisy/large?mb={args.download_mb}'))
+                     for _ in range(args.download_concurrency)]
+        try:
+            await asyncio.sleep(0.5)
+            await run_pool(4, args.requests // 10, lambda i: rec.get(quiet_session, f'/ws/quiet/page{i}'))
+        finally:
+            done.set()
+            for task in flooders:
+                task.cancel()
+            await asyncio.gather(*flooders, return_exceptions=True)
+    return {
+        "noisy_requests": len(noisy.latencies),
+        "noisy_rejected": noisy.errors,
+    }
+
+
+SCENARIOS = {
+    'cold_ide': scenario_cold_ide,
+    'status_then_open': scenario_status_then_open,
+    'small_assets': scenario_small_assets,
+    'small_dynamic': scenario_small_dynamic,
+    'large_download': scenario_large_download,
+    'websockets': scenario_websockets,
+    'noisy_neighbor': scenario_noisy_neighbor,
+}
+
+
+async def run_scenario(name, base, args, monitor):
+    rec = Recorder()
+    monitor.start()
+    cpu_before = monitor.cpu_seconds()
+    start = time.perf_counter()
+    extra = await SCENARIOS[name](base, args, rec) or {}
+    elapsed = time.perf_counter() - start
+    cpu = monitor.cpu_seconds() - cpu_before
+    await monitor.stop()
+
+    count = rec.messages or len(rec.latencies)
+    result = {
+        "count": count,
+        "errors": rec.errors,
+        "seconds": elapsed,
+        "per_sec": count / elapsed,
+        "p50_ms": percentile(rec.latencies, 0.5) * 1000,
+        "p99_ms": percentile(rec.latencies, 0.99) * 1000,
+        "mb_per_sec": rec.bytes / elapsed / 1e6,
+        "cpu_ms_per_op": cpu * 1000 / count if count else 0.0,
+        "proxy_cpu_util": cpu / elapsed,
+        "peak_rss_mb": monitor.peak_rss / 1e6,
+    }
+    result.update(extra)
+    return result
+
+
+# === プロキシの起動 ===
+
+async def start_proxy(env, port, log_path):
+    log_file = open(log_path, 'w')
+    process = subprocess.Popen(
+        [sys.executable, PROXY_PATH],
+        env={**os.environ, **env, 'PORT': str(port)},
+        stdout=log_file,
+        stderr=subprocess.STDOUT,
+    )
+    async with aiohttp.ClientSession() as session:
+        for _ in range(200):
+            if process.poll() is not None:
+                raise RuntimeError(f"proxy exited with {process.returncode}, see {log_path}")
+            try:
+                async with session.get(f'http://127.0.0.1:{port}/health') as resp:
+                    if resp.status == 200:
+                        return process
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"proxy did not become healthy, see {log_path}")
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=BENCH_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+# === 結果の保存と比較 ===
+
+SUMMARY_KEYS = ['per_sec', 'p50_ms', 'p99_ms', 'mb_per_sec', 'cpu_ms_per_op', 'peak_rss_mb', 'errors']
+BASE_KEYS = {'count', 'seconds', 'proxy_cpu_util'}
+LOWER_IS_BETTER = {'p50_ms', 'p99_ms', 'cpu_ms_per_op', 'peak_rss_mb', 'errors'}
+
+
+def save_results(results: dict, directory: str = RESULTS_DIR) -> str:
+    os.makedirs(directory, exist_ok=True)
+    name = time.strftime('%Y%m%d-%H%M%S')
+    if results["meta"]["label"]:
+        name += f"-{results['meta']['label']}"
+    path = os.path.join(directory, f'{name}.json')
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    return path
+
+
+def load_previous(spec: str, exclude: str = None, directory: str = RESULTS_DIR) -> dict:
+    if spec == 'last':
+        files = sorted(
+            os.path.join(directory, f) for f in os.listdir(directory)
+            if f.endswith('.json') and os.path.join(directory, f) != exclude
+        ) if os.path.isdir(directory) else []
+        if not files:
+            return None
+        spec = files[-1]
+    with open(spec) as f:
+        return json.load(f)
+
+
+def print_results(results: dict, previous: dict = None):
+    print(f"\n{'scenario':<16}" + ''.join(f"{k:>16}" for k in SUMMARY_KEYS))
+    for name, result in results["scenarios"].items():
+        print(f"{name:<16}" + ''.join(f"{result[k]:>16.2f}" for k in SUMMARY_KEYS))
+        extra = {k: v for k, v in result.items() if k not in SUMMARY_KEYS and k not in BASE_KEYS}
+        if extra:
+            print(f"{'':<16}" + ', '.join(f"{k} {v:.2f}" for k, v in extra.items()))
+        before = (previous or {}).get("scenarios", {}).get(name)
+        if before:
+            cells = []
+            for k in SUMMARY_KEYS:
+                if not before.get(k):
+                    cells.append(f"{'-':>16}")
+                    continue
+                change = (result[k] - before[k]) / before[k] * 100
+                better = (change < 0) == (k in LOWER_IS_BETTER)
+                cells.append(f"{change:>+14.1f}%{'+' if better else ' '}")
+            print(f"{'  vs previous':<16}" + ''.join(cells))
+    if previous:
+        meta = previous["meta"]
+        print(f"\n(previous: {meta['timestamp']} {meta['revision']} {meta['label'] or ''})")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS),
+                        help='実行するシナリオ（複数指定可、省略時はすべて）')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='proxy.py に渡す追加の環境変数（設定の比較用）')
+    parser.add_argument('--label', default='', help='結果ファイル名に付けるラベル')
+    parser.add_argument('--compare', metavar='PATH|last', help='比較する以前の結果')
+    parser.add_argument('--no-save', action='store_true')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--cold-users', type=int, default=10)
+    parser.add_argument('--assets', type=int, default=60, help='IDEページあたりの静的リソース数')
+    parser.add_argument('--think-time', type=float, default=1.0, help='ステータスページを開いてからIDEを開くまでの秒数')
+    parser.add_argument('--downloads', type=int, default=20)
+    parser.add_argument('--download-concurrency', type=int, default=5)
+    parser.add_argument('--download-mb', type=int, default=32)
+    parser.add_argument('--ws-sockets', type=int, default=100)
+    parser.add_argument('--ws-messages', type=int, default=500)
+    parser.add_argument('--ws-size', type=int, default=512)
+    parser.add_argument('--ws-window', type=int, default=8)
+    parser.add_argument('--api-latency', type=float, default=0.03, help='Workstations APIの擬似遅延（秒）')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='proxy-bench-')
+    cert, key = fakes.make_cert(directory)
+    api_port, upstream_port, proxy_port = free_port(), free_port(), free_port()
+
+    api = fakes.FakeWorkstationsAPI(latency=args.api_latency)
+    runners = [
+        await fakes.start_site(fakes.make_gcp_app(api), api_port),
+        await fakes.start_site(fakes.make_upstream_app(args.assets), upstream_port,
+                               fakes.make_server_ssl_context(cert, key)),
+    ]
+
+    overrides = dict(item.split('=', 1) for item in args.env)
+    # websockets シナリオは1つのWorkstationに --ws-sockets 本を同時に開いて中継性能を測るので、
+    # ハンドシェイクの速度制限は外す（--env WS_HANDSHAKE_RATE=2 等で上書きできる）
+    env = {**fakes.proxy_env(api_port, upstream_port, cert), 'WS_HANDSHAKE_RATE': '0', **overrides}
+    log_path = os.path.join(directory, 'proxy.log')
+    process = await start_proxy(env, proxy_port, log_path)
+    monitor = ProcessMonitor(process.pid)
+    base = f'http://127.0.0.1:{proxy_port}'
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+            "revision": git_revision(),
+            "label": args.label,
+            "python": platform.python_version(),
+            "aiohttp": aiohttp.__version__,
+            "cpus": os.cpu_count(),
+            "env": overrides,
+            "args": {k: v for k, v in vars(args).items() if k not in ('env', 'compare', 'no_save')},
+        },
+        "scenarios": {},
+    }
+
+    try:
+        for name in args.scenario or list(SCENARIOS):
+            print(f"running {name}...", file=sys.stderr)
+            results["scenarios"][name] = await run_scenario(name, base, args, monitor)
+        results["api_calls"] = dict(api.calls)
+    finally:
+        # 代替サーバーは同じイベントループで動いているので、終了待ちでループを止めない
+        process.terminate()
+        await asyncio.to_thread(process.wait, 30)
+        for runner in runners:
+            await runner.cleanup()
+
+    path = None if args.no_save else save_results(results)
+    previous = load_previous(args.compare, exclude=path) if args.compare else None
+    print_results(results, previous)
+    print(f"\nAPI calls: {results['api_calls']}")
+    print(f"proxy log: {log_path}")
+    if path:
+        print(f"saved: {path}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,534 @@
+#!/usr/bin/env python3
+"""
+記録したトラフィック（proxy.py の CAPTURE_FILE）の再生（ローカルのみ、GCP不要）
+- 記録の時刻どおりに（--speed 倍速で）HTTPリクエストとWebSocketのフレームを送る
+  応答を待たずに次を送るので、プロキシが遅くなると同時接続が増える（実際の利用と同じ）
+- 上流は記録に合わせて応答する代替Workstation: ステータス・サイズ・Content-Type・TTFBを再現し、
+  WebSocketではWorkstation→ブラウザ方向のフレームを記録の時刻どおりに送る
+- 種類ごと（asset: キャッシュ対象の静的リソース, dynamic, download: 256KiB超, ws_connect, ws_up, ws_down）の
+  レイテンシ分布とスループット、プロキシのCPU時間・ピークRSS、再生側の送信の遅れを表示
+- 結果は bench/results/replay/ にJSONで保存し、--compare で別のバージョン・設定の結果と比較
+
+使い方:
+    CAPTURE_FILE=/tmp/capture.jsonl python proxy.py            # 検証環境などで記録
+    python bench/replay.py /tmp/capture.jsonl --dry-run        # 記録の概要だけ表示
+    python bench/replay.py /tmp/capture.jsonl                  # 1倍速で再生
+    python bench/replay.py /tmp/capture.jsonl --speed 4 --compare last
+    python bench/replay.py /tmp/capture.jsonl.* --env RESPONSE_CACHE=false --label no-cache
+
+再現しないもの:
+- サイズはブラウザ側のバイト数（圧縮後）。代替Workstationはそのサイズの無圧縮テキストを返すので、圧縮率は異なる
+- 上流のTTFBは倍速でも実時間のまま（Workstationの応答は速くならない）
+- WebSocketのフレームには計測用に送信時刻を埋め込むため、20バイト未満のフレームは20バイトで送る
+- パスは形だけなので、/ws/{name}/ を使わないリクエストも /ws/{name}/ 付きで送る
+
+Linux専用（/proc からプロキシプロセスのCPU・メモリを読む）。openssl コマンドが必要。
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import platform
+import tempfile
+import statistics
+from urllib.parse import urlencode
+
+import aiohttp
+from aiohttp import web, WSMsgType
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+import fakes  # noqa: E402
+from loadtest import (  # noqa: E402
+    ProcessMonitor, free_port, git_revision, load_previous, percentile, save_results, start_proxy,
+)
+
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results', 'replay')
+# キャッシュ対象だったリクエストは proxy.py の CACHE_PATH_PATTERN に一致するパスで送る
+CACHE_PREFIX = f'/stable-{fakes.COMMIT}/static'
+DOWNLOAD_BYTES = 256 * 1024
+STAMP_BYTES = 20
+CLASSES = ['asset', 'dynamic', 'download', 'ws_connect', 'ws_up', 'ws_down']
+
+
+# === 記録の読み込み ===
+
+def load_capture(paths: list) -> list:
+    """
+    記録ファイル（ワーカーごとのファイルや再起動をまたいでもよい）を読み込み、時刻順のイベントにする
+    Workstationの連番はプロセスごとなので、先頭行（"capture"）ごとに別のWorkstationとして扱う
+    """
+    events = []
+    segment = 0
+    for path in paths:
+        started = None
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # 書き込み途中で止まった行
+                if "capture" in record:
+                    segment += 1
+                    started = record["started"]
+                    continue
+                if started is None:
+                    continue
+                record["at"] = started + record["t"]
+                record["ws"] = f"replay-{segment}-{record['w']}"
+                events.append(record)
+    events.sort(key=lambda e: e["at"])
+    if events:
+        origin = events[0]["at"]
+        for event in events:
+            event["at"] -= origin
+    return events
+
+
+def classify(event: dict) -> str:
+    if event["k"] == "ws":
+        return 'ws_connect'
+    if "c" in event:
+        return 'asset'
+    return 'download' if event["out"] > DOWNLOAD_BYTES else 'dynamic'
+
+
+def etag(path: str, size: int) -> str:
+    return '"' + hashlib.sha1(f"{path}:{size}".encode()).hexdigest() + '"'
+
+
+def build_requests(events: list) -> list:
+    """
+    HTTPイベントごとに送るパス・クエリ・ヘッダーを決める
+    キャッシュ対象のパスは記録中で同じ応答（最大サイズ・TTFBの中央値）を返すようにクエリを固定し、
+    キャッシュキーが変わらないようにする
+    """
+    assets = {}
+    for event in events:
+        if event["k"] == "http" and "c" in event:
+            asset = assets.setdefault(event["p"], {"size": 0, "ttfb": [], "ct": ''})
+            asset["size"] = max(asset["size"], event["out"])
+            if "u" in event:
+                asset["ttfb"].append(event["u"])
+            asset["ct"] = asset["ct"] or event.get("ct", '')
+
+    for event in events:
+        if event["k"] != "http":
+            continue
+        headers = {'Accept-Encoding': event.get("ae", 'identity').replace(',', ', ')}
+        if "c" in event:
+            asset = assets[event["p"]]
+            path = CACHE_PREFIX + event["p"]
+            query = {"_n": asset["size"], "_ct": asset["ct"],
+                     "_u": statistics.median(asset["ttfb"]) if asset["ttfb"] else 0}
+            if event["s"] == 304:
+                headers['If-None-Match'] = etag(path, asset["size"])
+        else:
+            path = event["p"]
+            query = {"_s": event["s"], "_n": event["out"], "_ct": event.get("ct", ''), "_u": event.get("u", 0)}
+        event["url"] = f"/ws/{event['ws']}{path}?{urlencode(query)}"
+        event["headers"] = headers
+    return events
+
+
+def describe(events: list):
+    """記録の概要（--dry-run）"""
+    if not events:
+        print("no events")
+        return
+    duration = events[-1]["at"]
+    counts = {}
+    for event in events:
+        counts[classify(event)] = counts.get(classify(event), 0) + 1
+    frames = [f for e in events if e["k"] == "ws" for f in e["f"]]
+    per_second = {}
+    for event in events:
+        per_second[int(event["at"])] = per_second.get(int(event["at"]), 0) + 1
+    print(f"duration {duration:.1f}s, workstations {len({e['ws'] for e in events})}, events {len(events)}")
+    print("  " + ', '.join(f"{name} {count}" for name, count in counts.items()))
+    print(f"  peak {max(per_second.values())} events/s, "
+          f"http bytes {sum(e.get('out', 0) for e in events) / 1e6:.1f} MB down, "
+          f"{sum(e.get('in', 0) for e in events) / 1e6:.1f} MB up")
+    if frames:
+        print(f"  websocket frames {len(frames)} "
+              f"(up {sum(1 for f in frames if f[1] == 0)}, down {sum(1 for f in frames if f[1] == 1)}), "
+              f"median size {statistics.median(f[2] for f in frames):.0f} B")
+
+
+# === 計測 ===
+
+class Stats:
+    def __init__(self):
+        self.latencies = {name: [] for name in CLASSES}
+        self.captured = {name: [] for name in CLASSES}  # 記録時のプロキシ内の所要時間（参考）
+        self.errors = {name: 0 for name in CLASSES}
+        self.bytes = {name: 0 for name in CLASSES}
+        self.late = []  # 予定時刻からの送信の遅れ（再生側が追いついているか）
+
+    def summary(self, elapsed: float) -> dict:
+        result = {}
+        for name in CLASSES:
+            values = self.latencies[name]
+            if not values and not self.errors[name]:
+                continue
+            result[name] = {
+                "count": len(values),
+                "errors": self.errors[name],
+                "per_sec": len(values) / elapsed,
+                "p50_ms": percentile(values, 0.5) * 1000,
+                "p90_ms": percentile(values, 0.9) * 1000,
+                "p99_ms": percentile(values, 0.99) * 1000,
+                "max_ms": max(values, default=0) * 1000,
+                "mb_per_sec": self.bytes[name] / elapsed / 1e6,
+            }
+            if self.captured[name]:
+                result[name]["captured_p50_ms"] = percentile(self.captured[name], 0.5)
+                result[name]["captured_p99_ms"] = percentile(self.captured[name], 0.99)
+        return result
+
+
+def stamp(size: int, text: bool):
+    """送信時刻を先頭に埋め込んだペイロード（受信側で遅延を計算する）"""
+    head = f"{time.monotonic():.6f} "
+    payload = head + 'x' * max(0, size - len(head))
+    return payload if text else payload.encode()
+
+
+def delay(data) -> float:
+    if isinstance(data, bytes):
+        data = data[:STAMP_BYTES].decode(errors='replace')
+    try:
+        return time.monotonic() - float(data.split(' ', 1)[0])
+    except ValueError:
+        return None
+
+
+async def play_frames(ws, frames: list, speed: float, origin: float):
+    """[ミリ秒, 方向, サイズ, テキスト] を origin からの時刻どおりに送る"""
+    for offset, _direction, size, text in frames:
+        wait = origin + offset / 1000 / speed - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        if ws.closed:
+            return
+        size = max(size, STAMP_BYTES)
+        if text:
+            await ws.send_str(stamp(size, True))
+        else:
+            await ws.send_bytes(stamp(size, False))
+
+
+async def receive_frames(ws, stats: Stats, name: str):
+    async for msg in ws:
+        if msg.type in (WSMsgType.TEXT, WSMsgType.BINARY):
+            value = delay(msg.data)
+            if value is not None:
+                stats.latencies[name].append(value)
+                stats.bytes[name] += len(msg.data)
+
+
+# === 代替Workstation ===
+
+class StandIn:
+    """記録に合わせて応答する代替Workstation（ステータス・サイズ・Content-Type・TTFB はクエリで指定）"""
+
+    BLOCK = fakes.asset_body('/replay', 64 * 1024)
+
+    def __init__(self, stats: Stats, speed: float):
+        self.stats = stats
+        self.speed = speed
+        self.scripts = {}  # WebSocket番号 -> Workstation→ブラウザ方向のフレーム
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=0)
+        app.router.add_get('/_replay_ws/{index}', self.handle_websocket)
+        app.router.add_route('*', '/{tail:.*}', self.handle_http)
+        return app
+
+    async def handle_http(self, request):
+        fakes.check_auth(request)
+        status = int(request.query.get('_s', '200'))
+        size = int(request.query.get('_n', '0'))
+        content_type = request.query.get('_ct') or 'application/octet-stream'
+        latency = float(request.query.get('_u', '0')) / 1000
+        if request.body_exists:
+            async for _ in request.content.iter_any():
+                pass
+        if latency:
+            await asyncio.sleep(latency)
+
+        if request.path.startswith(CACHE_PREFIX):
+            tag = etag(request.path, size)
+            headers = {'ETag': tag, 'Cache-Control': 'public, max-age=31536000, immutable'}
+            if request.headers.get('If-None-Match') == tag:
+                return web.Response(status=304, headers=headers)
+        else:
+            headers = {'Cache-Control': 'no-store'}
+        if status in (204, 304) or request.method == 'HEAD':
+            return web.Response(status=status, headers=headers)
+        if size <= DOWNLOAD_BYTES:
+            return web.Response(status=status, body=fakes.asset_body(request.path, size),
+                                content_type=content_type, headers=headers)
+
+        response = web.StreamResponse(status=status, headers={**headers, 'Content-Length': str(size)})
+        response.content_type = content_type
+        await response.prepare(request)
+        try:
+            sent = 0
+            while sent < size:
+                chunk = self.BLOCK[:size - sent]
+                await response.write(chunk)
+                sent += len(chunk)
+            await response.write_eof()
+        except ConnectionError:
+            pass
+        return response
+
+    async def handle_websocket(self, request):
+        fakes.check_auth(request)
+        frames = self.scripts.get(int(request.match_info['index']), [])
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        sender = asyncio.create_task(play_frames(ws, frames, self.speed, time.monotonic()))
+        try:
+            await receive_frames(ws, self.stats, 'ws_up')
+        finally:
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+        return ws
+
+
+# === 再生 ===
+
+class Replayer:
+    def __init__(self, base: str, stats: Stats, standin: StandIn, args):
+        self.base = base
+        self.stats = stats
+        self.standin = standin
+        self.args = args
+        self.sessions = {}
+        self.bodies = {}
+
+    def session(self, ws_name: str) -> aiohttp.ClientSession:
+        """Workstation（=ブラウザ）ごとのセッション（接続数はブラウザのHTTP/1.1の上限に合わせる）"""
+        if ws_name not in self.sessions:
+            self.sessions[ws_name] = aiohttp.ClientSession(
+                base_url=self.base,
+                connector=aiohttp.TCPConnector(limit=self.args.connections),
+                cookie_jar=aiohttp.DummyCookieJar(),
+                timeout=aiohttp.ClientTimeout(total=self.args.timeout),
+                auto_decompress=False,
+            )
+        return self.sessions[ws_name]
+
+    async def close(self):
+        for session in self.sessions.values():
+            await session.close()
+
+    def body(self, size: int) -> bytes:
+        if size not in self.bodies:
+            self.bodies[size] = b'\0' * size
+        return self.bodies[size]
+
+    async def play(self, index: int, event: dict):
+        if event["k"] == "ws":
+            await self.play_websocket(index, event)
+        else:
+            await self.play_http(event)
+
+    async def play_http(self, event: dict):
+        name = classify(event)
+        self.stats.captured[name].append(event["d"])
+        data = self.body(event["in"]) if event["in"] else None
+        start = time.monotonic()
+        try:
+            async with self.session(event["ws"]).request(
+                event["m"], event["url"], headers=event["headers"], data=data, allow_redirects=False,
+            ) as resp:
+                async for chunk in resp.content.iter_any():
+                    self.stats.bytes[name] += len(chunk)
+                # 記録では成功していたのに 5xx になったものだけを失敗と数える（503 の記録はそのまま再現される）
+                if resp.status >= 500 and event["s"] < 500:
+                    self.stats.errors[name] += 1
+                    return
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.stats.errors[name] += 1
+            return
+        self.stats.latencies[name].append(time.monotonic() - start)
+
+    async def play_websocket(self, index: int, event: dict):
+        self.standin.scripts[index] = [f for f in event["f"] if f[1] == 1]
+        start = time.monotonic()
+        try:
+            ws = await self.session(event["ws"]).ws_connect(
+                f"/ws/{event['ws']}/_replay_ws/{index}", max_msg_size=0)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.stats.errors['ws_connect'] += 1
+            return
+        # フレームの時刻は中継の開始（Workstationとの接続後）からの経過時間
+        connected = time.monotonic()
+        self.stats.latencies['ws_connect'].append(connected - start)
+        receiver = asyncio.create_task(receive_frames(ws, self.stats, 'ws_down'))
+        try:
+            await play_frames(ws, [f for f in event["f"] if f[1] == 0], self.args.speed, connected)
+            # 記録の接続時間が過ぎるまで（その間にWorkstation側のフレームが届く）開いておく
+            remaining = connected + event["d"] / 1000 / self.args.speed - time.monotonic()
+            if remaining > 0:
+                await asyncio.wait([receiver], timeout=remaining)
+        except (aiohttp.ClientError, ConnectionError):
+            self.stats.errors['ws_connect'] += 1
+        finally:
+            await ws.close()
+            receiver.cancel()
+            await asyncio.gather(receiver, return_exceptions=True)
+            self.standin.scripts.pop(index, None)
+
+    async def run(self, events: list) -> float:
+        """記録の時刻どおりにイベントを開始し、すべて終わるまで待つ。再生にかかった秒数を返す"""
+        tasks = []
+        origin = time.monotonic()
+        for index, event in enumerate(events):
+            due = origin + event["at"] / self.args.speed
+            wait = due - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.stats.late.append(max(0.0, time.monotonic() - due))
+            tasks.append(asyncio.create_task(self.play(index, event)))
+        await asyncio.gather(*tasks)
+        return time.monotonic() - origin
+
+
+# === 結果の表示 ===
+
+COLUMNS = ['count', 'errors', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms', 'mb_per_sec']
+COMPARE_KEYS = ['errors', 'p50_ms', 'p90_ms', 'p99_ms']
+PROXY_KEYS = ['cpu_ms_per_request', 'proxy_cpu_util', 'peak_rss_mb', 'late_p99_ms']
+
+
+def print_results(results: dict, previous: dict = None):
+    print(f"\n{'class':<12}" + ''.join(f"{k:>12}" for k in COLUMNS) + f"{'captured p50/p99':>20}")
+    for name, result in results["classes"].items():
+        captured = ''
+        if "captured_p50_ms" in result:
+            captured = f"{result['captured_p50_ms']:.1f}/{result['captured_p99_ms']:.1f}"
+        print(f"{name:<12}" + ''.join(f"{result[k]:>12.1f}" for k in COLUMNS) + f"{captured:>20}")
+        before = (previous or {}).get("classes", {}).get(name)
+        if before:
+            cells = []
+            for k in COLUMNS:
+                if k not in COMPARE_KEYS or not before.get(k):
+                    cells.append(f"{'':>12}")
+                    continue
+                change = (result[k] - before[k]) / before[k] * 100
+                cells.append(f"{change:>+10.1f}%{'+' if change < 0 else ' '}")
+            print(f"{'  vs prev':<12}" + ''.join(cells))
+
+    proxy = results["proxy"]
+    print("\n" + ', '.join(f"{k} {proxy[k]:.2f}" for k in PROXY_KEYS))
+    if previous:
+        before = previous["proxy"]
+        print("  vs previous: " + ', '.join(
+            f"{k} {(proxy[k] - before[k]) / before[k] * 100:+.1f}%" for k in PROXY_KEYS if before.get(k)))
+        meta = previous["meta"]
+        print(f"\n(previous: {meta['timestamp']} {meta['revision']} {meta['label'] or ''})")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('capture', nargs='+', help='CAPTURE_FILE で記録したファイル（複数可）')
+    parser.add_argument('--speed', type=float, default=1.0, help='再生速度（2 なら記録の半分の時間で送る）')
+    parser.add_argument('--start', type=float, default=0.0, help='記録の先頭から飛ばす秒数')
+    parser.add_argument('--duration', type=float, default=0.0, help='再生する記録の秒数（0なら最後まで）')
+    parser.add_argument('--connections', type=int, default=6, help='Workstation（ブラウザ）ごとのHTTP接続数の上限')
+    parser.add_argument('--timeout', type=float, default=300.0, help='1リクエストのタイムアウト（秒）')
+    parser.add_argument('--dry-run', action='store_true', help='記録の概要だけ表示して終了')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='proxy.py に渡す追加の環境変数（設定の比較用）')
+    parser.add_argument('--label', default='', help='結果ファイル名に付けるラベル')
+    parser.add_argument('--compare', metavar='PATH|last', help='比較する以前の結果')
+    parser.add_argument('--no-save', action='store_true')
+    parser.add_argument('--api-latency', type=float, default=0.03, help='Workstations APIの擬似遅延（秒）')
+    args = parser.parse_args()
+
+    events = load_capture(args.capture)
+    end = args.start + args.duration if args.duration else float('inf')
+    events = [e for e in events if args.start <= e["at"] < end]
+    for event in events:
+        event["at"] -= args.start
+    describe(events)
+    if args.dry_run or not events:
+        return
+    build_requests(events)
+
+    directory = tempfile.mkdtemp(prefix='proxy-replay-')
+    cert, key = fakes.make_cert(directory)
+    api_port, upstream_port, proxy_port = free_port(), free_port(), free_port()
+
+    stats = Stats()
+    standin = StandIn(stats, args.speed)
+    api = fakes.FakeWorkstationsAPI(latency=args.api_latency)
+    runners = [
+        await fakes.start_site(fakes.make_gcp_app(api), api_port),
+        await fakes.start_site(standin.make_app(), upstream_port, fakes.make_server_ssl_context(cert, key)),
+    ]
+
+    overrides = dict(item.split('=', 1) for item in args.env)
+    env = {**fakes.proxy_env(api_port, upstream_port, cert), **overrides}
+    log_path = os.path.join(directory, 'proxy.log')
+    process = await start_proxy(env, proxy_port, log_path)
+    monitor = ProcessMonitor(process.pid)
+    replayer = Replayer(f'http://127.0.0.1:{proxy_port}', stats, standin, args)
+
+    try:
+        print(f"replaying at {args.speed}x...", file=sys.stderr)
+        monitor.start()
+        cpu_before = monitor.cpu_seconds()
+        elapsed = await replayer.run(events)
+        cpu = monitor.cpu_seconds() - cpu_before
+        await monitor.stop()
+    finally:
+        await replayer.close()
+        process.terminate()
+        await asyncio.to_thread(process.wait, 30)
+        for runner in runners:
+            await runner.cleanup()
+
+    requests = sum(1 for e in events if e["k"] == "http")
+    results = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+            "revision": git_revision(),
+            "label": args.label,
+            "python": platform.python_version(),
+            "aiohttp": aiohttp.__version__,
+            "cpus": os.cpu_count(),
+            "env": overrides,
+            "capture": [os.path.abspath(path) for path in args.capture],
+            "events": len(events),
+            "args": {k: v for k, v in vars(args).items() if k not in ('capture', 'env', 'compare', 'no_save')},
+        },
+        "classes": stats.summary(elapsed),
+        "proxy": {
+            "seconds": elapsed,
+            "cpu_ms_per_request": cpu * 1000 / requests if requests else 0.0,
+            "proxy_cpu_util": cpu / elapsed,
+            "peak_rss_mb": monitor.peak_rss / 1e6,
+            "late_p99_ms": percentile(stats.late, 0.99) * 1000,
+        },
+        "api_calls": dict(api.calls),
+    }
+
+    path = None if args.no_save else save_results(results, RESULTS_DIR)
+    previous = load_previous(args.compare, exclude=path, directory=RESULTS_DIR) if args.compare else None
+    print_results(results, previous)
+    print(f"\nproxy log: {log_path}")
+    if path:
+        print(f"saved: {path}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
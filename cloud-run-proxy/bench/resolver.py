@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+名前解決のベンチマーク（ローカルのみ、GCP不要）
+- aiohttp標準のリゾルバー（getaddrinfo をスレッドで実行）と CachingResolver を比較
+- 接続ごとに解決が走る状況を想定し、同じホスト名を concurrency 並列で resolves 回解決
+
+使い方:
+    python bench/resolver.py --host localhost --resolves 5000 --concurrency 50
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import proxy  # noqa: E402
+
+
+async def bench(name, resolver, args):
+    latencies = []
+    remaining = iter(range(args.resolves))
+
+    async def worker():
+        for _ in remaining:
+            start = time.perf_counter()
+            await resolver.resolve(args.host, 443)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+    await resolver.close()
+    latencies.sort()
+    return {
+        "resolver": name,
+        "resolves_per_sec": args.resolves / elapsed,
+        "p50_us": statistics.median(latencies) * 1e6,
+        "p99_us": latencies[int(len(latencies) * 0.99) - 1] * 1e6,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--resolves', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    args = parser.parse_args()
+
+    results = [
+        await bench('default', aiohttp.DefaultResolver(), args),
+        await bench('caching', proxy.CachingResolver(), args),
+        await bench('static', proxy.CachingResolver(static_host='10.0.0.1', static_suffix=args.host), args),
+    ]
+    print(f"{'resolver':<10}{'resolves/s':>14}{'p50 us':>12}{'p99 us':>12}")
+    for r in results:
+        print(f"{r['resolver']:<10}{r['resolves_per_sec']:>14.0f}{r['p50_us']:>12.1f}{r['p99_us']:>12.1f}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
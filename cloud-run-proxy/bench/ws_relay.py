@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+WebSocket中継のベンチマーク（ローカルのみ、GCP不要）
+- 従来の forward_to_client/forward_to_server ループと WebSocketRelay を比較
+- エコーサーバー ← 中継サーバー ← クライアント の構成で、スループットと往復レイテンシを計測
+
+使い方:
+    python bench/ws_relay.py --connections 20 --messages 2000 --size 256 --window 32
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+import aiohttp
+from aiohttp import web, WSMsgType
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import proxy  # noqa: E402
+
+
+async def echo_handler(request):
+    """エコーサーバー（Workstationの代わり）"""
+    ws = web.WebSocketResponse(max_msg_size=0)
+    await ws.prepare(request)
+    async for msg in ws:
+        if msg.type == WSMsgType.TEXT:
+            await ws.send_str(msg.data)
+        elif msg.type == WSMsgType.BINARY:
+            await ws.send_bytes(msg.data)
+    return ws
+
+
+async def legacy_relay(ws_server, ws_client):
+    """変更前の中継ループ（比較用）"""
+    async def forward_to_client():
+        async for msg in ws_client:
+            if msg.type == WSMsgType.TEXT:
+                await ws_server.send_str(msg.data)
+            elif msg.type == WSMsgType.BINARY:
+                await ws_server.send_bytes(msg.data)
+            else:
+                break
+
+    async def forward_to_server():
+        async for msg in ws_server:
+            if msg.type == WSMsgType.TEXT:
+                await ws_client.send_str(msg.data)
+            elif msg.type == WSMsgType.BINARY:
+                await ws_client.send_bytes(msg.data)
+            else:
+                break
+
+    done, pending = await asyncio.wait(
+        [asyncio.create_task(forward_to_client()), asyncio.create_task(forward_to_server())],
+        return_when=asyncio.FIRST_COMPLETED
+    )
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+
+def make_relay_handler(upstream_url: str, mode: str):
+    async def handler(request):
+        ws_server = web.WebSocketResponse(max_msg_size=proxy.WS_MAX_MSG_SIZE, compress=proxy.WS_COMPRESS)
+        await ws_server.prepare(request)
+        session = request.app['session']
+        async with session.ws_connect(
+            upstream_url,
+            max_msg_size=proxy.WS_MAX_MSG_SIZE,
+            compress=15 if proxy.WS_COMPRESS else 0,
+        ) as ws_client:
+            if mode == 'legacy':
+                await legacy_relay(ws_server, ws_client)
+            else:
+                await proxy.WebSocketRelay(ws_server, ws_client, 'bench').run()
+        if not ws_server.closed:
+            await ws_server.close()
+        return ws_server
+    return handler
+
+
+async def start_site(app, port):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', port)
+    await site.start()
+    return runner
+
+
+async def run_client(url, messages, size, window, latencies):
+    """1接続: window 個まで投げっぱなしにして往復時間を計測"""
+    payload = b'x' * size
+    async with aiohttp.ClientSession() as session:
+        async with session.ws_connect(url, max_msg_size=0) as ws:
+            sent_at = []
+            received = 0
+            sent = 0
+            while received < messages:
+                while sent < messages and sent - received < window:
+                    sent_at.append(time.perf_counter())
+                    await ws.send_bytes(payload)
+                    sent += 1
+                msg = await ws.receive()
+                if msg.type != WSMsgType.BINARY:
+                    raise RuntimeError(f"unexpected message: {msg.type}")
+                latencies.append(time.perf_counter() - sent_at[received])
+                received += 1
+
+
+async def bench(mode, args):
+    latencies = []
+    url = f"http://127.0.0.1:{args.relay_port}/{mode}"
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        run_client(url, args.messages, args.size, args.window, latencies)
+        for _ in range(args.connections)
+    ])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    total = args.connections * args.messages
+    return {
+        "mode": mode,
+        "msgs_per_sec": total / elapsed,
+        "mb_per_sec": total * args.size * 2 / elapsed / 1e6,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--connections', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--window', type=int, default=32)
+    parser.add_argument('--upstream-port', type=int, default=18081)
+    parser.add_argument('--relay-port', type=int, default=18082)
+    args = parser.parse_args()
+
+    upstream = web.Application()
+    upstream.router.add_get('/', echo_handler)
+    upstream_runner = await start_site(upstream, args.upstream_port)
+
+    relay = web.Application()
+    upstream_url = f"http://127.0.0.1:{args.upstream_port}/"
+    relay.router.add_get('/legacy', make_relay_handler(upstream_url, 'legacy'))
+    relay.router.add_get('/relay', make_relay_handler(upstream_url, 'relay'))
+
+    async def session_ctx(app):
+        app['session'] = aiohttp.ClientSession()
+        yield
+        await app['session'].close()
+    relay.cleanup_ctx.append(session_ctx)
+    relay_runner = await start_site(relay, args.relay_port)
+
+    try:
+        print(f"{args.connections} connections x {args.messages} messages x {args.size} bytes, window {args.window}")
+        for mode in ('legacy', 'relay'):
+            r = await bench(mode, args)
+            print(f"{r['mode']:>7}: {r['msgs_per_sec']:10.0f} msg/s  {r['mb_per_sec']:7.1f} MB/s  "
+                  f"p50 {r['p50_ms']:6.2f}ms  p99 {r['p99_ms']:6.2f}ms")
+    finally:
+        await relay_runner.cleanup()
+        await upstream_runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
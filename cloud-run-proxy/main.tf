@@ -89,11 +89,57 @@ resource "google_cloud_run_v2_service" "proxy" {
         value = var.cluster_hostname
       }
 
+      env {
+        name  = "WORKSTATION_CONFIGS"
+        value = join(",", var.workstation_configs)
+      }
+
+      env {
+        name  = "SESSION_MODE"
+        value = var.session_mode
+      }
+
+      # 署名付きセッションCookieの鍵は Secret Manager から渡す（Terraformの変数・状態に値を置かない）
+      dynamic "env" {
+        for_each = var.session_secret_id != "" ? [1] : []
+        content {
+          name = "SESSION_SECRET"
+          value_source {
+            secret_key_ref {
+              secret  = var.session_secret_id
+              version = "latest"
+            }
+          }
+        }
+      }
+
+      env {
+        name  = "WORKERS"
+        value = var.workers
+      }
+
+      env {
+        name  = "AUTOSTART_ENABLED"
+        value = var.autostart ? "true" : "false"
+      }
+
       resources {
         limits = {
-          cpu    = "1"
+          cpu    = var.cpu
           memory = "512Mi"
         }
+        # 起動中（import・トークン取得）だけCPUを増やす
+        startup_cpu_boost = true
+      }
+
+      # GCPトークンの取得が終わるまでトラフィックを流さない
+      startup_probe {
+        http_get {
+          path = "/ready"
+        }
+        period_seconds    = 1
+        timeout_seconds   = 1
+        failure_threshold = 30
       }
     }
 
@@ -113,7 +159,28 @@ resource "google_cloud_run_v2_service" "proxy" {
     }
   }
 
-  depends_on = [null_resource.build_and_push]
+  lifecycle {
+    # cookieモード・ワーカーモード (WORKERS > 1) は SESSION_SECRET がないと起動しない
+    precondition {
+      condition     = var.session_secret_id != "" || (var.session_mode == "memory" && (var.workers == "1" || (var.workers == "auto" && var.cpu == "1")))
+      error_message = "session_secret_id is required when session_mode = \"cookie\" or the proxy runs more than one worker."
+    }
+  }
+
+  depends_on = [
+    null_resource.build_and_push,
+    google_secret_manager_secret_iam_member.session_secret,
+  ]
+}
+
+# Secret Manager: Cloud Run (default compute service account) can read the session secret
+resource "google_secret_manager_secret_iam_member" "session_secret" {
+  count = var.session_secret_id != "" ? 1 : 0
+
+  project   = var.project_id
+  secret_id = var.session_secret_id
+  role      = "roles/secretmanager.secretAccessor"
+  member    = "serviceAccount:${data.google_project.current.number}-compute@developer.gserviceaccount.com"
 }
 
 # IAM: Grant specific users access (Cloud Run invoker)
@@ -7,14 +7,40 @@ Cloud Run Proxy Server for Private Cloud Workstations
 - IAP認証前提
 """
 
+import time
+_boot_started = time.monotonic()  # 起動時間の計測用（他のimportより前）
+
 import os
+import re
+import json
+import bisect
+import hashlib
+import hmac
+import base64
+import html
 import asyncio
-import time
 import aiohttp
 from aiohttp import web, WSMsgType
+from aiohttp.abc import AbstractResolver
 import ssl
 import sys
+import socket
 import secrets
+import zlib
+import atexit
+import queue
+import random
+import threading
+import contextvars
+import traceback
+import signal
+import tempfile
+import io
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from multidict import CIMultiDict
+
+_import_finished = time.monotonic()
 
 # 標準出力をバッファリングしない
 sys.stdout.reconfigure(line_buffering=True)
@@ -28,30 +54,277 @@ CONFIG_NAME = os.environ.get('CONFIG_NAME', 'workstation-config')
 PORT = int(os.environ.get('PORT', '8080'))
 
 # メタデータサーバーURL
-METADATA_TOKEN_URL = "http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/token"
+METADATA_TOKEN_URL = os.environ.get(
+    'METADATA_TOKEN_URL',
+    "http://metadata.google.internal/computeMetadata/v1/instance/service-accounts/default/token"
+)
+
+# 接続先の上書き（ローカル検証・ベンチマーク用。通常は未設定）
+WORKSTATIONS_API_URL = os.environ.get('WORKSTATIONS_API_URL', 'https://workstations.googleapis.com')
+UPSTREAM_CONNECT_ADDRESS = os.environ.get('UPSTREAM_CONNECT_ADDRESS', '')  # "host:port" Workstationへの接続先を固定（Host/SNIはそのまま）
+UPSTREAM_CA_FILE = os.environ.get('UPSTREAM_CA_FILE', '')  # 追加で信頼するCA証明書（PEM）
+
+# 名前解決設定（Workstationホストはすべて同じPSCエンドポイントに解決される）
+RESOLVER_CACHE = os.environ.get('RESOLVER_CACHE', 'true').lower() == 'true'  # 解決結果をホストごとにキャッシュ
+RESOLVER_TTL = float(os.environ.get('RESOLVER_TTL', '300'))  # キャッシュの有効期間（秒）。期限切れ後は古い結果を返しつつ再解決
+RESOLVER_NEGATIVE_TTL = float(os.environ.get('RESOLVER_NEGATIVE_TTL', '5'))  # 解決失敗をキャッシュする秒数
+RESOLVER_STATIC_IP = os.environ.get('RESOLVER_STATIC_IP', '')  # *.CLUSTER_HOSTNAME を常にこのIP（PSCエンドポイント）に解決
+
+# コネクションプール設定
+UPSTREAM_POOL_LIMIT = int(os.environ.get('UPSTREAM_POOL_LIMIT', '100'))  # Workstationごとの最大同時接続数
+API_POOL_LIMIT = int(os.environ.get('API_POOL_LIMIT', '16'))  # googleapis/メタデータサーバー向けの最大同時接続数
+POOL_KEEPALIVE_TIMEOUT = float(os.environ.get('POOL_KEEPALIVE_TIMEOUT', '60'))  # アイドル接続を閉じるまでの秒数
+UPSTREAM_TIMEOUT = int(os.environ.get('UPSTREAM_TIMEOUT', '3600'))  # Workstationへのリクエスト全体のタイムアウト
+
+# ストリーミング設定
+STREAM_BUFFER_THRESHOLD = int(os.environ.get('STREAM_BUFFER_THRESHOLD', str(256 * 1024)))  # これ以下のボディはバッファリング
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', str(64 * 1024)))  # ストリーミング時の最大チャンクサイズ
+
+# 受付制御（1人のダウンロードや大量の取得で他のWorkstationが待たされないようにする）
+# キーは Workstation名 + IAPユーザー（X-Goog-Authenticated-User-Email があれば）
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', 'true').lower() == 'true'
+ADMISSION_MAX_ACTIVE = int(os.environ.get('ADMISSION_MAX_ACTIVE', '256'))  # インスタンス全体の同時HTTPリクエスト数
+ADMISSION_PER_KEY = int(os.environ.get('ADMISSION_PER_KEY', '32'))  # キーごとの同時HTTPリクエスト数
+ADMISSION_QUEUE_PER_KEY = int(os.environ.get('ADMISSION_QUEUE_PER_KEY', '128'))  # キーごとの待ち行列の上限（超えたら即503）
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', '10'))  # 待ち行列で待つ最大秒数（超えたら503）
+ADMISSION_MAX_WEBSOCKETS = int(os.environ.get('ADMISSION_MAX_WEBSOCKETS', '1000'))  # インスタンス全体の同時WebSocket数
+ADMISSION_WEBSOCKETS_PER_KEY = int(os.environ.get('ADMISSION_WEBSOCKETS_PER_KEY', '64'))  # キーごとの同時WebSocket数
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', '2'))  # 503の Retry-After（秒）
+BANDWIDTH_LIMIT = int(os.environ.get('BANDWIDTH_LIMIT', '0'))  # ストリーミング送信の合計帯域（バイト/秒）。0で無制限。転送中のキーで均等に分ける
+
+# メモリ予算（コンテナのメモリ上限に達してインスタンスごとWebSocketが切れる前に、新規の受け付けを絞る）
+# 使用量はバッファ・キュー・キャッシュの推定値（プロセスのRSSではない）
+MEMORY_BUDGET = os.environ.get('MEMORY_BUDGET', 'auto')  # 推定使用量の上限（バイト）。"auto" ならコンテナのメモリ上限の半分をワーカー数で割った値、0で無制限
+MEMORY_SHED_RATIO = float(os.environ.get('MEMORY_SHED_RATIO', '0.8'))  # 予算のこの割合を超えたら大きな転送を断る（予算を超えたらすべての新規リクエスト）
+MEMORY_LARGE_TRANSFER = int(os.environ.get('MEMORY_LARGE_TRANSFER', str(1024 * 1024)))  # これより大きいボディ（Content-Length）を大きな転送とする
+MEMORY_CHECK_INTERVAL = float(os.environ.get('MEMORY_CHECK_INTERVAL', '5'))  # 使用量の確認とアイドル接続の回収の間隔（秒）
+WS_IDLE_TIMEOUT = float(os.environ.get('WS_IDLE_TIMEOUT', '3600'))  # どちらの方向にもメッセージがないWebSocketを閉じるまでの秒数（0で無効）
+UPSTREAM_IDLE_TIMEOUT = float(os.environ.get('UPSTREAM_IDLE_TIMEOUT', '900'))  # 使われていないWorkstationのクライアント（接続プール）を破棄するまでの秒数（0で無効）
+MEMORY_GOVERNOR_KEY = web.AppKey('memory_governor', asyncio.Task)
+
+# 起動設定（min_instance_count = 0 からのスケールアウト時間を短くする）
+STARTUP_PREFETCH_TOKEN = os.environ.get('STARTUP_PREFETCH_TOKEN', 'true').lower() == 'true'  # 起動直後にGCPトークンを取得（完了まで /ready は 503）
+_startup = {"bound": None, "ready": None}  # 各段階の time.monotonic()
+STARTUP_KEY = web.AppKey('startup', asyncio.Task)
+
+# ワーカーモード設定
+WORKERS = os.environ.get('WORKERS', '1')  # ワーカープロセス数（"auto" ならコンテナで使えるCPU数）
+WORKER_SHUTDOWN_TIMEOUT = float(os.environ.get('WORKER_SHUTDOWN_TIMEOUT', '9'))  # 終了時にワーカーを待つ秒数（Cloud Run は SIGTERM の10秒後に強制終了）
+WORKER_ID = os.environ.get('WORKER_ID', '')  # スーパーバイザーが設定（ワーカー番号）
+TOKEN_BROKER_SOCKET = os.environ.get('TOKEN_BROKER_SOCKET', '')  # スーパーバイザーが設定（トークン共有用のUnixソケット）
+
+# ログ設定
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower()  # json: Cloud Logging の構造化ログ, text: 1行テキスト
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()  # 全体のログレベル
+LOG_LEVELS = os.environ.get('LOG_LEVELS', '')  # カテゴリごとのログレベル（例: "access=WARNING,websocket=DEBUG"）
+LOG_ACCESS_SAMPLE = float(os.environ.get('LOG_ACCESS_SAMPLE', '1.0'))  # アクセスログを記録する割合（5xxは常に記録）
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))  # 書き込み待ちの上限（超えた分は破棄して件数のみ記録）
+
+# メトリクス設定
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_MAX_WORKSTATIONS = int(os.environ.get('METRICS_MAX_WORKSTATIONS', '100'))  # workstationラベルの種類の上限
+
+# リクエストの段階ごとの計測（トークン取得・名前解決・接続・TTFB・転送）
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'false').lower() == 'true'  # レスポンスに Server-Timing ヘッダーを付ける
+TRACE_SPANS_FILE = os.environ.get('TRACE_SPANS_FILE', '')  # スパンをOTLP/JSONで追記するファイル
+TRACE_OTLP_ENDPOINT = os.environ.get('TRACE_OTLP_ENDPOINT', '')  # スパンを送るOTLP/HTTPのURL（例: http://localhost:4318/v1/traces）
+TRACE_SAMPLE = float(os.environ.get('TRACE_SAMPLE', '1.0'))  # 受信したトレースコンテキストがないリクエストを記録する割合
+TRACE_EXPORT_INTERVAL = float(os.environ.get('TRACE_EXPORT_INTERVAL', '5'))  # スパンをまとめて出力する間隔（秒）
+TRACE_QUEUE_SIZE = int(os.environ.get('TRACE_QUEUE_SIZE', '10000'))  # 出力待ちスパンの上限（超えた分は破棄）
+TRACE_SERVICE_NAME = os.environ.get('TRACE_SERVICE_NAME', os.environ.get('K_SERVICE', 'cloud-run-proxy'))
+TRACE_EXPORT_ENABLED = bool(TRACE_SPANS_FILE or TRACE_OTLP_ENDPOINT)
+TIMING_ENABLED = SERVER_TIMING or TRACE_EXPORT_ENABLED
+
+# トラフィックの記録（bench/replay.py で再生して性能を比較する用。ボディ・ヘッダー・クエリ・Cookieは記録しない）
+CAPTURE_FILE = os.environ.get('CAPTURE_FILE', '')  # 記録先（JSON Linesで追記）。空なら記録しない
+CAPTURE_SAMPLE = float(os.environ.get('CAPTURE_SAMPLE', '1.0'))  # 記録するWorkstationの割合（Workstation単位で選ぶ）
+CAPTURE_MAX_BYTES = int(os.environ.get('CAPTURE_MAX_BYTES', str(256 * 1024 * 1024)))  # ファイルがこのサイズを超えたら記録を止める
+CAPTURE_WS_FRAMES = int(os.environ.get('CAPTURE_WS_FRAMES', '10000'))  # WebSocket接続ごとに記録するフレーム数の上限
+CAPTURE_ENABLED = bool(CAPTURE_FILE)
+
+# イベントループの監視とプロファイル（同期処理でループが止まると、全員のIDE・ターミナルが同時に止まる）
+LOOP_LAG_INTERVAL = float(os.environ.get('LOOP_LAG_INTERVAL', '0.1'))  # ループの遅れを測る間隔（秒）。0で無効
+LOOP_BLOCK_THRESHOLD = float(os.environ.get('LOOP_BLOCK_THRESHOLD', '0.25'))  # これ以上ループが止まったらスタックをログに出す（秒）
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')  # /debug/profile・/debug/memory に必要なトークン（X-Debug-Token ヘッダー）。空なら無効
+PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', '60'))  # 1回のプロファイルの最大秒数
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', '0.005'))  # スタックを採取する間隔（秒）
+
+# WebSocket中継設定
+WS_MAX_MSG_SIZE = int(os.environ.get('WS_MAX_MSG_SIZE', str(16 * 1024 * 1024)))  # 1フレームの最大サイズ
+WS_COMPRESS = os.environ.get('WS_COMPRESS', 'true').lower() == 'true'  # permessage-deflateを両側でネゴシエート
+WS_QUEUE_FRAMES = int(os.environ.get('WS_QUEUE_FRAMES', '256'))  # 方向ごとのキューの最大フレーム数
+WS_QUEUE_BYTES = int(os.environ.get('WS_QUEUE_BYTES', str(4 * 1024 * 1024)))  # 方向ごとのキューの最大バイト数
+WS_HEARTBEAT = float(os.environ.get('WS_HEARTBEAT', '30'))  # Workstation側のping間隔（秒）
+
+# WebSocketの寿命（Cloud Run の timeout（3600秒）でまとめて切られて一斉に再接続されるのを避ける）
+WS_MAX_AGE = float(os.environ.get('WS_MAX_AGE', '3300'))  # WebSocketの最大寿命（秒、0で無効）。Cloud Run の timeout より短くする
+WS_MAX_AGE_JITTER = float(os.environ.get('WS_MAX_AGE_JITTER', '0.25'))  # 寿命を接続ごとに最大この割合だけ短くする（0〜1）
+WS_HANDSHAKE_RATE = float(os.environ.get('WS_HANDSHAKE_RATE', '2'))  # WorkstationごとのWebSocketハンドシェイクの上限（回/秒、0で無制限）
+WS_HANDSHAKE_BURST = int(os.environ.get('WS_HANDSHAKE_BURST', '10'))  # 上記の一時的な超過の許容回数
+WS_HANDSHAKE_MAX_WAIT = float(os.environ.get('WS_HANDSHAKE_MAX_WAIT', '10'))  # 上限を超えたハンドシェイクを待たせる最大秒数（超えたら503）
+WS_DRAIN_PERIOD = float(os.environ.get('WS_DRAIN_PERIOD', '6'))  # 終了時（SIGTERM）にWebSocketを少しずつ閉じる期間（秒）。Cloud Run は10秒後に強制終了
+
+# レスポンス圧縮設定（上流が無圧縮で返したレスポンスのみ対象、圧縮済みはそのまま転送）
+RESPONSE_COMPRESSION = os.environ.get('RESPONSE_COMPRESSION', 'true').lower() == 'true'
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', '1024'))  # これ未満のボディは圧縮しない
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', '6'))  # gzipの圧縮レベル
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', '5'))  # brotliの品質 (0-11)
+COMPRESSION_THREADS = int(os.environ.get('COMPRESSION_THREADS', '2'))  # 圧縮用スレッド数
+COMPRESSIBLE_TYPES = (
+    'text/', 'application/javascript', 'application/json', 'application/xml',
+    'application/wasm', 'image/svg+xml', 'application/manifest+json',
+)
+_compression_executor = None
+
+# 静的リソースキャッシュ設定
+# /stable-<commit>/static/... はイメージ（=Config）が同じなら内容も同じなので、Workstation間で共有する
+RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', 'true').lower() == 'true'
+CACHE_PATH_PATTERN = re.compile(os.environ.get('CACHE_PATH_PATTERN', r'^/[a-z-]+-[0-9a-f]{7,}/static/'))
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', str(64 * 1024 * 1024)))  # メモリキャッシュの上限
+CACHE_MAX_ENTRY_BYTES = int(os.environ.get('CACHE_MAX_ENTRY_BYTES', str(8 * 1024 * 1024)))  # 1エントリの上限
+CACHE_DIR = os.environ.get('CACHE_DIR', '')  # 設定するとメモリから溢れたエントリをディスクに保存
+CACHE_DISK_MAX_BYTES = int(os.environ.get('CACHE_DISK_MAX_BYTES', str(256 * 1024 * 1024)))  # ディスクキャッシュの上限
+
+# Workstation状態キャッシュ・監視設定
+STATUS_CACHE_TTL = float(os.environ.get('STATUS_CACHE_TTL', '5'))  # 状態キャッシュの有効期間（秒）
+STATUS_POLL_FAST = float(os.environ.get('STATUS_POLL_FAST', '3'))  # STARTING/STOPPING中のポーリング間隔（秒）
+STATUS_POLL_SLOW = float(os.environ.get('STATUS_POLL_SLOW', '30'))  # 安定状態のポーリング間隔（秒）
+STATUS_EVENTS_HEARTBEAT = float(os.environ.get('STATUS_EVENTS_HEARTBEAT', '15'))  # SSEのキープアライブ間隔（秒）
+STATUS_LIST_TTL = float(os.environ.get('STATUS_LIST_TTL', '5'))  # Workstation一覧のキャッシュ有効期間（秒）
+STATUS_LIST_PAGE_SIZE = int(os.environ.get('STATUS_LIST_PAGE_SIZE', '100'))  # 一覧取得の1ページの件数
+BATCH_MAX = int(os.environ.get('BATCH_MAX', '50'))  # 一括開始/停止の最大件数
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '4'))  # 一括開始/停止の同時API呼び出し数
+BATCH_RATE = float(os.environ.get('BATCH_RATE', '5'))  # 一括開始/停止のAPI呼び出し回数の上限（回/秒、インスタンス全体）
+
+# Workstationの登録簿（名前 → Cluster・Config・ホスト名・最後に分かった状態。複数のConfigにまたがってルーティング）
+# WORKSTATION_CONFIGS: "cluster/config@hostname" のカンマ区切り（リージョンが違う場合は "region/cluster/config@hostname"）
+# 未設定なら CLUSTER_NAME / CONFIG_NAME / CLUSTER_HOSTNAME の1つ。同じ名前が複数のConfigにあれば先に書いたものを使う
+WORKSTATION_CONFIGS = os.environ.get('WORKSTATION_CONFIGS', '')
+REGISTRY_ENABLED = os.environ.get('REGISTRY_ENABLED', 'true').lower() == 'true'  # false: 登録簿にない名前は先頭のConfigとして扱う（従来どおり）
+REGISTRY_REFRESH_INTERVAL = float(os.environ.get('REGISTRY_REFRESH_INTERVAL', '60'))  # 一覧（list）で登録簿を更新する間隔（秒）
+REGISTRY_NEGATIVE_TTL = float(os.environ.get('REGISTRY_NEGATIVE_TTL', '30'))  # 見つからなかった名前を問い合わせずに404にする秒数
+REGISTRY_MISS_RATE = float(os.environ.get('REGISTRY_MISS_RATE', '5'))  # 登録簿にない名前の問い合わせ（get）の上限（回/秒）
+REGISTRY_MISS_BURST = int(os.environ.get('REGISTRY_MISS_BURST', '20'))  # 上記の一時的な超過の許容回数（超えた分は503）
+REGISTRY_READY_TIMEOUT = float(os.environ.get('REGISTRY_READY_TIMEOUT', '10'))  # 起動時に最初の一覧を待つ最大秒数（/ready は待つ間 503）
+
+# 自動開始（停止中のWorkstationへの最初のリクエストで開始し、RUNNINGになるまで後続のリクエストを待たせる）
+AUTOSTART_ENABLED = os.environ.get('AUTOSTART_ENABLED', 'false').lower() == 'true'
+AUTOSTART_WAIT = float(os.environ.get('AUTOSTART_WAIT', '300'))  # RUNNINGになるのを待つ最大秒数（超えたら待っているリクエストに503）
+AUTOSTART_QUEUE = int(os.environ.get('AUTOSTART_QUEUE', '256'))  # Workstationごとに待たせるリクエスト数の上限（超えたら即503）
+AUTOSTART_TRUST = float(os.environ.get('AUTOSTART_TRUST', '30'))  # 上流が応答してからこの秒数は状態を確認せずに転送
+_autostarts = {}  # {workstation_name: AutoStart} 開始を待っているWorkstation
+_running_seen = {}  # {workstation_name: time.monotonic()} 上流が最後に応答した時刻
+_status_cache = {}  # {workstation_name: {"status": dict, "fetched": timestamp}}
+_workstation_list = {"workstations": [], "body": None, "etag": None, "fetched": 0}  # 一覧のキャッシュ（JSON本文とETag）
+_status_subscribers = {}  # {workstation_name: set(asyncio.Queue)}
+_status_watchers = {}  # {workstation_name: Task}
+_status_wakeups = {}  # {workstation_name: asyncio.Event} 開始/停止直後に監視を即時実行させる
+
+# ウォームアップ設定（RUNNINGを検知したら、初回アクセスの前にトークンと接続を準備）
+WARMUP_ENABLED = os.environ.get('WARMUP_ENABLED', 'true').lower() == 'true'
+WARMUP_CONNECTIONS = int(os.environ.get('WARMUP_CONNECTIONS', '4'))  # 事前に開く接続数
+WARMUP_PREFETCH = os.environ.get('WARMUP_PREFETCH', 'true').lower() == 'true'  # エントリーページを1回取得する
+WARMUP_PATH = os.environ.get('WARMUP_PATH', '/')  # エントリーページのパス
+WARMUP_MIN_INTERVAL = float(os.environ.get('WARMUP_MIN_INTERVAL', '300'))  # 同じWorkstationを再度ウォームアップしない期間（秒）
+_warmups = {}  # {workstation_name: {"started", "finished", "token_ms", "connect_ms", "used", ...}}
+_warmup_tasks = set()
 
 # トークンキャッシュ
 _gcp_token_cache = {"token": None, "expires": 0}
 _ws_token_cache = {}  # {workstation_name: {"token": ..., "expires": ...}}
+_ws_token_last_used = {}  # {workstation_name: timestamp} バックグラウンド更新の対象判定用
+_inflight = {}  # {key: Task} 同じキーの同時取得を1回にまとめる（トークン、レスポンスキャッシュ）
+TOKEN_REFRESHER_KEY = web.AppKey('token_refresher', asyncio.Task)
+
+# トークンのバックグラウンド更新設定
+TOKEN_REFRESH_INTERVAL = float(os.environ.get('TOKEN_REFRESH_INTERVAL', '60'))  # 更新チェック間隔（秒）
+TOKEN_REFRESH_AHEAD = float(os.environ.get('TOKEN_REFRESH_AHEAD', '600'))  # 期限のこの秒数前から先行更新（5分のマージンより前）
+TOKEN_IDLE_EVICT = float(os.environ.get('TOKEN_IDLE_EVICT', '1800'))  # この秒数使われていないトークンは破棄
+
+# アプリ全体で共有するクライアント（create_app の startup で作成、cleanup で破棄）
+_ssl_context = None
+_resolver = None  # 全クライアントセッションで共有する CachingResolver
+_api_session = None  # googleapis/メタデータサーバー用
+_broker_session = None  # ワーカーモード: スーパーバイザーのトークンブローカー用
+_ws_sessions = {}  # {workstation_host: ClientSession}
+_ws_sessions_used = {}  # {workstation_host: time.monotonic()} アイドルなクライアントの回収用
 
 # セッション管理（静的リソースルーティング用）
-_sessions = {}  # {session_id: {"expires": timestamp, "last_workstation": str}}
+# memory: サーバー側に保存（インスタンスごと）
+# cookie: last_workstation を HMAC 署名付きCookieに保存（サーバー側の状態なし、インスタンス間で共有可能）
+SESSION_MODE = os.environ.get('SESSION_MODE', 'memory').lower()
+SESSION_SECRET = os.environ.get('SESSION_SECRET', '')  # cookieモード・ワーカーモードでは必須（全インスタンス・全ワーカーで同じ値）
+SESSION_MAX_ENTRIES = int(os.environ.get('SESSION_MAX_ENTRIES', '10000'))  # memoryモードの最大セッション数
+_sessions = OrderedDict()  # {session_id: {"expires": timestamp, "last_workstation": str}} 作成順 = 期限順
 SESSION_DURATION = 86400  # 24時間
 
 
+def sign_session(ws_name: str, expires: int) -> str:
+    """last_workstation と有効期限を署名付きCookie値にする"""
+    payload = base64.urlsafe_b64encode(f"{expires}:{ws_name}".encode()).decode().rstrip('=')
+    signature = hmac.new(SESSION_SECRET.encode(), payload.encode(), hashlib.sha256).digest()
+    return f"{payload}.{base64.urlsafe_b64encode(signature).decode().rstrip('=')}"
+
+
+def verify_session(value: str) -> str:
+    """署名付きCookie値を検証して last_workstation を返す（不正・期限切れは None）"""
+    payload, _, signature = value.partition('.')
+    expected = hmac.new(SESSION_SECRET.encode(), payload.encode(), hashlib.sha256).digest()
+    expected = base64.urlsafe_b64encode(expected).decode().rstrip('=')
+    if not signature or not hmac.compare_digest(signature, expected):
+        return None
+    try:
+        expires, _, ws_name = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)).decode().partition(':')
+        if int(expires) < time.time():
+            return None
+    except ValueError:
+        return None
+    return ws_name or None
+
+
+def evict_sessions():
+    """期限切れセッションと上限超過分を古い順に削除"""
+    now = time.time()
+    while _sessions:
+        session_id, session = next(iter(_sessions.items()))
+        if session["expires"] > now and len(_sessions) <= SESSION_MAX_ENTRIES:
+            break
+        del _sessions[session_id]
+
+
 def get_last_workstation(request) -> str:
     """セッションから最後にアクセスしたWorkstation名を取得"""
     session_id = request.cookies.get('session')
-    if session_id and session_id in _sessions:
-        return _sessions[session_id].get('last_workstation')
+    if not session_id:
+        return None
+    if SESSION_MODE == 'cookie':
+        return verify_session(session_id)
+    session = _sessions.get(session_id)
+    if session and session["expires"] > time.time():
+        return session.get('last_workstation')
     return None
 
 
 def set_last_workstation(request, ws_name: str):
-    """セッションに最後にアクセスしたWorkstation名を保存"""
+    """
+    セッションに最後にアクセスしたWorkstation名を保存
+    セッションはここで初めて作成する（ヘルスチェック等、Workstationにアクセスしないリクエストでは作らない）
+    """
+    if get_last_workstation(request) == ws_name:
+        return
+    if SESSION_MODE == 'cookie':
+        request['session_cookie'] = sign_session(ws_name, int(time.time()) + SESSION_DURATION)
+        return
+
     session_id = request.cookies.get('session')
-    if session_id and session_id in _sessions:
-        _sessions[session_id]['last_workstation'] = ws_name
+    session = _sessions.get(session_id) if session_id else None
+    if session is None:
+        evict_sessions()
+        session_id = secrets.token_urlsafe(32)
+        session = {"expires": time.time() + SESSION_DURATION}
+        _sessions[session_id] = session
+        request['session_cookie'] = session_id
+    session['last_workstation'] = ws_name
 
 # ステータスページHTML（CSSの {} は {{}} にエスケープ）
 STATUS_HTML = """<!DOCTYPE html>
@@ -59,7 +332,7 @@ STATUS_HTML = """<!DOCTYPE html>
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <meta http-equiv="refresh" content="15">
+    <noscript><meta http-equiv="refresh" content="15"></noscript>
     <title>Workstation Status</title>
     <style>
         body {{ font-family: sans-serif; display: flex; justify-content: center; align-items: center; height: 100vh; margin: 0; background: #f5f5f5; }}
@@ -93,25 +366,340 @@ STATUS_HTML = """<!DOCTYPE html>
         </div>
         <div class="info">
             <div class="label">State</div>
-            <div class="value {state_class}">{state}</div>
+            <div class="value {state_class}" id="state">{state}</div>
         </div>
         <div class="info">
             <div class="label">Host</div>
             <div class="value" style="font-size: 0.9rem;">{host}</div>
         </div>
+        <div id="error">{error}</div>
+        <div id="message">{message}</div>
+        <div id="button">{button}</div>
+        <div id="open-link">{open_link}</div>
+    </div>
+    <script>
+        // 状態変化をServer-Sent Eventsで受け取り、ページを再読み込みせずに更新
+        if (window.EventSource) {{
+            const events = new EventSource(location.pathname.replace(/[/]$/, '') + '/events');
+            events.addEventListener('status', (e) => {{
+                const parts = JSON.parse(e.data);
+                const state = document.getElementById('state');
+                if (state.textContent !== parts.state) {{
+                    document.getElementById('message').innerHTML = '';
+                }}
+                state.textContent = parts.state;
+                state.className = 'value ' + parts.state_class;
+                document.getElementById('error').innerHTML = parts.error;
+                document.getElementById('button').innerHTML = parts.button;
+                document.getElementById('open-link').innerHTML = parts.open_link;
+            }});
+        }}
+    </script>
+</body>
+</html>
+"""
+
+
+# 自動開始を待つ間にブラウザへ返すページ（状態はSSEで受け取り、RUNNINGになったら再読み込み）
+AUTOSTART_HTML = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <noscript><meta http-equiv="refresh" content="10"></noscript>
+    <title>Starting {workstation}</title>
+    <style>
+        body {{ font-family: sans-serif; display: flex; justify-content: center; align-items: center; height: 100vh; margin: 0; background: #f5f5f5; }}
+        .status-box {{ background: white; padding: 2rem; border-radius: 8px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); min-width: 300px; }}
+        h1 {{ margin-top: 0; font-size: 1.5rem; }}
+        .state {{ color: #fbbc04; font-weight: bold; }}
+        .note {{ color: #666; font-size: 0.9rem; }}
+        a {{ color: #4285f4; text-decoration: none; }}
+        a:hover {{ text-decoration: underline; }}
+    </style>
+</head>
+<body data-events="{events_url}">
+    <div class="status-box">
+        <h1>Starting workstation</h1>
+        <p><b>{workstation}</b>: <span class="state" id="state">{state}</span></p>
+        <p class="note">This page reloads automatically when the workstation is running.</p>
+        <p class="note"><a href="{status_url}">Status page</a></p>
+    </div>
+    <script>
+        if (window.EventSource) {{
+            const events = new EventSource(document.body.dataset.events);
+            events.addEventListener('status', (e) => {{
+                const parts = JSON.parse(e.data);
+                document.getElementById('state').textContent = parts.state;
+                if (parts.state === 'STATE_RUNNING') {{
+                    events.close();
+                    location.reload();
+                }}
+            }});
+        }}
+    </script>
+</body>
+</html>
+"""
+
+
+STATUS_INDEX_HTML = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <noscript><meta http-equiv="refresh" content="15"></noscript>
+    <title>Workstations</title>
+    <style>
+        body {{ font-family: sans-serif; display: flex; justify-content: center; margin: 0; padding: 2rem 0; background: #f5f5f5; }}
+        .status-box {{ background: white; padding: 2rem; border-radius: 8px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); min-width: 500px; }}
+        h1 {{ margin-top: 0; font-size: 1.5rem; }}
+        .label {{ color: #666; font-size: 0.9rem; }}
+        table {{ border-collapse: collapse; width: 100%; margin: 1rem 0; }}
+        th, td {{ text-align: left; padding: 0.5rem; border-bottom: 1px solid #eee; }}
+        th {{ color: #666; font-size: 0.9rem; font-weight: normal; }}
+        .state-running {{ color: #34a853; font-weight: bold; }}
+        .state-stopped {{ color: #ea4335; font-weight: bold; }}
+        .state-starting, .state-stopping {{ color: #fbbc04; font-weight: bold; }}
+        .state-other {{ color: #666; font-weight: bold; }}
+        button {{ padding: 0.75rem 1.5rem; border: none; border-radius: 4px; cursor: pointer; font-size: 1rem; margin-right: 0.5rem; }}
+        .btn-start {{ background: #34a853; color: white; }}
+        .btn-start:hover {{ background: #2d8f47; }}
+        .btn-stop {{ background: #ea4335; color: white; }}
+        .btn-stop:hover {{ background: #d33426; }}
+        .error {{ color: red; font-size: 0.9rem; margin-top: 1rem; }}
+        .message {{ color: #34a853; font-size: 0.9rem; margin-top: 1rem; }}
+        a {{ color: #4285f4; text-decoration: none; }}
+        a:hover {{ text-decoration: underline; }}
+    </style>
+</head>
+<body>
+    <div class="status-box">
+        <h1>Workstations</h1>
+        <div class="label">{cluster} / {config}</div>
         {error}
         {message}
-        {button}
-        {open_link}
+        <form method="POST">
+            <table>
+                <tr><th></th><th>Name</th><th>State</th><th></th></tr>
+                {rows}
+            </table>
+            <button type="submit" name="action" value="start" class="btn-start">Start selected</button>
+            <button type="submit" name="action" value="stop" class="btn-stop">Stop selected</button>
+        </form>
     </div>
+    <script>
+        function stateClass(state) {{
+            if (state === 'STATE_RUNNING') return 'state-running';
+            if (state === 'STATE_STOPPED') return 'state-stopped';
+            if (state === 'STATE_STARTING' || state === 'STATE_STOPPING') return 'state-starting';
+            return 'state-other';
+        }}
+        // 一覧APIを定期的に取得して状態列を更新（変化がなければ 304）
+        async function refresh() {{
+            try {{
+                const resp = await fetch('/api/workstations', {{cache: 'no-cache'}});
+                if (!resp.ok) return;
+                for (const ws of (await resp.json()).workstations) {{
+                    const state = document.getElementById('state-' + ws.workstation);
+                    if (!state || state.textContent === ws.state) continue;
+                    state.textContent = ws.state;
+                    state.className = stateClass(ws.state);
+                    document.getElementById('open-' + ws.workstation).hidden = ws.state !== 'STATE_RUNNING';
+                }}
+            }} catch (e) {{}}
+        }}
+        setInterval(refresh, {refresh_ms});
+    </script>
 </body>
 </html>
 """
 
+STATUS_INDEX_ROW = """<tr>
+                    <td><input type="checkbox" name="name" value="{workstation}"></td>
+                    <td><a href="/status/{workstation}">{workstation}</a></td>
+                    <td id="state-{workstation}" class="{state_class}">{state}</td>
+                    <td><a id="open-{workstation}" href="/ws/{workstation}/"{hidden}>Open</a></td>
+                </tr>"""
+
+
+LOG_SEVERITIES = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+LOG_ACCESS_SKIP = ('/health', '/ready', '/metrics')  # アクセスログを出さないパス（ヘルスチェック・収集）
+_log_default_level = LOG_SEVERITIES.get(LOG_LEVEL, 20)
+_log_levels = {
+    category.strip(): LOG_SEVERITIES.get(level.strip().upper(), _log_default_level)
+    for category, _, level in (item.partition('=') for item in LOG_LEVELS.split(',') if '=' in item)
+}
+_request_id = contextvars.ContextVar('request_id', default=None)
+_request_timing = contextvars.ContextVar('request_timing', default=None)  # 処理中のリクエストの RequestTiming
+
+
+class LogWriter:
+    """
+    ログレコードをキュー経由でバックグラウンドスレッドから書き込む
+    イベントループ側はキューに入れるだけで、整形・書き込みは行わない
+    キューが満杯のときは破棄し、破棄した件数をカテゴリごとにまとめて出力する
+    """
+
+    BATCH = 256
+
+    def __init__(self, stream, maxsize: int, fmt: str):
+        self.stream = stream
+        self.fmt = fmt
+        self.queue = queue.Queue(maxsize)
+        self.dropped = {}  # {category: 件数}
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, record: dict):
+        if self.thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock:
+                self.dropped[record["category"]] = self.dropped.get(record["category"], 0) + 1
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+
+    def close(self, timeout: float = 2.0):
+        """残りを書き出して終了（プロセス終了時）"""
+        if self.thread is None or not self.thread.is_alive():
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            with self.lock:
+                dropped, self.dropped = self.dropped, {}
+            if dropped:
+                batch.append({
+                    "time": time.time(), "severity": "WARNING", "category": "log",
+                    "message": f"Dropped {sum(dropped.values())} log record(s) under pressure",
+                    "dropped": dropped,
+                })
+            lines = [self.format(record) for record in batch if record is not None]
+            try:
+                self.stream.write(''.join(lines))
+                self.stream.flush()
+            except (OSError, ValueError):
+                pass
+            if None in batch:
+                return
+
+    def format(self, record: dict) -> str:
+        record = dict(record)
+        timestamp = record.pop("time")
+        severity = record.pop("severity")
+        message = record.pop("message")
+        category = record.pop("category")
+        if self.fmt == 'text':
+            record.pop("httpRequest", None)
+            stack_trace = record.pop("stack_trace", None)
+            extra = ''.join(f" {k}={v}" for k, v in record.items())
+            if stack_trace:
+                extra += "\n" + stack_trace.rstrip()
+            return f"[{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))}] {message}{extra}\n"
+
+        entry = {
+            "severity": severity,
+            "message": message,
+            "time": time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)) + f".{int(timestamp % 1 * 1e6):06d}Z",
+            "logging.googleapis.com/labels": {"category": category},
+        }
+        trace = record.pop("trace", None)
+        if trace:
+            entry["logging.googleapis.com/trace"] = f"projects/{PROJECT_ID}/traces/{trace}"
+        entry.update(record)
+        return json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+
+
+_log_writer = LogWriter(sys.stdout, LOG_QUEUE_SIZE, LOG_FORMAT)
+
+
+def log_enabled(category: str, level: str) -> bool:
+    return LOG_SEVERITIES[level] >= _log_levels.get(category, _log_default_level)
+
+
+def log(msg, category: str = 'app', level: str = 'INFO', **fields):
+    """
+    ログ出力（書き込みはバックグラウンドスレッドで行い、イベントループをブロックしない）
+    fields は構造化ログのフィールドとしてそのまま出力する
+    """
+    if not log_enabled(category, level):
+        return
+    record = {"time": time.time(), "severity": level, "category": category, "message": msg}
+    request_id = _request_id.get()
+    if request_id is not None:
+        record["request_id"] = request_id
+    if WORKER_ID:
+        record["worker"] = WORKER_ID
+    record.update((k, v) for k, v in fields.items() if v is not None)
+    _log_writer.submit(record)
+
 
-def log(msg):
-    """ログ出力"""
-    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {msg}", flush=True)
+@web.middleware
+async def access_log_middleware(request, handler):
+    """リクエストIDの割り当てとアクセスログ（終了時に1行、ステータスと所要時間付き）"""
+    trace = request.headers.get('X-Cloud-Trace-Context', '').split('/', 1)[0]
+    token = _request_id.set(request.headers.get('X-Request-Id') or trace or secrets.token_hex(8))
+    start = time.monotonic()
+    status = 500
+    response = None
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        if request.path not in LOG_ACCESS_SKIP and (
+            status >= 500 or LOG_ACCESS_SAMPLE >= 1 or random.random() < LOG_ACCESS_SAMPLE
+        ):
+            duration = time.monotonic() - start
+            # ストリーミング済みなら送信済みバイト数、それ以外はこれから送るボディのサイズ
+            if response is None:
+                size = 0
+            elif response.prepared:
+                size = response.body_length
+            else:
+                size = response.content_length or 0
+            log(
+                f"{request.method} {request.path} {status} {duration * 1000:.1f}ms",
+                category='access',
+                level='ERROR' if status >= 500 else 'INFO',
+                workstation=request.get('workstation'),
+                status=status,
+                duration_ms=round(duration * 1000, 1),
+                trace=trace or None,
+                httpRequest={
+                    "requestMethod": request.method,
+                    "requestUrl": request.path_qs,
+                    "status": status,
+                    "responseSize": str(size),
+                    "latency": f"{duration:.6f}s",
+                    "userAgent": request.headers.get('User-Agent', ''),
+                    "remoteIp": request.headers.get('X-Forwarded-For', request.remote or '').split(',')[0].strip(),
+                    "protocol": f"HTTP/{request.version.major}.{request.version.minor}",
+                },
+            )
+        _request_id.reset(token)
 
 
 def parse_workstation_path(path: str) -> tuple:
@@ -128,292 +716,3089 @@ def parse_workstation_path(path: str) -> tuple:
     return None, path
 
 
-async def get_gcp_access_token() -> str:
-    """メタデータサーバーからGCPアクセストークンを取得"""
-    global _gcp_token_cache
+class Metric:
+    """
+    Prometheus形式のメトリクス（依存ライブラリなし、dictの加算のみ）
+    ラベル値はタプルで渡す
+    """
 
-    # キャッシュが有効なら返す
-    if _gcp_token_cache["token"] and time.time() < _gcp_token_cache["expires"] - 60:
-        return _gcp_token_cache["token"]
+    def __init__(self, name: str, help_text: str, kind: str, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.labelnames = labelnames
+        self.values = {}  # {label_values: float}
+        _metrics.append(self)
 
-    headers = {"Metadata-Flavor": "Google"}
-    async with aiohttp.ClientSession() as session:
-        async with session.get(METADATA_TOKEN_URL, headers=headers) as resp:
-            if resp.status == 200:
-                data = await resp.json()
-                _gcp_token_cache["token"] = data["access_token"]
-                _gcp_token_cache["expires"] = time.time() + data.get("expires_in", 3600)
-                return data["access_token"]
-            else:
-                raise Exception(f"Failed to get GCP token: {resp.status}")
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
 
+    def dec(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) - amount
 
-async def get_workstation_access_token(workstation_name: str) -> str:
-    """Workstation APIからアクセストークンを取得"""
-    global _ws_token_cache
+    def set(self, value, labels=()):
+        self.values[labels] = value
 
-    # Workstation名ごとにキャッシュをチェック（5分のマージン）
-    cache = _ws_token_cache.get(workstation_name, {"token": None, "expires": 0})
-    if cache["token"] and time.time() < cache["expires"] - 300:
-        return cache["token"]
+    def _labels(self, labels, extra=()) -> str:
+        pairs = list(zip(self.labelnames, labels)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{self._escape(v)}"' for k, v in pairs) + '}'
 
-    # GCPアクセストークン取得
-    gcp_token = await get_gcp_access_token()
+    @staticmethod
+    def _escape(value) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
 
-    # Workstation API呼び出し
-    api_url = (
-        f"https://workstations.googleapis.com/v1/projects/{PROJECT_ID}/"
-        f"locations/{REGION}/workstationClusters/{CLUSTER_NAME}/"
-        f"workstationConfigs/{CONFIG_NAME}/workstations/{workstation_name}:generateAccessToken"
-    )
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{self._labels(labels)} {value}")
+        return lines
 
-    headers = {
-        "Authorization": f"Bearer {gcp_token}",
-        "Content-Type": "application/json"
-    }
 
-    # 1時間後に期限切れ
-    expire_time = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 3600))
-    body = {"expireTime": expire_time}
+class Histogram(Metric):
+    """累積バケット付きヒストグラム（observeはbisect + 加算のみ）"""
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(api_url, headers=headers, json=body) as resp:
-            if resp.status == 200:
-                data = await resp.json()
-                _ws_token_cache[workstation_name] = {
-                    "token": data["accessToken"],
-                    "expires": time.time() + 3600
-                }
-                log(f"Got Workstation access token for '{workstation_name}', expires: {data.get('expireTime')}")
-                return data["accessToken"]
-            else:
-                error = await resp.text()
-                raise Exception(f"Failed to get Workstation token for '{workstation_name}': {resp.status} - {error}")
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
 
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, 'histogram', labelnames)
+        self.buckets = buckets
 
-async def get_workstation_status(workstation_name: str) -> dict:
-    """Workstation APIから状態を取得"""
-    # GCPアクセストークン取得
-    gcp_token = await get_gcp_access_token()
+    def observe(self, value: float, labels=()):
+        data = self.values.get(labels)
+        if data is None:
+            data = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        data[0][bisect.bisect_left(self.buckets, value)] += 1
+        data[1] += value
+        data[2] += 1
 
-    # Workstation API呼び出し
-    api_url = (
-        f"https://workstations.googleapis.com/v1/projects/{PROJECT_ID}/"
-        f"locations/{REGION}/workstationClusters/{CLUSTER_NAME}/"
-        f"workstationConfigs/{CONFIG_NAME}/workstations/{workstation_name}"
-    )
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{self.name}_count{self._labels(labels)} {count}")
+        return lines
 
-    headers = {
-        "Authorization": f"Bearer {gcp_token}",
-    }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(api_url, headers=headers) as resp:
-            if resp.status == 200:
-                data = await resp.json()
-                return {
-                    "workstation": workstation_name,
-                    "state": data.get("state", "UNKNOWN"),
-                    "host": f"{workstation_name}.{CLUSTER_HOSTNAME}"
-                }
-            elif resp.status == 404:
-                return {
-                    "workstation": workstation_name,
-                    "state": "NOT_FOUND",
-                    "error": "Workstation not found"
-                }
-            else:
-                error = await resp.text()
-                return {
-                    "workstation": workstation_name,
-                    "state": "ERROR",
-                    "error": f"API error: {resp.status} - {error}"
-                }
+_metrics = []
+_metric_workstations = set()
 
+PROXY_LATENCY = Histogram('proxy_request_duration_seconds',
+                          'End-to-end latency of proxied HTTP requests', ('workstation',))
+UPSTREAM_TTFB = Histogram('proxy_upstream_ttfb_seconds',
+                          'Time until upstream response headers were received', ('workstation',))
+API_LATENCY = Histogram('proxy_workstations_api_duration_seconds',
+                        'Latency of metadata server and Workstations API calls', ('call',))
+TOKEN_CACHE = Metric('proxy_token_cache_total', 'Token cache lookups and refreshes', 'counter', ('cache', 'result'))
+HTTP_BYTES = Metric('proxy_http_bytes_total', 'Bytes relayed over HTTP', 'counter', ('workstation', 'direction'))
+WS_BYTES = Metric('proxy_websocket_bytes_total', 'Bytes relayed over WebSocket', 'counter',
+                  ('workstation', 'direction'))
+WS_ACTIVE = Metric('proxy_websocket_active', 'Active WebSocket connections', 'gauge')
+WS_HANDSHAKES = Metric('proxy_websocket_handshakes_total',
+                       'WebSocket handshakes by rate limiter outcome (immediate/delayed/rejected)', 'counter',
+                       ('result',))
+WS_HANDSHAKE_DELAY = Histogram('proxy_websocket_handshake_delay_seconds',
+                               'Time WebSocket handshakes were held by the per-workstation rate limiter',
+                               buckets=(0.1, 0.25, 0.5, 1, 2, 3, 5, 7.5, 10))
+WS_RETIRED = Metric('proxy_websocket_retired_total', 'WebSockets closed by the proxy with 1012 so that clients reconnect',
+                    'counter', ('reason',))
+WS_LIFETIME = Histogram('proxy_websocket_lifetime_seconds', 'How long relayed WebSockets stayed open',
+                        buckets=(10, 60, 300, 900, 1800, 2400, 2700, 3000, 3300, 3600))
+SESSIONS = Metric('proxy_sessions', 'Entries in the server-side session store', 'gauge')
+RESPONSES = Metric('proxy_responses_total', 'Proxied responses by status code', 'counter', ('workstation', 'status'))
+DNS_RESOLVE = Metric('proxy_dns_resolve_total', 'Upstream hostname resolutions by source', 'counter', ('result',))
+DNS_LOOKUP = Histogram('proxy_dns_lookup_seconds', 'Time spent in getaddrinfo on cache misses and refreshes',
+                       ('result',), buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+STARTUP_SECONDS = Metric('proxy_startup_seconds',
+                         'Seconds from module load to each startup phase (process = since exec)', 'gauge', ('phase',))
+ADMISSION_WAIT = Histogram('proxy_admission_wait_seconds',
+                           'Time HTTP requests waited in the per-workstation admission queue', ('workstation',))
+ADMISSION_REJECTED = Metric('proxy_admission_rejected_total', 'Requests rejected with 503 by admission control',
+                            'counter', ('kind', 'reason'))
+ADMISSION_ACTIVE = Metric('proxy_admission_active', 'Admitted requests in flight', 'gauge', ('kind',))
+ADMISSION_QUEUED = Metric('proxy_admission_queued', 'Requests waiting for admission', 'gauge', ('kind',))
+BANDWIDTH_DELAY = Metric('proxy_bandwidth_delay_seconds_total',
+                         'Time streams were paused to keep within their bandwidth share', 'counter', ('workstation',))
+MEMORY_BYTES = Metric('proxy_memory_bytes', 'Estimated memory held by each subsystem', 'gauge', ('subsystem',))
+MEMORY_RSS = Metric('proxy_memory_rss_bytes', 'Resident set size of this process', 'gauge')
+MEMORY_SHED = Metric('proxy_memory_shed_total', 'Requests rejected with 503 to stay within the memory budget',
+                     'counter', ('kind', 'reason'))
+IDLE_REAPED = Metric('proxy_idle_reaped_total', 'Idle WebSockets and upstream clients closed by the reaper',
+                     'counter', ('kind',))
+WARMUPS = Metric('proxy_warmups_total', 'Workstation warm-ups by result', 'counter', ('result',))
+WARMUP_SAVED = Histogram('proxy_warmup_saved_seconds',
+                         'Estimated first-load time saved by warm-up (token + connection setup)')
+AUTOSTARTS = Metric('proxy_autostarts_total', 'Workstation starts triggered by requests', 'counter', ('result',))
+AUTOSTART_REQUESTS = Metric('proxy_autostart_requests_total',
+                            'Requests that found their workstation not running, by outcome', 'counter', ('outcome',))
+AUTOSTART_WAIT_SECONDS = Histogram('proxy_autostart_wait_seconds',
+                                   'Time requests waited for an auto-started workstation to become RUNNING',
+                                   buckets=(1, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300))
+REGISTRY_LOOKUPS = Metric('proxy_registry_lookups_total', 'Workstation registry lookups by result', 'counter',
+                          ('result',))
+REGISTRY_ENTRIES = Metric('proxy_registry_workstations', 'Workstations known to the registry', 'gauge', ('config',))
+LOOP_LAG = Histogram('proxy_event_loop_lag_seconds', 'Delay between scheduled and actual wake-up of the loop sampler',
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+LOOP_BLOCKED = Metric('proxy_event_loop_blocked_total',
+                      'Times the event loop was blocked longer than LOOP_BLOCK_THRESHOLD', 'counter')
 
-async def start_workstation(workstation_name: str) -> dict:
-    """Workstationを開始"""
-    gcp_token = await get_gcp_access_token()
 
-    api_url = (
-        f"https://workstations.googleapis.com/v1/projects/{PROJECT_ID}/"
-        f"locations/{REGION}/workstationClusters/{CLUSTER_NAME}/"
-        f"workstationConfigs/{CONFIG_NAME}/workstations/{workstation_name}:start"
-    )
+def workstation_label(ws_name: str) -> str:
+    """workstationラベルの値（種類が上限を超えたら 'other' にまとめる）"""
+    if ws_name in _metric_workstations:
+        return ws_name
+    if len(_metric_workstations) < METRICS_MAX_WORKSTATIONS:
+        _metric_workstations.add(ws_name)
+        return ws_name
+    return 'other'
 
-    headers = {
-        "Authorization": f"Bearer {gcp_token}",
-        "Content-Type": "application/json"
-    }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(api_url, headers=headers, json={}) as resp:
-            if resp.status == 200:
-                log(f"Workstation '{workstation_name}' start initiated")
-                return {"success": True}
-            elif resp.status == 409:
-                # 既に開始処理中 - 成功扱い
-                log(f"Workstation '{workstation_name}' already starting (409)")
-                return {"success": True}
-            else:
-                error = await resp.text()
-                log(f"Failed to start workstation '{workstation_name}': {resp.status} - {error}")
-                return {"success": False, "error": f"API error: {resp.status}"}
+class api_timer:
+    """
+    Workstations API / メタデータサーバー呼び出しの所要時間を計測
+    async with api_timer('get'), session.get(...) as resp: の形で使う
+    """
 
+    def __init__(self, call: str):
+        self.call = (call,)
 
-async def stop_workstation(workstation_name: str) -> dict:
-    """Workstationを停止"""
-    gcp_token = await get_gcp_access_token()
+    async def __aenter__(self):
+        self.start = time.monotonic()
+        return self
 
-    api_url = (
-        f"https://workstations.googleapis.com/v1/projects/{PROJECT_ID}/"
-        f"locations/{REGION}/workstationClusters/{CLUSTER_NAME}/"
-        f"workstationConfigs/{CONFIG_NAME}/workstations/{workstation_name}:stop"
-    )
+    async def __aexit__(self, *exc):
+        API_LATENCY.observe(time.monotonic() - self.start, self.call)
+        return False
 
-    headers = {
-        "Authorization": f"Bearer {gcp_token}",
-        "Content-Type": "application/json"
-    }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(api_url, headers=headers, json={}) as resp:
-            if resp.status == 200:
-                log(f"Workstation '{workstation_name}' stop initiated")
-                return {"success": True}
-            elif resp.status == 409:
-                # 既に停止処理中 - 成功扱い
-                log(f"Workstation '{workstation_name}' already stopping (409)")
-                return {"success": True}
-            else:
-                error = await resp.text()
-                log(f"Failed to stop workstation '{workstation_name}': {resp.status} - {error}")
-                return {"success": False, "error": f"API error: {resp.status}"}
+def render_metrics() -> str:
+    """全メトリクスをPrometheusテキスト形式で出力"""
+    SESSIONS.set(len(_sessions))
+    counts = dict.fromkeys((config.key for config in _registry.configs), 0)
+    for entry in _registry.entries.values():
+        counts[entry.config.key] += 1
+    for key, count in counts.items():
+        REGISTRY_ENTRIES.set(count, (key,))
+    _memory.update_metrics()
+    for controller in (_http_admission, _websocket_admission):
+        ADMISSION_ACTIVE.set(controller.active, (controller.kind,))
+        ADMISSION_QUEUED.set(controller.queued(), (controller.kind,))
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    # レスポンスキャッシュの統計
+    for key, value in _response_cache.summary().items():
+        lines.append(f"# TYPE proxy_response_cache_{key} {'gauge' if 'bytes' in key or 'entries' in key else 'counter'}")
+        lines.append(f"proxy_response_cache_{key} {value}")
+    return '\n'.join(lines) + '\n'
 
 
-async def handle_status(request):
-    """Workstationのステータスページを表示"""
-    ws_name = request.match_info.get('name')
-    if not ws_name:
-        return web.Response(status=400, text="Workstation name required")
+async def handle_metrics(request):
+    """Prometheusメトリクスエンドポイント"""
+    return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8',
+                        headers={'Cache-Control': 'no-store'})
 
-    message = ""
-    error_msg = ""
-    action_performed = None  # 実行したアクションを記録
 
-    # POST: 開始/停止アクション
-    if request.method == 'POST':
-        # まず現在の状態を取得
-        current_status = await get_workstation_status(ws_name)
-        current_state = current_status.get('state', 'UNKNOWN')
+@web.middleware
+async def metrics_middleware(request, handler):
+    """プロキシしたHTTPリクエストのレイテンシとステータスを記録（handle_requestが request['workstation'] を設定）"""
+    start = time.monotonic()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        ws_name = request.get('workstation')
+        if ws_name is not None and not request.get('websocket'):
+            label = (workstation_label(ws_name),)
+            PROXY_LATENCY.observe(time.monotonic() - start, label)
+            RESPONSES.inc((label[0], str(status)))
 
-        data = await request.post()
-        action = data.get('action')
 
-        # 遷移中（STARTING/STOPPING）の場合はアクションを無視
-        if current_state in ['STATE_STARTING', 'STATE_STOPPING']:
-            log(f"Ignoring action '{action}' - workstation is in transitional state: {current_state}")
-        # 状態と矛盾するアクションは無視（例: RUNNING中にstart）
-        elif action == 'start' and current_state == 'STATE_RUNNING':
-            log(f"Ignoring start action - workstation is already running")
-        elif action == 'stop' and current_state == 'STATE_STOPPED':
-            log(f"Ignoring stop action - workstation is already stopped")
-        elif action == 'start' and current_state == 'STATE_STOPPED':
-            result = await start_workstation(ws_name)
-            if result.get('success'):
-                action_performed = 'start'
-            else:
-                error_msg = f'<div class="error">Failed to start: {result.get("error", "Unknown error")}</div>'
-        elif action == 'stop' and current_state == 'STATE_RUNNING':
-            result = await stop_workstation(ws_name)
-            if result.get('success'):
-                action_performed = 'stop'
-            else:
-                error_msg = f'<div class="error">Failed to stop: {result.get("error", "Unknown error")}</div>'
+class RequestTiming:
+    """
+    1リクエストの段階ごとの所要時間（Server-Timing ヘッダーとトレーススパンの元データ）
+    時刻は time.monotonic() で記録し、スパンの出力時だけUNIX時刻に変換する
+    """
 
-    log(f"Status page for workstation: {ws_name}")
-    status = await get_workstation_status(ws_name)
+    def __init__(self, trace_id: str, parent_span_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.parent_span_id = parent_span_id  # 呼び出し元（Cloud Run のフロントエンド等）のスパン
+        self.span_id = secrets.token_hex(8)  # このリクエスト（サーバースパン）
+        self.upstream_span_id = secrets.token_hex(8)  # Workstationへのリクエスト（クライアントスパン）
+        self.sampled = sampled
+        self.start = time.monotonic()
+        self.wall_start = time.time_ns()
+        self.phases = []  # [(name, start, end, attributes)]
+        self.marks = {}  # {name: time.monotonic()} TraceConfigのフックが記録する時刻
 
-    state = status.get('state', 'UNKNOWN')
+    def add(self, name: str, start: float, end: float, **attributes):
+        self.phases.append((name, start, end, attributes))
 
-    # アクション実行後、状態に応じてメッセージを表示
-    # 既に目標状態に達している場合はメッセージを表示しない
-    if action_performed == 'start' and state != 'STATE_RUNNING':
-        message = '<div class="message">Starting workstation...</div>'
-    elif action_performed == 'stop' and state != 'STATE_STOPPED':
-        message = '<div class="message">Stopping workstation...</div>'
+    def traceparent(self) -> str:
+        """Workstationへ転送する W3C traceparent（親はクライアントスパン）"""
+        return f"00-{self.trace_id}-{self.upstream_span_id}-{'01' if self.sampled else '00'}"
 
-    # 状態に応じたCSSクラス
-    if state == 'STATE_RUNNING':
-        state_class = 'state-running'
-    elif state == 'STATE_STOPPED':
-        state_class = 'state-stopped'
-    elif state in ['STATE_STARTING', 'STATE_STOPPING']:
-        state_class = 'state-starting'
-    else:
-        state_class = 'state-other'
+    def server_timing(self) -> str:
+        """
+        Server-Timing ヘッダーの値（同じ段階は合計、total はここまでの経過時間）
+        connect は接続確立全体の時間なので、内側の dns を差し引いて TCP + TLS だけにする
+        """
+        totals = {}
+        for name, start, end, _ in self.phases:
+            if name not in ('upstream', 'transfer'):
+                totals[name] = totals.get(name, 0.0) + (end - start)
+        if 'connect' in totals:
+            totals['connect'] -= totals.get('dns', 0.0)
+        totals['total'] = time.monotonic() - self.start
+        return ', '.join(f"{name};dur={value * 1000:.1f}" for name, value in totals.items())
 
-    # ボタン生成
-    if state == 'STATE_RUNNING':
-        button = f'''<form method="POST">
-            <input type="hidden" name="action" value="stop">
-            <button type="submit" class="btn-stop">Stop Workstation</button>
-        </form>'''
-    elif state == 'STATE_STOPPED':
-        button = f'''<form method="POST">
-            <input type="hidden" name="action" value="start">
-            <button type="submit" class="btn-start">Start Workstation</button>
-        </form>'''
-    elif state in ['STATE_STARTING', 'STATE_STOPPING']:
-        button = '<button class="btn-disabled" disabled>Processing...</button>'
-    else:
-        button = ''
+    def _unix_nano(self, monotonic: float) -> str:
+        return str(self.wall_start + int((monotonic - self.start) * 1e9))
 
-    # エラー表示
-    if status.get('error') and not error_msg:
-        error_msg = f'<div class="error">{status["error"]}</div>'
+    def spans(self, name: str, end: float, attributes: dict) -> list:
+        """OTLP/JSON 形式のスパン（サーバースパン + 各段階の子スパン）"""
+        spans = [{
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_span_id,
+            "name": name,
+            "kind": 2,  # SERVER
+            "startTimeUnixNano": self._unix_nano(self.start),
+            "endTimeUnixNano": self._unix_nano(end),
+            "attributes": otlp_attributes(attributes),
+            "status": {"code": 2 if attributes.get("http.response.status_code", 0) >= 500 else 0},
+        }]
+        for phase, start, phase_end, phase_attributes in self.phases:
+            if phase == 'upstream':
+                span_id, parent, kind = self.upstream_span_id, self.span_id, 3  # CLIENT
+            elif phase in ('pool', 'dns', 'connect', 'ttfb', 'transfer'):
+                span_id, parent, kind = secrets.token_hex(8), self.upstream_span_id, 1  # INTERNAL
+            else:
+                span_id, parent, kind = secrets.token_hex(8), self.span_id, 1
+            spans.append({
+                "traceId": self.trace_id,
+                "spanId": span_id,
+                "parentSpanId": parent,
+                "name": phase,
+                "kind": kind,
+                "startTimeUnixNano": self._unix_nano(start),
+                "endTimeUnixNano": self._unix_nano(phase_end),
+                "attributes": otlp_attributes(phase_attributes),
+            })
+        return spans
 
-    # STATE_RUNNINGの時のみWorkstationへのリンクを表示
-    if state == 'STATE_RUNNING':
-        open_link = f'<div style="margin-top: 1.5rem; font-size: 0.9rem;"><a href="/ws/{ws_name}/">Open Workstation</a></div>'
-    else:
-        open_link = ''
 
-    html = STATUS_HTML.format(
-        workstation=ws_name,
-        state=state,
-        state_class=state_class,
-        host=status.get('host', ''),
-        error=error_msg,
-        message=message,
-        button=button,
-        open_link=open_link
-    )
-    return web.Response(text=html, content_type='text/html')
+def otlp_attributes(attributes: dict) -> list:
+    result = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            result.append({"key": key, "value": {"boolValue": value}})
+        elif isinstance(value, int):
+            result.append({"key": key, "value": {"intValue": str(value)}})
+        elif value is not None:
+            result.append({"key": key, "value": {"stringValue": str(value)}})
+    return result
 
 
-async def health_check(request):
-    """ヘルスチェックエンドポイント"""
-    return web.Response(text="OK")
+def parse_trace_context(headers) -> tuple:
+    """
+    受信したトレースコンテキスト (trace_id, parent_span_id, sampled)
+    W3C traceparent を優先し、なければ X-Cloud-Trace-Context（TRACE_ID/SPAN_ID(10進);o=1）
+    どちらもなければ新しいトレースを開始し、TRACE_SAMPLE の割合でサンプリング
+    """
+    parts = headers.get('traceparent', '').split('-')
+    if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+        try:
+            return parts[1], parts[2], bool(int(parts[3], 16) & 1)
+        except ValueError:
+            pass
+    cloud = headers.get('X-Cloud-Trace-Context', '')
+    if cloud:
+        trace_id, _, rest = cloud.partition('/')
+        span, _, options = rest.partition(';')
+        if len(trace_id) == 32:
+            try:
+                parent = f"{int(span):016x}" if span else ''
+            except ValueError:
+                parent = ''
+            return trace_id.lower(), parent, options == 'o=1'
+    return secrets.token_hex(16), '', random.random() < TRACE_SAMPLE
 
 
-@web.middleware
-async def session_middleware(request, handler):
-    """セッション管理ミドルウェア（静的リソースルーティング用）"""
-    # セッションがなければ作成
-    session_id = request.cookies.get('session')
-    if not session_id or session_id not in _sessions:
-        session_id = secrets.token_urlsafe(32)
-        _sessions[session_id] = {"expires": time.time() + SESSION_DURATION}
+class timed:
+    """
+    with timed('token'): の形で、処理中のリクエストの段階の所要時間を記録
+    計測が無効（SERVER_TIMING も TRACE_* も未設定）なら何もしない
+    """
+
+    def __init__(self, name: str, **attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.timing = _request_timing.get()
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        if self.timing is not None:
+            self.timing.add(self.name, self.start, time.monotonic(), **self.attributes)
+        return False
+
+
+async def _trace_queued_start(session, context, params):
+    context.queued = time.monotonic()
+
+
+async def _trace_queued_end(session, context, params):
+    timing = _request_timing.get()
+    if timing is not None:
+        timing.add('pool', context.queued, time.monotonic())
+
+
+async def _trace_dns_start(session, context, params):
+    context.dns = time.monotonic()
+
+
+async def _trace_dns_end(session, context, params):
+    timing = _request_timing.get()
+    if timing is not None:
+        timing.add('dns', context.dns, time.monotonic(), host=params.host)
+
+
+async def _trace_connect_start(session, context, params):
+    context.connect = time.monotonic()
+
+
+async def _trace_connect_end(session, context, params):
+    timing = _request_timing.get()
+    if timing is not None:
+        timing.add('connect', context.connect, time.monotonic())
+
+
+async def _trace_headers_sent(session, context, params):
+    timing = _request_timing.get()
+    if timing is not None:
+        timing.marks['headers_sent'] = time.monotonic()
+
+
+def make_trace_config() -> aiohttp.TraceConfig:
+    """クライアントセッション用のフック（接続待ち・名前解決・接続確立・リクエスト送信の時刻）"""
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_queued_start.append(_trace_queued_start)
+    trace_config.on_connection_queued_end.append(_trace_queued_end)
+    trace_config.on_dns_resolvehost_start.append(_trace_dns_start)
+    trace_config.on_dns_resolvehost_end.append(_trace_dns_end)
+    trace_config.on_connection_create_start.append(_trace_connect_start)
+    trace_config.on_connection_create_end.append(_trace_connect_end)
+    trace_config.on_request_headers_sent.append(_trace_headers_sent)
+    return trace_config
+
+
+def session_trace_configs() -> list:
+    """計測が有効なときだけフックを付ける（無効時はフック呼び出しのコストもかけない）"""
+    return [make_trace_config()] if TIMING_ENABLED else []
+
+
+class SpanExporter:
+    """
+    終了したスパンを溜めて、TRACE_EXPORT_INTERVAL 秒ごとにまとめて出力
+    - TRACE_SPANS_FILE: OTLP/JSON（ExportTraceServiceRequest）を1行ずつ追記（Collector の otlpjsonfile で読める）
+    - TRACE_OTLP_ENDPOINT: OTLP/HTTP の JSON で送信（例: http://localhost:4318/v1/traces）
+    溜まったスパンが TRACE_QUEUE_SIZE を超えた分は破棄して件数を数える
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.dropped = 0
+        self.task = None
+        self.path = TRACE_SPANS_FILE
+        if self.path and WORKER_ID:
+            # ワーカーモードではワーカーごとのファイルに書く（行が混ざらないように）
+            self.path = f"{self.path}.{WORKER_ID}"
+
+    def add(self, spans: list):
+        if len(self.spans) + len(spans) > TRACE_QUEUE_SIZE:
+            self.dropped += len(spans)
+            return
+        self.spans.extend(spans)
+
+    def _payload(self, spans: list) -> dict:
+        return {"resourceSpans": [{
+            "resource": {"attributes": otlp_attributes({
+                "service.name": TRACE_SERVICE_NAME,
+                "service.instance.id": WORKER_ID or None,
+                "gcp.project_id": PROJECT_ID,
+            })},
+            "scopeSpans": [{"scope": {"name": "cloud-run-proxy"}, "spans": spans}],
+        }]}
+
+    def _append(self, line: bytes):
+        with open(self.path, 'ab') as f:
+            f.write(line)
+
+    async def flush(self):
+        spans, self.spans = self.spans, []
+        if self.dropped:
+            log(f"Dropped {self.dropped} spans (TRACE_QUEUE_SIZE={TRACE_QUEUE_SIZE})", category='trace', level='WARNING')
+            self.dropped = 0
+        if not spans:
+            return
+        body = json.dumps(self._payload(spans)).encode()
+        if self.path:
+            await asyncio.to_thread(self._append, body + b'\n')
+        if TRACE_OTLP_ENDPOINT:
+            async with get_api_session().post(
+                TRACE_OTLP_ENDPOINT, data=body, headers={'Content-Type': 'application/json'},
+            ) as resp:
+                if resp.status >= 400:
+                    log(f"OTLP export failed: {resp.status} {await resp.text()}", category='trace', level='WARNING')
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(TRACE_EXPORT_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                log(f"Span export error: {e!r}", category='trace', level='WARNING')
+
+
+_span_exporter = SpanExporter()
+
+
+async def on_startup_span_exporter(app):
+    if TRACE_EXPORT_ENABLED:
+        _span_exporter.task = asyncio.create_task(_span_exporter.run())
+
+
+async def on_cleanup_span_exporter(app):
+    """残っているスパンを出力してから終了"""
+    if _span_exporter.task is not None:
+        _span_exporter.task.cancel()
+        await asyncio.gather(_span_exporter.task, return_exceptions=True)
+        try:
+            await _span_exporter.flush()
+        except Exception as e:
+            log(f"Span export error: {e!r}", category='trace', level='WARNING')
+
+
+class TrafficCapture:
+    """
+    リプレイ用にトラフィックの形だけを記録（CAPTURE_FILE に1行1レコードのJSONで追記）
+    - http: 開始時刻・メソッド・パスの形・ステータス・送受信バイト数・所要時間・上流のTTFB・キャッシュ結果
+    - ws: 接続ごとのフレームの時刻（接続からのミリ秒）・方向・サイズ・テキスト/バイナリ
+    パスの各要素とWorkstation名は起動ごとのランダムな鍵で置き換える
+    （同じパスは同じ形になるので、キャッシュの効き方やバーストの形は再生できる。拡張子だけは残す）
+    時刻はプロセスごとの先頭行（"capture"）の started からの秒数
+    """
+
+    FLUSH_INTERVAL = 2.0
+    QUEUE_SIZE = 100000
+
+    def __init__(self):
+        self.records = []
+        self.dropped = 0
+        self.task = None
+        self.key = secrets.token_bytes(16)
+        self.started = time.monotonic()
+        self.workstations = {}  # Workstation名 -> 連番（記録対象外は None）
+        self.full = False
+        self.path = CAPTURE_FILE
+        if self.path and WORKER_ID:
+            self.path = f"{self.path}.{WORKER_ID}"
+        self.records.append({"capture": 1, "started": round(time.time(), 3), "worker": WORKER_ID or None})
+
+    def alias(self, ws_name: str):
+        """記録対象ならWorkstationの連番、対象外なら None（CAPTURE_SAMPLE で最初に決める）"""
+        if not CAPTURE_ENABLED or self.full:
+            return None
+        if ws_name not in self.workstations:
+            sampled = CAPTURE_SAMPLE >= 1 or random.random() < CAPTURE_SAMPLE
+            self.workstations[ws_name] = len(self.workstations) + 1 if sampled else None
+        return self.workstations[ws_name]
+
+    def _token(self, segment: str) -> str:
+        return hashlib.blake2s(segment.encode(), key=self.key, digest_size=4).hexdigest()
+
+    def shape(self, path: str) -> str:
+        """/stable-abc/static/out/vs/loader.js → /1f0c9a2e/5d7e0b11/.../8c2f4a90.js"""
+        parts = []
+        for segment in path.split('/')[1:]:
+            stem, dot, ext = segment.rpartition('.')
+            if not segment:
+                parts.append('')
+            elif dot and stem and len(ext) <= 8 and ext.isascii() and ext.isalnum():
+                parts.append(f"{self._token(stem)}.{ext.lower()}")
+            else:
+                parts.append(self._token(segment))
+        return '/' + '/'.join(parts)
+
+    def add(self, record: dict):
+        if len(self.records) >= self.QUEUE_SIZE:
+            self.dropped += 1
+            return
+        self.records.append(record)
+
+    def http(self, request, ws_name: str, response, status: int, start: float):
+        alias = self.alias(ws_name)
+        if alias is None:
+            return
+        path = parse_workstation_path(request.path)[1]
+        if response is None:
+            size = 0
+        elif response.prepared:
+            size = response.body_length
+        else:
+            size = response.content_length or 0
+        record = {
+            "k": "http",
+            "t": round(start - self.started, 3),
+            "w": alias,
+            "m": request.method,
+            "p": self.shape(path),
+            "s": status,
+            "in": request.content_length or 0,
+            "out": size,
+            "d": round((time.monotonic() - start) * 1000, 1),
+        }
+        ttfb = request.get('upstream_ttfb')
+        if ttfb is not None:
+            record["u"] = round(ttfb * 1000, 1)
+        accept = request.headers.get('Accept-Encoding', '').lower()
+        encodings = ','.join(e for e in ('br', 'gzip') if e in accept)
+        if encodings:
+            record["ae"] = encodings
+        if response is not None:
+            for field, header in (("c", 'X-Proxy-Cache'), ("e", 'Content-Encoding'), ("ct", 'Content-Type')):
+                value = response.headers.get(header)
+                if value:
+                    record[field] = value.split(';', 1)[0]
+        self.add(record)
+
+    def websocket(self, ws_name: str, actual_path: str, relay):
+        alias = self.alias(ws_name)
+        if alias is None or relay.frames is None:
+            return
+        self.add({
+            "k": "ws",
+            "t": round(relay.started - self.started, 3),
+            "w": alias,
+            "p": self.shape(actual_path),
+            "d": round((time.monotonic() - relay.started) * 1000, 1),
+            "cc": [relay.upstream["close_code"], relay.downstream["close_code"]],
+            "f": relay.frames,
+            "fd": relay.frames_dropped,
+        })
+
+    def _append(self, data: bytes) -> int:
+        with open(self.path, 'ab') as f:
+            f.write(data)
+            return f.tell()
+
+    async def flush(self):
+        records, self.records = self.records, []
+        if self.dropped:
+            log(f"Dropped {self.dropped} capture records", category='capture', level='WARNING')
+            self.dropped = 0
+        if not records or self.full:
+            return
+        data = ''.join(json.dumps(r, separators=(',', ':')) + '\n' for r in records).encode()
+        size = await asyncio.to_thread(self._append, data)
+        if size >= CAPTURE_MAX_BYTES:
+            self.full = True
+            log(f"Capture file reached {size} bytes, stopped recording (CAPTURE_MAX_BYTES={CAPTURE_MAX_BYTES})",
+                category='capture', level='WARNING')
+
+    async def run(self):
+        while not self.full:
+            await asyncio.sleep(self.FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                log(f"Capture write error: {e!r}", category='capture', level='WARNING')
+
+
+_capture = TrafficCapture()
+
+
+async def on_startup_capture(app):
+    if CAPTURE_ENABLED:
+        log(f"Capturing traffic to {_capture.path} (sample {CAPTURE_SAMPLE})", category='capture')
+        _capture.task = asyncio.create_task(_capture.run())
+
+
+async def on_cleanup_capture(app):
+    """残っているレコードを書き出してから終了"""
+    if _capture.task is not None:
+        _capture.task.cancel()
+        await asyncio.gather(_capture.task, return_exceptions=True)
+        try:
+            await _capture.flush()
+        except Exception as e:
+            log(f"Capture write error: {e!r}", category='capture', level='WARNING')
+
+
+@web.middleware
+async def capture_middleware(request, handler):
+    """プロキシしたHTTPリクエストの形を記録（WebSocketは relay_websocket が接続の終了時に記録）"""
+    start = time.monotonic()
+    status = 500
+    response = None
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        ws_name = request.get('workstation')
+        if ws_name is not None and not request.get('websocket'):
+            _capture.http(request, ws_name, response, status, start)
+
+
+class LoopMonitor:
+    """
+    イベントループの遅延監視
+    - ループ上のタスクが LOOP_LAG_INTERVAL ごとに起き、予定からの遅れを LOOP_LAG に記録
+    - 別スレッドが最後に起きた時刻を見張り、LOOP_BLOCK_THRESHOLD 以上止まっていたら
+      その時点のループスレッドのスタック（ループを止めているコード）をログに出す（1回の停止につき1回）
+      ループが止まったままでもログは出る（書き込みはLogWriterのスレッド）
+    """
+
+    def __init__(self):
+        self.beat = time.monotonic()
+        self.thread_id = None
+        self.task = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    async def run(self):
+        while True:
+            expected = time.monotonic() + LOOP_LAG_INTERVAL
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self.beat = now
+            LOOP_LAG.observe(lag)
+            if lag >= LOOP_BLOCK_THRESHOLD:
+                LOOP_BLOCKED.inc()
+                log(f"Event loop was blocked for {lag * 1000:.0f}ms", category='loop', level='WARNING',
+                    lag_ms=round(lag * 1000, 1))
+
+    def _watch(self):
+        reported = None
+        while not self.stopped.wait(LOOP_BLOCK_THRESHOLD / 2):
+            beat = self.beat
+            stalled = time.monotonic() - beat - LOOP_LAG_INTERVAL
+            if stalled < LOOP_BLOCK_THRESHOLD or beat == reported:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            log(f"Event loop blocked for {stalled * 1000:.0f}ms so far, in {frame.f_code.co_name} "
+                f"({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})",
+                category='loop', level='WARNING', stalled_ms=round(stalled * 1000, 1),
+                stack_trace=''.join(traceback.format_stack(frame)))
+
+    def start(self):
+        self.thread_id = threading.get_ident()
+        self.beat = time.monotonic()
+        self.task = asyncio.create_task(self.run())
+        self.thread = threading.Thread(target=self._watch, name='loop-monitor', daemon=True)
+        self.thread.start()
+
+    async def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        if self.thread is not None:
+            await asyncio.to_thread(self.thread.join, 1)
+
+
+_loop_monitor = LoopMonitor()
+
+
+async def on_startup_loop_monitor(app):
+    if LOOP_LAG_INTERVAL > 0:
+        _loop_monitor.start()
+
+
+async def on_cleanup_loop_monitor(app):
+    await _loop_monitor.stop()
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def sample_stacks(thread_id: int, seconds: float) -> dict:
+    """
+    別スレッドから thread_id のスタックを PROFILE_SAMPLE_INTERVAL ごとに採取し、
+    collapsed形式（"外側;...;内側" -> 回数）で返す。ループが待機中のサンプルは select で終わる
+    """
+    counts = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        names = []
+        while frame is not None:
+            names.append(frame_name(frame))
+            frame = frame.f_back
+        if names:
+            stack = ';'.join(reversed(names))
+            counts[stack] = counts.get(stack, 0) + 1
+        time.sleep(PROFILE_SAMPLE_INTERVAL)
+    return counts
+
+
+_profile_lock = asyncio.Lock()
+
+
+def check_debug_token(request):
+    """/debug/* の認証（PROFILE_TOKEN が空なら 404、X-Debug-Token が違えば 403）"""
+    if not PROFILE_TOKEN:
+        raise web.HTTPNotFound()
+    if not hmac.compare_digest(request.headers.get('X-Debug-Token', '').encode(), PROFILE_TOKEN.encode()):
+        raise web.HTTPForbidden(text="Invalid X-Debug-Token")
+
+
+async def handle_debug_profile(request):
+    """
+    実行中のインスタンスのプロファイル（PROFILE_TOKEN を X-Debug-Token ヘッダーで渡す）
+    GET /debug/profile?seconds=N&format=collapsed|text|pstats
+    - collapsed（既定）: ループのスタックのサンプリング。負荷が小さく、flamegraph.pl / speedscope で読める
+    - text / pstats: cProfile（すべての関数呼び出しを記録するので、その間は遅くなる）
+      text は sort（既定 cumulative）順の上位 limit 件、pstats は python -m pstats / snakeviz で読めるバイナリ
+    ワーカーモードでは、このリクエストを受けたワーカーだけが対象
+    """
+    check_debug_token(request)
+    try:
+        seconds = float(request.query.get('seconds', '10'))
+        limit = int(request.query.get('limit', '50'))
+    except ValueError:
+        return web.Response(status=400, text="seconds and limit must be numbers")
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        return web.Response(status=400, text=f"seconds must be in (0, {PROFILE_MAX_SECONDS:g}]")
+    fmt = request.query.get('format', 'collapsed')
+    sort = request.query.get('sort', 'cumulative')
+    if fmt not in ('collapsed', 'text', 'pstats'):
+        return web.Response(status=400, text="format must be collapsed, text or pstats")
+    # プロファイラーは使うときだけ読み込む（通常の起動では import しない）
+    import cProfile
+    import marshal
+    import pstats
+    if sort not in pstats.Stats.sort_arg_dict_default:
+        return web.Response(status=400, text=f"unknown sort key: {sort}")
+    if _profile_lock.locked():
+        return web.Response(status=409, text="Another profile is running")
+
+    async with _profile_lock:
+        log(f"Profiling for {seconds:g}s ({fmt})", category='loop')
+        headers = {'Cache-Control': 'no-store'}
+        if fmt == 'collapsed':
+            counts = await asyncio.to_thread(sample_stacks, threading.get_ident(), seconds)
+            lines = [f"{stack} {count}" for stack, count in sorted(counts.items(), key=lambda item: -item[1])]
+            return web.Response(text='\n'.join(lines) + '\n', headers=headers)
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+        if fmt == 'pstats':
+            profiler.create_stats()
+            headers['Content-Disposition'] = 'attachment; filename="proxy.pstats"'
+            return web.Response(body=marshal.dumps(profiler.stats), content_type='application/octet-stream',
+                                headers=headers)
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats(sort).print_stats(limit)
+        return web.Response(text=out.getvalue(), headers=headers)
+
+
+def apply_server_timing(request, response):
+    """
+    Server-Timing ヘッダーを付与（SERVER_TIMING=true のとき）
+    ストリーミングレスポンスはハンドラー内でprepareされるため、prepare前に呼び出す
+    """
+    timing = request.get('timing')
+    if SERVER_TIMING and timing is not None and not response.prepared:
+        response.headers['Server-Timing'] = timing.server_timing()
+
+
+@web.middleware
+async def timing_middleware(request, handler):
+    """リクエストごとの段階の計測を開始し、終了時にサーバースパンを出力"""
+    if request.path in LOG_ACCESS_SKIP:
+        return await handler(request)
+    timing = RequestTiming(*parse_trace_context(request.headers))
+    request['timing'] = timing
+    token = _request_timing.set(timing)
+    status = 500
+    try:
         response = await handler(request)
-        response.set_cookie('session', session_id, httponly=True, max_age=SESSION_DURATION)
+        status = response.status
+        apply_server_timing(request, response)
         return response
-    return await handler(request)
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        _request_timing.reset(token)
+        if TRACE_EXPORT_ENABLED and timing.sampled:
+            _span_exporter.add(timing.spans(f"{request.method} {request.path}", time.monotonic(), {
+                "http.request.method": request.method,
+                "url.path": request.path,
+                "http.response.status_code": status,
+                "workstation": request.get('workstation'),
+                "websocket": bool(request.get('websocket')),
+            }))
+
+
+def get_ssl_context() -> ssl.SSLContext:
+    """共有SSLコンテキストを取得（CAバンドルの読み込みは1回だけ）"""
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+        if UPSTREAM_CA_FILE:
+            _ssl_context.load_verify_locations(UPSTREAM_CA_FILE)
+    return _ssl_context
+
+
+class CachingResolver(AbstractResolver):
+    """
+    名前解決結果をホストごとにキャッシュするリゾルバー
+    - 成功は RESOLVER_TTL 秒、失敗は RESOLVER_NEGATIVE_TTL 秒キャッシュ
+    - 期限切れの結果はそのまま返し、バックグラウンドで再解決（再解決に失敗しても古い結果を使い続ける）
+    - static_host を指定すると static_suffix（文字列またはタプル）で終わるホストはDNSを引かずにそのアドレスを返す
+    """
+
+    def __init__(self, cache: bool = True, static_host: str = '', static_port: int = None, static_suffix=''):
+        self.resolver = aiohttp.DefaultResolver()
+        self.cache = cache
+        self.static_host = static_host.strip('[]')
+        self.static_port = static_port
+        self.static_suffix = static_suffix
+        self.static_family = socket.AF_INET6 if ':' in self.static_host else socket.AF_INET
+        self.entries = {}  # {(host, port, family): {"result": list, "error": (errno, strerror), "expires": monotonic}}
+        self.refreshing = set()
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        if self.static_host and host.endswith(self.static_suffix):
+            DNS_RESOLVE.inc(('static',))
+            return [{
+                "hostname": host,
+                "host": self.static_host,
+                "port": self.static_port or port,
+                "family": self.static_family,
+                "proto": 0,
+                "flags": socket.AI_NUMERICHOST,
+            }]
+
+        key = (host, port, family)
+        flight_key = f"dns:{host}:{port}:{family}"
+        entry = self.entries.get(key) if self.cache else None
+        if entry is None or (entry["error"] and time.monotonic() >= entry["expires"]):
+            DNS_RESOLVE.inc(('miss',))
+            entry = await single_flight(flight_key, lambda: self._lookup(key))
+        elif time.monotonic() >= entry["expires"]:
+            DNS_RESOLVE.inc(('stale',))
+            if flight_key not in _inflight:
+                task = asyncio.create_task(single_flight(flight_key, lambda: self._lookup(key)))
+                self.refreshing.add(task)
+                task.add_done_callback(self.refreshing.discard)
+        else:
+            DNS_RESOLVE.inc(('hit',))
+
+        if entry["error"]:
+            raise socket.gaierror(*entry["error"])
+        return entry["result"]
+
+    async def _lookup(self, key) -> dict:
+        """getaddrinfo を実行してキャッシュを更新（例外は投げずにエントリとして返す）"""
+        host, port, family = key
+        start = time.monotonic()
+        try:
+            result = await self.resolver.resolve(host, port, family)
+            entry = {"result": result, "error": None, "expires": time.monotonic() + RESOLVER_TTL}
+            DNS_LOOKUP.observe(time.monotonic() - start, ('ok',))
+        except OSError as e:
+            DNS_LOOKUP.observe(time.monotonic() - start, ('error',))
+            previous = self.entries.get(key)
+            if previous is not None and not previous["error"]:
+                # DNSが一時的に失敗しても、解決済みのアドレスで接続を続ける
+                entry = dict(previous, expires=time.monotonic() + RESOLVER_NEGATIVE_TTL)
+            else:
+                entry = {"result": None, "error": (e.errno, e.strerror), "expires": time.monotonic() + RESOLVER_NEGATIVE_TTL}
+            log(f"DNS lookup failed for {host}: {e}", category='dns', level='WARNING')
+        if self.cache:
+            self.entries[key] = entry
+        return entry
+
+    async def close(self):
+        for task in list(self.refreshing):
+            task.cancel()
+        await self.resolver.close()
+
+
+def get_resolver():
+    """
+    クライアントセッションで共有するリゾルバー
+    UPSTREAM_CONNECT_ADDRESS（host:port）または RESOLVER_STATIC_IP があればWorkstationホストはDNSを引かない
+    キャッシュも固定アドレスも使わない場合は None（aiohttp標準のリゾルバー）
+    """
+    global _resolver
+    if _resolver is None and (RESOLVER_CACHE or RESOLVER_STATIC_IP or UPSTREAM_CONNECT_ADDRESS):
+        static_host, static_port = RESOLVER_STATIC_IP, None
+        if UPSTREAM_CONNECT_ADDRESS:
+            static_host, _, port = UPSTREAM_CONNECT_ADDRESS.rpartition(':')
+            static_port = int(port)
+        _resolver = CachingResolver(
+            cache=RESOLVER_CACHE,
+            static_host=static_host,
+            static_port=static_port,
+            static_suffix=tuple(f".{hostname}" for hostname in _registry.hostnames()),
+        )
+    return _resolver
+
+
+def connector_options() -> dict:
+    """TCPConnector の名前解決関連の引数（独自リゾルバーを使う場合はaiohttp側のDNSキャッシュを無効化）"""
+    resolver = get_resolver()
+    if resolver is None:
+        return {}
+    return {"resolver": resolver, "use_dns_cache": False}
+
+
+def get_api_session() -> aiohttp.ClientSession:
+    """googleapis/メタデータサーバー用の共有セッションを取得"""
+    global _api_session
+    if _api_session is None or _api_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=API_POOL_LIMIT,
+            keepalive_timeout=POOL_KEEPALIVE_TIMEOUT,
+            ssl=get_ssl_context(),
+            **connector_options(),
+        )
+        _api_session = aiohttp.ClientSession(
+            connector=connector,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            trace_configs=session_trace_configs(),
+        )
+    return _api_session
+
+
+def get_workstation_session(workstation_host: str) -> aiohttp.ClientSession:
+    """Workstationホストごとのkeep-aliveセッションを取得"""
+    _ws_sessions_used[workstation_host] = time.monotonic()
+    session = _ws_sessions.get(workstation_host)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=UPSTREAM_POOL_LIMIT,
+            keepalive_timeout=POOL_KEEPALIVE_TIMEOUT,
+            ssl=get_ssl_context(),
+            **connector_options(),
+        )
+        # ユーザー間でCookieが混ざらないようにCookieJarは無効化
+        # 圧縮済みボディは展開せずにそのまま転送する（auto_decompress=False）
+        session = aiohttp.ClientSession(
+            connector=connector,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            auto_decompress=False,
+            timeout=aiohttp.ClientTimeout(total=UPSTREAM_TIMEOUT),
+            trace_configs=session_trace_configs(),
+        )
+        _ws_sessions[workstation_host] = session
+    return session
+
+
+async def on_startup_sessions(app):
+    """共有クライアントの設定を記録（作成は初回使用時。SSLコンテキストは warm_credentials で準備）"""
+    log(f"Connection pools configured (upstream limit: {UPSTREAM_POOL_LIMIT}, api limit: {API_POOL_LIMIT}, "
+        f"keepalive: {POOL_KEEPALIVE_TIMEOUT}s)")
+
+
+async def on_cleanup_sessions(app):
+    """共有クライアントをすべて閉じる"""
+    global _api_session, _broker_session, _resolver
+    sessions = list(_ws_sessions.values())
+    _ws_sessions.clear()
+    _ws_sessions_used.clear()
+    if _api_session is not None:
+        sessions.append(_api_session)
+        _api_session = None
+    if _broker_session is not None:
+        sessions.append(_broker_session)
+        _broker_session = None
+    for session in sessions:
+        if not session.closed:
+            await session.close()
+    if _resolver is not None:
+        await _resolver.close()
+        _resolver = None
+    log(f"Closed {len(sessions)} client session(s)")
+
+
+async def single_flight(key: str, fetch):
+    """
+    同じキーの取得処理を1つにまとめる
+    実行中の取得があればその結果を待ち、なければ fetch() を新規に実行する
+    """
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch())
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _inflight.pop(key, None))
+    # 待っている側がキャンセルされても、他の待機者のために取得は継続させる
+    return await asyncio.shield(task)
+
+
+async def get_gcp_access_token() -> str:
+    """メタデータサーバーからGCPアクセストークンを取得"""
+    # キャッシュが有効なら返す
+    if _gcp_token_cache["token"] and time.time() < _gcp_token_cache["expires"] - 60:
+        TOKEN_CACHE.inc(('gcp', 'hit'))
+        return _gcp_token_cache["token"]
+
+    TOKEN_CACHE.inc(('gcp', 'miss'))
+    return await single_flight("gcp", fetch_gcp_access_token)
+
+
+async def fetch_token_from_broker(path: str) -> dict:
+    """ワーカーモード: スーパーバイザーからトークンを取得（ワーカー間で共有）"""
+    global _broker_session
+    if _broker_session is None or _broker_session.closed:
+        _broker_session = aiohttp.ClientSession(
+            connector=aiohttp.UnixConnector(path=TOKEN_BROKER_SOCKET),
+            cookie_jar=aiohttp.DummyCookieJar(),
+        )
+    async with _broker_session.get(f"http://broker{path}") as resp:
+        if resp.status != 200:
+            raise Exception(f"Token broker error: {resp.status} - {await resp.text()}")
+        return await resp.json()
+
+
+async def fetch_gcp_access_token() -> str:
+    """メタデータサーバーからGCPアクセストークンを取得してキャッシュを更新"""
+    if TOKEN_BROKER_SOCKET:
+        data = await fetch_token_from_broker('/token/gcp')
+        _gcp_token_cache.update(data)
+        return data["token"]
+
+    headers = {"Metadata-Flavor": "Google"}
+    session = get_api_session()
+    async with api_timer('metadata_token'), session.get(METADATA_TOKEN_URL, headers=headers) as resp:
+        if resp.status == 200:
+            data = await resp.json()
+            _gcp_token_cache["token"] = data["access_token"]
+            _gcp_token_cache["expires"] = time.time() + data.get("expires_in", 3600)
+            return data["access_token"]
+        else:
+            raise Exception(f"Failed to get GCP token: {resp.status}")
+
+
+# === Workstationの登録簿 ===
+
+class WorkstationConfig:
+    """WORKSTATION_CONFIGS の1項目（Cluster/Config と、一覧APIのURL）"""
+
+    __slots__ = ('index', 'region', 'cluster', 'config', 'hostname', 'key', 'workstations_url')
+
+    def __init__(self, index: int, region: str, cluster: str, config: str, hostname: str):
+        self.index = index
+        self.region = region
+        self.cluster = cluster
+        self.config = config
+        self.hostname = hostname
+        self.key = f"{cluster}/{config}"
+        self.workstations_url = (
+            f"{WORKSTATIONS_API_URL}/v1/projects/{PROJECT_ID}/"
+            f"locations/{region}/workstationClusters/{cluster}/"
+            f"workstationConfigs/{config}/workstations"
+        )
+
+
+def parse_workstation_configs(value: str) -> list:
+    """WORKSTATION_CONFIGS を解釈（未設定なら CLUSTER_NAME / CONFIG_NAME / CLUSTER_HOSTNAME の1つ）"""
+    if not value.strip():
+        return [WorkstationConfig(0, REGION, CLUSTER_NAME, CONFIG_NAME, CLUSTER_HOSTNAME)]
+    configs = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        spec, _, hostname = item.partition('@')
+        parts = spec.split('/')
+        if len(parts) == 2:
+            parts.insert(0, REGION)
+        if len(parts) != 3 or not all(parts):
+            raise ValueError(f"Invalid WORKSTATION_CONFIGS entry: {item!r} (expected [region/]cluster/config@hostname)")
+        configs.append(WorkstationConfig(len(configs), *parts, hostname or CLUSTER_HOSTNAME))
+    return configs
+
+
+class WorkstationEntry:
+    """
+    登録簿の1件（名前 → Config・ホスト名・最後に分かった状態）
+    APIのURLと上流へのヘッダーの雛形は登録時に1回だけ作る
+    """
+
+    __slots__ = ('name', 'config', 'host', 'base_url', 'ws_base_url', 'api_url', 'token_url', 'start_url',
+                 'stop_url', 'ws_headers', 'state', 'updated')
+
+    def __init__(self, name: str, config: WorkstationConfig, state: str = 'UNKNOWN'):
+        self.name = name
+        self.config = config
+        self.host = f"{name}.{config.hostname}"
+        self.base_url = f"https://{self.host}"
+        self.ws_base_url = f"wss://{self.host}"
+        self.api_url = f"{config.workstations_url}/{name}"
+        self.token_url = f"{self.api_url}:generateAccessToken"
+        self.start_url = f"{self.api_url}:start"
+        self.stop_url = f"{self.api_url}:stop"
+        self.ws_headers = {"Host": self.host, "Origin": self.base_url}
+        self.state = state
+        self.updated = time.time()
+
+    def set_state(self, state: str):
+        self.state = state
+        self.updated = time.time()
+
+    def status(self) -> dict:
+        return {
+            "workstation": self.name,
+            "state": self.state,
+            "host": self.host,
+            "cluster": self.config.cluster,
+            "config": self.config.config,
+        }
+
+
+class RegistryThrottled(Exception):
+    """登録簿にない名前の問い合わせが REGISTRY_MISS_RATE を超えた（503 + Retry-After を返す）"""
+
+
+class WorkstationRegistry:
+    """
+    Workstation名 → WorkstationEntry の索引（ルーティングは辞書を1回引くだけ）
+    - 一覧（list）を定期的に取得して、追加・状態の変化・削除を反映する
+    - 登録簿にない名前は全Configを1回ずつ get で探す（同じ名前は1回にまとめ、全体で REGISTRY_MISS_RATE 回/秒まで）
+    - 見つからなかった名前は REGISTRY_NEGATIVE_TTL 秒のあいだ問い合わせずに「なし」を返す
+    - 問い合わせが上限を超えたら RegistryThrottled（存在しないとは限らないので「なし」にはしない）
+    - APIが失敗したときは先頭のConfigとして扱う（登録簿には入れない）
+    """
+
+    def __init__(self, configs: list):
+        self.configs = configs
+        self.entries = {}  # {workstation_name: WorkstationEntry}
+        self.missing = {}  # {workstation_name: time.monotonic() の期限}
+        self.tokens = float(REGISTRY_MISS_BURST)
+        self.tokens_at = time.monotonic()
+        self.filled = asyncio.Event()  # 最初の一覧を反映した（/ready が待つ）
+
+    def hostnames(self) -> list:
+        return list(dict.fromkeys(config.hostname for config in self.configs))
+
+    def host(self, name: str) -> str:
+        entry = self.entries.get(name)
+        return entry.host if entry is not None else f"{name}.{self.configs[0].hostname}"
+
+    def add(self, name: str, config: WorkstationConfig, state: str = None) -> WorkstationEntry:
+        entry = self.entries.get(name)
+        if entry is None or entry.config is not config:
+            entry = self.entries[name] = WorkstationEntry(name, config)
+        if state is not None:
+            entry.set_state(state)
+        self.missing.pop(name, None)
+        return entry
+
+    def remove(self, name: str):
+        """APIが「なし」と答えた名前を外し、しばらく問い合わせないようにする"""
+        if self.entries.pop(name, None) is not None:
+            log(f"Workstation '{name}' removed from registry", category='status')
+        self.mark_missing(name)
+
+    def mark_missing(self, name: str):
+        now = time.monotonic()
+        if len(self.missing) >= 4096:
+            self.missing = {key: until for key, until in self.missing.items() if until > now}
+        self.missing[name] = now + REGISTRY_NEGATIVE_TTL
+
+    def merge(self, config: WorkstationConfig, items: list) -> list:
+        """
+        1つのConfigの一覧を反映して、そのConfigの WorkstationEntry を返す
+        一覧にないものは外す。同じ名前が先のConfigにすでにあればそちらを優先する
+        """
+        seen = set()
+        merged = []
+        for name, state in items:
+            entry = self.entries.get(name)
+            if entry is not None and entry.config.index < config.index:
+                continue
+            seen.add(name)
+            merged.append(self.add(name, config, state))
+        for name in [name for name, entry in self.entries.items() if entry.config is config and name not in seen]:
+            del self.entries[name]
+        return merged
+
+    def allow_miss(self) -> bool:
+        """登録簿にない名前の問い合わせ（トークンバケット）"""
+        if REGISTRY_MISS_RATE <= 0:
+            return True
+        now = time.monotonic()
+        self.tokens = min(REGISTRY_MISS_BURST, self.tokens + (now - self.tokens_at) * REGISTRY_MISS_RATE)
+        self.tokens_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    async def resolve(self, name: str):
+        """名前から WorkstationEntry を返す（存在しなければ None）"""
+        entry = self.entries.get(name)
+        if entry is not None:
+            REGISTRY_LOOKUPS.inc(('hit',))
+            return entry
+        if not REGISTRY_ENABLED:
+            REGISTRY_LOOKUPS.inc(('hit',))
+            return self.add(name, self.configs[0])
+        until = self.missing.get(name)
+        if until is not None:
+            if until > time.monotonic():
+                REGISTRY_LOOKUPS.inc(('not_found',))
+                return None
+            del self.missing[name]
+        if f"registry:{name}" not in _inflight and not self.allow_miss():
+            REGISTRY_LOOKUPS.inc(('throttled',))
+            raise RegistryThrottled(f"Too many lookups of unknown workstations, retry '{name}' shortly")
+        return await single_flight(f"registry:{name}", lambda: self.find(name))
+
+    async def find(self, name: str):
+        """全Configを get で探す（見つかったら登録、どこにもなければしばらく「なし」）"""
+        try:
+            gcp_token = await get_gcp_access_token()
+            headers = {"Authorization": f"Bearer {gcp_token}"}
+            results = await asyncio.gather(*[self.probe(config, name, headers) for config in self.configs])
+        except Exception as e:
+            REGISTRY_LOOKUPS.inc(('error',))
+            log(f"Registry lookup failed for '{name}': {e}", category='status', level='WARNING')
+            return WorkstationEntry(name, self.configs[0])
+        for config, state in zip(self.configs, results):
+            if state is not None:
+                REGISTRY_LOOKUPS.inc(('found',))
+                return self.add(name, config, state)
+        REGISTRY_LOOKUPS.inc(('not_found',))
+        self.mark_missing(name)
+        return None
+
+    async def probe(self, config: WorkstationConfig, name: str, headers: dict):
+        """1つのConfigで get（あれば状態、なければ None）"""
+        session = get_api_session()
+        async with api_timer('get'), session.get(f"{config.workstations_url}/{name}", headers=headers) as resp:
+            if resp.status == 200:
+                data = await resp.json()
+                return data.get("state", "UNKNOWN")
+            if resp.status == 404:
+                return None
+            raise RuntimeError(f"API error ({config.key}): {resp.status} - {await resp.text()}")
+
+
+_registry = WorkstationRegistry(parse_workstation_configs(WORKSTATION_CONFIGS))
+REGISTRY_REFRESHER_KEY = web.AppKey('registry_refresher', asyncio.Task)
+
+
+def registry_throttled(ws_name: str) -> web.Response:
+    log(f"Registry lookup throttled for {ws_name}", category='status', level='WARNING', workstation=ws_name)
+    return web.Response(status=503, text="Too many requests for unknown workstations, retry shortly",
+                        headers={'Retry-After': str(ADMISSION_RETRY_AFTER)})
+
+
+async def registry_refresher():
+    """一覧を定期的に取得して登録簿を更新（状態キャッシュと一覧のキャッシュも同時に更新される）"""
+    while True:
+        try:
+            await single_flight("status:list", refresh_workstation_list)
+        except Exception as e:
+            log(f"Registry refresh failed: {e}", category='status', level='WARNING')
+        await asyncio.sleep(REGISTRY_REFRESH_INTERVAL)
+
+
+async def on_startup_registry(app):
+    """登録簿のバックグラウンド更新を開始"""
+    if REGISTRY_ENABLED and REGISTRY_REFRESH_INTERVAL > 0:
+        app[REGISTRY_REFRESHER_KEY] = asyncio.create_task(registry_refresher())
+
+
+async def on_cleanup_registry(app):
+    """登録簿のバックグラウンド更新を停止"""
+    task = app.get(REGISTRY_REFRESHER_KEY)
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+async def get_workstation_access_token(workstation_name: str) -> str:
+    """Workstation APIからアクセストークンを取得"""
+    _ws_token_last_used[workstation_name] = time.time()
+
+    # Workstation名ごとにキャッシュをチェック（5分のマージン）
+    cache = _ws_token_cache.get(workstation_name, {"token": None, "expires": 0})
+    if cache["token"] and time.time() < cache["expires"] - 300:
+        TOKEN_CACHE.inc(('workstation', 'hit'))
+        return cache["token"]
+
+    TOKEN_CACHE.inc(('workstation', 'miss'))
+    return await single_flight(f"ws:{workstation_name}", lambda: fetch_workstation_access_token(workstation_name))
+
+
+async def fetch_workstation_access_token(workstation_name: str) -> str:
+    """Workstation APIからアクセストークンを取得してキャッシュを更新"""
+    entry = await _registry.resolve(workstation_name)
+    if entry is None:
+        raise Exception(f"Workstation '{workstation_name}' not found")
+
+    if TOKEN_BROKER_SOCKET:
+        # どのConfigかはワーカー側の登録簿で決まっているので、番号を渡す
+        data = await fetch_token_from_broker(f'/token/workstation/{workstation_name}?config={entry.config.index}')
+        _ws_token_cache[workstation_name] = data
+        return data["token"]
+
+    # GCPアクセストークン取得
+    gcp_token = await get_gcp_access_token()
+
+    headers = {
+        "Authorization": f"Bearer {gcp_token}",
+        "Content-Type": "application/json"
+    }
+
+    # 1時間後に期限切れ
+    expire_time = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 3600))
+    body = {"expireTime": expire_time}
+
+    session = get_api_session()
+    async with api_timer('generate_access_token'), session.post(entry.token_url, headers=headers, json=body) as resp:
+        if resp.status == 200:
+            data = await resp.json()
+            _ws_token_cache[workstation_name] = {
+                "token": data["accessToken"],
+                "expires": time.time() + 3600
+            }
+            log(f"Got Workstation access token for '{workstation_name}', expires: {data.get('expireTime')}",
+                category='token', workstation=workstation_name)
+            return data["accessToken"]
+        else:
+            error = await resp.text()
+            raise Exception(f"Failed to get Workstation token for '{workstation_name}': {resp.status} - {error}")
+
+
+async def refresh_tokens_once():
+    """
+    期限が近いトークンを先行更新し、使われなくなったWorkstationのトークンを破棄
+    リクエスト処理がトークン取得で待たされないようにするため、5分のマージンに入る前に更新する
+    """
+    now = time.time()
+
+    if _gcp_token_cache["token"] and _gcp_token_cache["expires"] - now < TOKEN_REFRESH_AHEAD:
+        try:
+            TOKEN_CACHE.inc(('gcp', 'refresh'))
+            await single_flight("gcp", fetch_gcp_access_token)
+        except Exception as e:
+            log(f"Background GCP token refresh failed: {e}", category='token', level='WARNING')
+
+    for workstation_name in list(_ws_token_cache):
+        last_used = _ws_token_last_used.get(workstation_name, 0)
+        if now - last_used > TOKEN_IDLE_EVICT:
+            _ws_token_cache.pop(workstation_name, None)
+            _ws_token_last_used.pop(workstation_name, None)
+            TOKEN_CACHE.inc(('workstation', 'evict'))
+            log(f"Evicted idle Workstation token for '{workstation_name}'", category='token', level='DEBUG')
+            continue
+
+        if _ws_token_cache[workstation_name]["expires"] - now < TOKEN_REFRESH_AHEAD:
+            try:
+                TOKEN_CACHE.inc(('workstation', 'refresh'))
+                await single_flight(
+                    f"ws:{workstation_name}",
+                    lambda name=workstation_name: fetch_workstation_access_token(name)
+                )
+            except Exception as e:
+                log(f"Background token refresh failed for '{workstation_name}': {e}", category='token', level='WARNING')
+
+
+async def token_refresher():
+    """トークンのバックグラウンド更新ループ"""
+    while True:
+        await asyncio.sleep(TOKEN_REFRESH_INTERVAL)
+        try:
+            await refresh_tokens_once()
+        except Exception as e:
+            log(f"Token refresher error: {e}", category='token', level='ERROR')
+
+
+async def on_startup_token_refresher(app):
+    """トークンのバックグラウンド更新を開始"""
+    app[TOKEN_REFRESHER_KEY] = asyncio.create_task(token_refresher())
+
+
+async def on_cleanup_token_refresher(app):
+    """トークンのバックグラウンド更新を停止"""
+    task = app.get(TOKEN_REFRESHER_KEY)
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+def workstation_not_found(workstation_name: str) -> dict:
+    return {
+        "workstation": workstation_name,
+        "state": "NOT_FOUND",
+        "error": "Workstation not found"
+    }
+
+
+async def get_workstation_status(workstation_name: str) -> dict:
+    """Workstation APIから状態を取得（登録簿にない名前は問い合わせずに NOT_FOUND）"""
+    entry = await _registry.resolve(workstation_name)
+    if entry is None:
+        return workstation_not_found(workstation_name)
+
+    # GCPアクセストークン取得
+    gcp_token = await get_gcp_access_token()
+
+    headers = {
+        "Authorization": f"Bearer {gcp_token}",
+    }
+
+    session = get_api_session()
+    async with api_timer('get'), session.get(entry.api_url, headers=headers) as resp:
+        if resp.status == 200:
+            data = await resp.json()
+            entry.set_state(data.get("state", "UNKNOWN"))
+            return entry.status()
+        elif resp.status == 404:
+            _registry.remove(workstation_name)
+            return workstation_not_found(workstation_name)
+        else:
+            error = await resp.text()
+            return {
+                "workstation": workstation_name,
+                "state": "ERROR",
+                "error": f"API error: {resp.status} - {error}"
+            }
+
+
+async def start_workstation(workstation_name: str) -> dict:
+    """Workstationを開始"""
+    entry = await _registry.resolve(workstation_name)
+    if entry is None:
+        return {"success": False, "error": "Workstation not found"}
+
+    gcp_token = await get_gcp_access_token()
+
+    headers = {
+        "Authorization": f"Bearer {gcp_token}",
+        "Content-Type": "application/json"
+    }
+
+    session = get_api_session()
+    async with api_timer('start'), session.post(entry.start_url, headers=headers, json={}) as resp:
+        if resp.status == 200:
+            log(f"Workstation '{workstation_name}' start initiated", category='status', workstation=workstation_name)
+            return {"success": True}
+        elif resp.status == 409:
+            # 既に開始処理中 - 成功扱い
+            log(f"Workstation '{workstation_name}' already starting (409)", category='status', workstation=workstation_name)
+            return {"success": True}
+        else:
+            error = await resp.text()
+            log(f"Failed to start workstation '{workstation_name}': {resp.status} - {error}",
+                category='status', level='WARNING', workstation=workstation_name)
+            return {"success": False, "error": f"API error: {resp.status}"}
+
+
+async def stop_workstation(workstation_name: str) -> dict:
+    """Workstationを停止"""
+    entry = await _registry.resolve(workstation_name)
+    if entry is None:
+        return {"success": False, "error": "Workstation not found"}
+
+    gcp_token = await get_gcp_access_token()
+
+    headers = {
+        "Authorization": f"Bearer {gcp_token}",
+        "Content-Type": "application/json"
+    }
+
+    session = get_api_session()
+    async with api_timer('stop'), session.post(entry.stop_url, headers=headers, json={}) as resp:
+        if resp.status == 200:
+            log(f"Workstation '{workstation_name}' stop initiated", category='status', workstation=workstation_name)
+            return {"success": True}
+        elif resp.status == 409:
+            # 既に停止処理中 - 成功扱い
+            log(f"Workstation '{workstation_name}' already stopping (409)", category='status', workstation=workstation_name)
+            return {"success": True}
+        else:
+            error = await resp.text()
+            log(f"Failed to stop workstation '{workstation_name}': {resp.status} - {error}",
+                category='status', level='WARNING', workstation=workstation_name)
+            return {"success": False, "error": f"API error: {resp.status}"}
+
+
+async def list_config_workstations(config, headers: dict) -> list:
+    """
+    1つのConfig内の全Workstationを [(名前, 状態)] で取得
+    ページごとに STATUS_LIST_PAGE_SIZE 件、nextPageToken がなくなるまで続ける
+    """
+    session = get_api_session()
+    items = []
+    params = {"pageSize": str(STATUS_LIST_PAGE_SIZE)}
+    while True:
+        async with api_timer('list'), session.get(config.workstations_url, headers=headers, params=params) as resp:
+            if resp.status != 200:
+                error = await resp.text()
+                raise RuntimeError(f"API error ({config.key}): {resp.status} - {error}")
+            data = await resp.json()
+        for item in data.get("workstations", []):
+            items.append((item.get("name", "").rsplit('/', 1)[-1], item.get("state", "UNKNOWN")))
+        if not data.get("nextPageToken"):
+            break
+        params["pageToken"] = data["nextPageToken"]
+    return items
+
+
+async def list_workstations() -> list:
+    """
+    登録簿の全Configの全Workstationを一覧取得し、登録簿も更新する
+    一部のConfigだけ失敗した場合は、そのConfigの登録簿を前回のまま残して残りを返す（すべて失敗したら例外）
+    """
+    gcp_token = await get_gcp_access_token()
+    headers = {
+        "Authorization": f"Bearer {gcp_token}",
+    }
+    results = await asyncio.gather(
+        *[list_config_workstations(config, headers) for config in _registry.configs], return_exceptions=True)
+
+    workstations = []
+    errors = []
+    for config, result in zip(_registry.configs, results):
+        if isinstance(result, Exception):
+            errors.append(result)
+            log(f"Failed to list workstations in {config.key}: {result}", category='status', level='WARNING')
+            continue
+        for entry in _registry.merge(config, result):
+            workstations.append(entry.status())
+    if len(errors) == len(results):
+        raise errors[0]
+    _registry.filled.set()
+    workstations.sort(key=lambda ws: ws["workstation"])
+    return workstations
+
+
+async def get_cached_workstation_list() -> dict:
+    """
+    Workstation一覧をキャッシュ経由で取得（STATUS_LIST_TTL秒）
+    同時の取得は1回の list 呼び出しにまとめる
+    """
+    if _workstation_list["body"] is not None and time.time() - _workstation_list["fetched"] < STATUS_LIST_TTL:
+        return _workstation_list
+    return await single_flight("status:list", refresh_workstation_list)
+
+
+async def refresh_workstation_list() -> dict:
+    """
+    一覧を取得してキャッシュを更新
+    JSON本文とETagはここで1回だけ作り、各Workstationの状態キャッシュも同時に更新する
+    """
+    workstations = await list_workstations()
+    fetched = time.time()
+    for status in workstations:
+        _status_cache[status["workstation"]] = {"status": status, "fetched": fetched}
+    default = _registry.configs[0]
+    body = json.dumps({
+        "cluster": default.cluster,
+        "config": default.config,
+        "configs": [{"cluster": c.cluster, "config": c.config} for c in _registry.configs],
+        "workstations": workstations,
+    }).encode()
+    _workstation_list.update({
+        "workstations": workstations,
+        "body": body,
+        "etag": '"' + hashlib.sha1(body).hexdigest() + '"',
+        "fetched": fetched,
+    })
+    return _workstation_list
+
+
+class RateLimiter:
+    """一定の速度（回/秒）を超えないように待たせる（Workstations API のクォータ対策）"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_at = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        at = max(now, self.next_at)
+        self.next_at = at + self.interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+
+_batch_limiter = RateLimiter(BATCH_RATE)
+
+
+async def batch_workstation_action(action: str, names: list) -> dict:
+    """
+    複数のWorkstationを開始/停止
+    同時実行数は BATCH_CONCURRENCY、API呼び出しは全体で BATCH_RATE 回/秒まで
+    開始できない（停止できない）状態のものは呼び出さずに skipped とする
+    """
+    listing = await get_cached_workstation_list()
+    states = {ws["workstation"]: ws["state"] for ws in listing["workstations"]}
+    ready_state, call = {
+        'start': ('STATE_STOPPED', start_workstation),
+        'stop': ('STATE_RUNNING', stop_workstation),
+    }[action]
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run(name: str) -> dict:
+        state = states.get(name, 'NOT_FOUND')
+        if state != ready_state:
+            return {"success": False, "skipped": True, "state": state}
+        async with semaphore:
+            await _batch_limiter.wait()
+            try:
+                result = await call(name)
+            except Exception as e:
+                result = {"success": False, "error": str(e)}
+        invalidate_workstation_status(name)
+        return result
+
+    results = await asyncio.gather(*[run(name) for name in names])
+    log(f"Batch {action}: {sum(1 for r in results if r.get('success'))}/{len(names)} succeeded", category='status')
+    return dict(zip(names, results))
+
+
+async def get_cached_workstation_status(workstation_name: str) -> dict:
+    """
+    Workstationの状態をキャッシュ経由で取得（STATUS_CACHE_TTL秒）
+    同じWorkstationへの同時取得は1回のAPI呼び出しにまとめる
+    """
+    cached = _status_cache.get(workstation_name)
+    if cached and time.time() - cached["fetched"] < STATUS_CACHE_TTL:
+        return cached["status"]
+    return await single_flight(f"status:{workstation_name}", lambda: refresh_workstation_status(workstation_name))
+
+
+async def refresh_workstation_status(workstation_name: str) -> dict:
+    """Workstation APIから状態を取得してキャッシュを更新"""
+    status = await get_workstation_status(workstation_name)
+    _status_cache[workstation_name] = {"status": status, "fetched": time.time()}
+    return status
+
+
+def invalidate_workstation_status(workstation_name: str):
+    """開始/停止の直後にキャッシュを破棄し、監視中なら即時に再取得させる"""
+    _status_cache.pop(workstation_name, None)
+    _workstation_list["fetched"] = 0
+    wakeup = _status_wakeups.get(workstation_name)
+    if wakeup is not None:
+        wakeup.set()
+
+
+def schedule_warmup(workstation_name: str):
+    """
+    STARTING→RUNNING になったWorkstationをバックグラウンドでウォームアップ（状態監視と自動開始から呼ぶ）
+    直近に実施済み、または利用中（接続・トークンが既に温まっている）なら何もしない
+    """
+    if not WARMUP_ENABLED:
+        return
+    now = time.time()
+    previous = _warmups.get(workstation_name)
+    if previous is not None and now - previous["started"] < WARMUP_MIN_INTERVAL:
+        return
+    if now - _ws_token_last_used.get(workstation_name, 0) < POOL_KEEPALIVE_TIMEOUT:
+        WARMUPS.inc(('skipped',))
+        return
+    _warmups[workstation_name] = {"started": now, "finished": None, "used": False}
+    task = asyncio.create_task(warm_workstation(workstation_name))
+    _warmup_tasks.add(task)
+    task.add_done_callback(_warmup_tasks.discard)
+
+
+async def warm_workstation(workstation_name: str):
+    """トークンを取得し、WARMUP_CONNECTIONS 本の接続を同時に開く（うち1本でエントリーページを取得）"""
+    record = _warmups[workstation_name]
+    try:
+        entry = await _registry.resolve(workstation_name)
+        if entry is None:
+            raise RuntimeError("Workstation not found")
+        workstation_host = entry.host
+        start = time.monotonic()
+        token = await get_workstation_access_token(workstation_name)
+        record["token_ms"] = (time.monotonic() - start) * 1000
+
+        session = get_workstation_session(workstation_host)
+        url = f"{entry.base_url}{WARMUP_PATH}"
+        headers = {"Authorization": f"Bearer {token}"}
+
+        async def touch(method: str) -> int:
+            async with session.request(method, url, headers=headers, allow_redirects=False) as resp:
+                await resp.read()
+                return resp.status
+
+        # 同時に投げることで、それぞれが別の接続を開いてプールに残る
+        methods = ['GET' if WARMUP_PREFETCH else 'HEAD'] + ['HEAD'] * (WARMUP_CONNECTIONS - 1)
+        start = time.monotonic()
+        statuses = await asyncio.gather(*[touch(method) for method in methods])
+        record["connect_ms"] = (time.monotonic() - start) * 1000
+        WARMUPS.inc(('ok',))
+        log(f"Warmed up '{workstation_name}': token {record['token_ms']:.0f}ms, "
+            f"{len(methods)} connection(s) {record['connect_ms']:.0f}ms, {WARMUP_PATH} -> {statuses[0]}",
+            category='warmup', workstation=workstation_name)
+    except Exception as e:
+        record["error"] = repr(e)
+        WARMUPS.inc(('error',))
+        log(f"Warm-up failed for '{workstation_name}': {e!r}", category='warmup', level='WARNING',
+            workstation=workstation_name)
+    finally:
+        record["finished"] = time.time()
+
+
+def report_warmup_use(workstation_name: str):
+    """ウォームアップ後の最初のリクエストで、短縮できた時間（推定）を記録"""
+    record = _warmups.get(workstation_name)
+    if record is None or record["used"]:
+        return
+    record["used"] = True
+    if record["finished"] is None or "error" in record:
+        # 間に合わなかった、または失敗
+        return
+    saved = (record["token_ms"] + record["connect_ms"]) / 1000
+    WARMUP_SAVED.observe(saved)
+    log(f"First request to '{workstation_name}' after warm-up: about {saved * 1000:.0f}ms saved "
+        f"(warmed {time.time() - record['finished']:.0f}s ago)", category='warmup', workstation=workstation_name)
+
+
+async def on_cleanup_warmups(app):
+    """実行中のウォームアップを停止"""
+    tasks = list(_warmup_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def subscribe_workstation_status(workstation_name: str) -> asyncio.Queue:
+    """状態変化の通知を購読（購読者がいる間だけ監視タスクが動く）"""
+    subscriber = asyncio.Queue(maxsize=8)
+    _status_subscribers.setdefault(workstation_name, set()).add(subscriber)
+    task = _status_watchers.get(workstation_name)
+    if task is None or task.done():
+        _status_wakeups[workstation_name] = asyncio.Event()
+        _status_watchers[workstation_name] = asyncio.create_task(watch_workstation_status(workstation_name))
+    return subscriber
+
+
+def unsubscribe_workstation_status(workstation_name: str, subscriber: asyncio.Queue):
+    """購読を解除（最後の購読者なら監視タスクは次のループで終了）"""
+    subscribers = _status_subscribers.get(workstation_name)
+    if subscribers is not None:
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del _status_subscribers[workstation_name]
+            wakeup = _status_wakeups.get(workstation_name)
+            if wakeup is not None:
+                wakeup.set()
+
+
+async def watch_workstation_status(workstation_name: str):
+    """
+    購読者がいる間だけWorkstationの状態をポーリングし、変化したら通知
+    STARTING/STOPPING中と自動開始の待ちがある間は短い間隔、安定状態では長い間隔、APIエラーが続く間は倍々に延ばす
+    """
+    last_state = None
+    failures = 0
+    wakeup = _status_wakeups[workstation_name]
+    try:
+        while _status_subscribers.get(workstation_name):
+            wakeup.clear()
+            try:
+                status = await single_flight(
+                    f"status:{workstation_name}", lambda: refresh_workstation_status(workstation_name))
+                failures = 0
+            except Exception as e:
+                log(f"Status watcher error for '{workstation_name}': {e}", category='status', level='WARNING')
+                status = None
+                failures += 1
+
+            if status is not None and status.get('state') != last_state:
+                if last_state == 'STATE_STARTING' and status.get('state') == 'STATE_RUNNING':
+                    # 開始を見届けたときだけウォームアップ（一覧・ステータスページの表示だけでは行わない）
+                    schedule_warmup(workstation_name)
+                last_state = status.get('state')
+                for subscriber in list(_status_subscribers.get(workstation_name, ())):
+                    if subscriber.full():
+                        subscriber.get_nowait()
+                    subscriber.put_nowait(status)
+
+            if failures:
+                # APIエラーが続く間は間隔を倍々に延ばす（最大 STATUS_POLL_SLOW）
+                interval = min(STATUS_POLL_FAST * 2 ** (failures - 1), STATUS_POLL_SLOW)
+            elif last_state in ('STATE_STARTING', 'STATE_STOPPING') or workstation_name in _autostarts:
+                # 自動開始を待っている間は、開始直後でまだ STOPPED の場合も短い間隔で確認する
+                interval = STATUS_POLL_FAST
+            else:
+                interval = STATUS_POLL_SLOW
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        if _status_watchers.get(workstation_name) is asyncio.current_task():
+            del _status_watchers[workstation_name]
+            _status_wakeups.pop(workstation_name, None)
+
+
+async def on_cleanup_status_watchers(app):
+    """状態監視タスクを停止"""
+    tasks = list(_status_watchers.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class AutoStartFailed(Exception):
+    """自動開始で RUNNING にならなかった（開始APIの失敗、想定外の状態、待ち時間の超過）"""
+
+    def __init__(self, reason: str, detail: str = ''):
+        super().__init__(detail or reason)
+        self.reason = reason
+
+
+class AutoStart:
+    """
+    停止中のWorkstation 1台分の自動開始
+    - 状態監視（watch_workstation_status）を購読し、STOPPED なら start_workstation を1回だけ呼ぶ
+    - 待っているリクエストは ready（Future）を共有し、RUNNING を検知した時点でまとめて再開する
+    - AUTOSTART_WAIT 秒で RUNNING にならなければ AutoStartFailed('timeout')（次のリクエストで新しく作り直す）
+    """
+
+    def __init__(self, workstation_name: str):
+        self.name = workstation_name
+        self.ready = asyncio.get_running_loop().create_future()
+        self.waiting = 0
+        self.created = time.monotonic()
+        self.start_requested = False
+        self.task = asyncio.create_task(self.run())
+
+    async def _handle(self, status: dict) -> bool:
+        """状態を1つ処理し、RUNNING なら True"""
+        state = status.get('state')
+        if state == 'STATE_RUNNING':
+            return True
+        if state == 'STATE_STOPPED' and not self.start_requested:
+            self.start_requested = True
+            result = await start_workstation(self.name)
+            AUTOSTARTS.inc(('ok' if result.get('success') else 'error',))
+            if not result.get('success'):
+                raise AutoStartFailed('start_failed', result.get('error', ''))
+            log(f"Auto-starting '{self.name}' on request", category='status', workstation=self.name)
+            invalidate_workstation_status(self.name)
+        elif state not in ('STATE_STOPPED', 'STATE_STARTING', 'STATE_STOPPING'):
+            raise AutoStartFailed('state', f"Workstation is {state}: {status.get('error', '')}")
+        return False
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + AUTOSTART_WAIT
+        subscriber = subscribe_workstation_status(self.name)
+        try:
+            # 監視タスクは変化したときだけ通知するため、最初の状態は自分で取得する
+            status = await get_cached_workstation_status(self.name)
+            started = False
+            while not await self._handle(status):
+                started = started or status.get('state') == 'STATE_STARTING'
+                status = await asyncio.wait_for(subscriber.get(), deadline - loop.time())
+            waited = time.monotonic() - self.created
+            _running_seen[self.name] = time.monotonic()
+            if started or self.start_requested:
+                schedule_warmup(self.name)
+            log(f"Workstation '{self.name}' is running after {waited:.1f}s, releasing {self.waiting} request(s)",
+                category='status', workstation=self.name)
+            self.ready.set_result(waited)
+        except asyncio.TimeoutError:
+            self.ready.set_exception(AutoStartFailed('timeout', f"not running after {AUTOSTART_WAIT:.0f}s"))
+        except AutoStartFailed as e:
+            self.ready.set_exception(e)
+        except Exception as e:
+            self.ready.set_exception(AutoStartFailed('error', repr(e)))
+        finally:
+            unsubscribe_workstation_status(self.name, subscriber)
+            if _autostarts.get(self.name) is self:
+                del _autostarts[self.name]
+            if self.ready.done() and not self.ready.cancelled() and self.ready.exception() is not None:
+                log(f"Auto-start for '{self.name}' failed: {self.ready.exception()}", category='status',
+                    level='WARNING', workstation=self.name)
+
+
+def is_navigation(request) -> bool:
+    """ブラウザのページ遷移（待たせずに開始中のページを返す）"""
+    if request.method != 'GET':
+        return False
+    mode = request.headers.get('Sec-Fetch-Mode')
+    if mode is not None:
+        return mode == 'navigate'
+    return 'text/html' in request.headers.get('Accept', '')
+
+
+def autostart_page(ws_name: str, state: str) -> web.Response:
+    page = AUTOSTART_HTML.format(
+        workstation=html.escape(ws_name),
+        state=html.escape(state),
+        events_url=html.escape(f"/status/{ws_name}/events"),
+        status_url=html.escape(f"/status/{ws_name}"),
+    )
+    return web.Response(status=503, text=page, content_type='text/html',
+                        headers={'Retry-After': '5', 'Cache-Control': 'no-store'})
+
+
+async def ensure_running(request, ws_name: str) -> web.Response:
+    """
+    自動開始: Workstationが RUNNING でなければ開始して待つ
+    RUNNING なら None、待てない場合（ページ遷移・待ち行列の超過・失敗）は返すレスポンス
+    状態が取得できない・見つからない場合は None（従来どおり転送して上流のエラーを返す）
+    """
+    seen = _running_seen.get(ws_name)
+    if seen is not None and time.monotonic() - seen < AUTOSTART_TRUST:
+        return None
+    autostart = _autostarts.get(ws_name)
+    if autostart is None:
+        try:
+            status = await get_cached_workstation_status(ws_name)
+        except Exception as e:
+            log(f"Auto-start: status check failed for '{ws_name}': {e}", category='status', level='WARNING')
+            return None
+        state = status.get('state')
+        if state == 'STATE_RUNNING':
+            _running_seen[ws_name] = time.monotonic()
+            return None
+        if state not in ('STATE_STOPPED', 'STATE_STARTING', 'STATE_STOPPING'):
+            return None
+        autostart = _autostarts.get(ws_name)
+        if autostart is None:
+            autostart = _autostarts[ws_name] = AutoStart(ws_name)
+    else:
+        state = 'STATE_STARTING' if autostart.start_requested else 'STATE_STOPPED'
+
+    if is_navigation(request):
+        AUTOSTART_REQUESTS.inc(('interstitial',))
+        return autostart_page(ws_name, state)
+    if autostart.waiting >= AUTOSTART_QUEUE:
+        AUTOSTART_REQUESTS.inc(('queue_full',))
+        return web.Response(status=503, text=f"Workstation '{ws_name}' is starting, retry shortly",
+                            headers={'Retry-After': str(ADMISSION_RETRY_AFTER)})
+
+    start = time.monotonic()
+    autostart.waiting += 1
+    try:
+        with timed('autostart'):
+            await asyncio.shield(autostart.ready)
+    except AutoStartFailed as e:
+        AUTOSTART_REQUESTS.inc((e.reason,))
+        return web.Response(status=503, text=f"Workstation '{ws_name}' did not start: {e}",
+                            headers={'Retry-After': str(ADMISSION_RETRY_AFTER)})
+    finally:
+        autostart.waiting -= 1
+    AUTOSTART_REQUESTS.inc(('released',))
+    AUTOSTART_WAIT_SECONDS.observe(time.monotonic() - start)
+    return None
+
+
+async def on_cleanup_autostarts(app):
+    """自動開始の待ちを停止"""
+    tasks = [autostart.task for autostart in _autostarts.values()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def status_state_class(state: str) -> str:
+    """状態に応じたCSSクラス"""
+    if state == 'STATE_RUNNING':
+        return 'state-running'
+    elif state == 'STATE_STOPPED':
+        return 'state-stopped'
+    elif state in ['STATE_STARTING', 'STATE_STOPPING']:
+        return 'state-starting'
+    return 'state-other'
+
+
+def render_status_parts(ws_name: str, status: dict) -> dict:
+    """ステータスページの状態依存部分を生成（ページ描画とSSEで共用）"""
+    state = status.get('state', 'UNKNOWN')
+    state_class = status_state_class(state)
+
+    # ボタン生成
+    if state == 'STATE_RUNNING':
+        button = f'''<form method="POST">
+            <input type="hidden" name="action" value="stop">
+            <button type="submit" class="btn-stop">Stop Workstation</button>
+        </form>'''
+    elif state == 'STATE_STOPPED':
+        button = f'''<form method="POST">
+            <input type="hidden" name="action" value="start">
+            <button type="submit" class="btn-start">Start Workstation</button>
+        </form>'''
+    elif state in ['STATE_STARTING', 'STATE_STOPPING']:
+        button = '<button class="btn-disabled" disabled>Processing...</button>'
+    else:
+        button = ''
+
+    # エラー表示
+    error_msg = f'<div class="error">{html.escape(status["error"])}</div>' if status.get('error') else ''
+
+    # STATE_RUNNINGの時のみWorkstationへのリンクを表示
+    if state == 'STATE_RUNNING':
+        open_link = f'<div style="margin-top: 1.5rem; font-size: 0.9rem;"><a href="/ws/{html.escape(ws_name)}/">Open Workstation</a></div>'
+    else:
+        open_link = ''
+
+    return {
+        "state": state,
+        "state_class": state_class,
+        "button": button,
+        "error": error_msg,
+        "open_link": open_link,
+    }
+
+
+async def handle_status_events(request):
+    """Workstationの状態変化をServer-Sent Eventsで配信"""
+    ws_name = request.match_info.get('name')
+    stream = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    await stream.prepare(request)
+
+    async def send_status(status):
+        data = json.dumps(render_status_parts(ws_name, status))
+        await stream.write(f"event: status\ndata: {data}\n\n".encode())
+
+    subscriber = subscribe_workstation_status(ws_name)
+    try:
+        # 監視タスクは変化したときだけ通知するため、接続直後に現在の状態を送る（取得できなければ次の通知まで待つ）
+        try:
+            status = await get_cached_workstation_status(ws_name)
+        except Exception as e:
+            log(f"Status events: initial status failed for '{ws_name}': {e}", category='status', level='WARNING')
+        else:
+            await send_status(status)
+        while True:
+            try:
+                status = await asyncio.wait_for(subscriber.get(), timeout=STATUS_EVENTS_HEARTBEAT)
+            except asyncio.TimeoutError:
+                # コメント行でキープアライブ
+                await stream.write(b": keepalive\n\n")
+                continue
+            await send_status(status)
+    except ConnectionResetError:
+        pass
+    finally:
+        # キャンセル（クライアント切断・シャットダウン）はそのまま伝える。購読の解除だけはここで必ず行う
+        unsubscribe_workstation_status(ws_name, subscriber)
+    return stream
+
+
+def is_cross_site(request) -> bool:
+    """
+    別サイトのページから送られたPOSTか（CSRF対策）
+    Sec-Fetch-Site があればそれで、なければ Origin と Host を比べる。どちらもなければ（curl など）同一とみなす
+    """
+    site = request.headers.get('Sec-Fetch-Site')
+    if site is not None:
+        cross = site not in ('same-origin', 'none')
+    else:
+        origin = request.headers.get('Origin')
+        cross = origin is not None and origin.partition('://')[2] != request.host
+    if cross:
+        log(f"Rejected cross-site {request.method} {request.path} "
+            f"(Sec-Fetch-Site: {site}, Origin: {request.headers.get('Origin')})", category='status', level='WARNING')
+    return cross
+
+
+async def handle_status(request):
+    """Workstationのステータスページを表示"""
+    ws_name = request.match_info.get('name')
+    if not ws_name:
+        return web.Response(status=400, text="Workstation name required")
+
+    message = ""
+    error_msg = ""
+    action_performed = None  # 実行したアクションを記録
+
+    # POST: 開始/停止アクション
+    if request.method == 'POST':
+        if is_cross_site(request):
+            return web.Response(status=403, text="Cross-site request rejected")
+        # まず現在の状態を取得（キャッシュ経由）
+        current_status = await get_cached_workstation_status(ws_name)
+        current_state = current_status.get('state', 'UNKNOWN')
+
+        data = await request.post()
+        action = data.get('action')
+
+        # 遷移中（STARTING/STOPPING）の場合はアクションを無視
+        if current_state in ['STATE_STARTING', 'STATE_STOPPING']:
+            log(f"Ignoring action '{action}' - workstation is in transitional state: {current_state}", category='status')
+        # 状態と矛盾するアクションは無視（例: RUNNING中にstart）
+        elif action == 'start' and current_state == 'STATE_RUNNING':
+            log("Ignoring start action - workstation is already running", category='status')
+        elif action == 'stop' and current_state == 'STATE_STOPPED':
+            log("Ignoring stop action - workstation is already stopped", category='status')
+        elif action == 'start' and current_state == 'STATE_STOPPED':
+            result = await start_workstation(ws_name)
+            invalidate_workstation_status(ws_name)
+            if result.get('success'):
+                action_performed = 'start'
+            else:
+                error_msg = f'<div class="error">Failed to start: {html.escape(result.get("error", "Unknown error"))}</div>'
+        elif action == 'stop' and current_state == 'STATE_RUNNING':
+            result = await stop_workstation(ws_name)
+            invalidate_workstation_status(ws_name)
+            if result.get('success'):
+                action_performed = 'stop'
+            else:
+                error_msg = f'<div class="error">Failed to stop: {html.escape(result.get("error", "Unknown error"))}</div>'
+
+    log(f"Status page for workstation: {ws_name}", category='status', level='DEBUG')
+    status = await get_cached_workstation_status(ws_name)
+
+    state = status.get('state', 'UNKNOWN')
+
+    # アクション実行後、状態に応じてメッセージを表示
+    # 既に目標状態に達している場合はメッセージを表示しない
+    if action_performed == 'start' and state != 'STATE_RUNNING':
+        message = '<div class="message">Starting workstation...</div>'
+    elif action_performed == 'stop' and state != 'STATE_STOPPED':
+        message = '<div class="message">Stopping workstation...</div>'
+
+    parts = render_status_parts(ws_name, status)
+
+    page = STATUS_HTML.format(
+        workstation=html.escape(ws_name),
+        state=html.escape(state),
+        state_class=parts['state_class'],
+        host=html.escape(status.get('host', '')),
+        error=error_msg or parts['error'],
+        message=message,
+        button=parts['button'],
+        open_link=parts['open_link']
+    )
+    return web.Response(text=page, content_type='text/html')
+
+
+async def handle_status_index(request):
+    """全Workstationの一覧ページ（チェックしたものを一括で開始/停止）"""
+    message = ""
+    error_msg = ""
+
+    # POST: 一括開始/停止
+    if request.method == 'POST':
+        if is_cross_site(request):
+            return web.Response(status=403, text="Cross-site request rejected")
+        data = await request.post()
+        action = data.get('action')
+        names = data.getall('name', [])[:BATCH_MAX]
+        if action in ('start', 'stop') and names:
+            results = await batch_workstation_action(action, names)
+            succeeded = [name for name, result in results.items() if result.get('success')]
+            failed = [name for name, result in results.items() if result.get('error')]
+            if succeeded:
+                verb = 'Starting' if action == 'start' else 'Stopping'
+                message = f'<div class="message">{verb}: {html.escape(", ".join(succeeded))}</div>'
+            if failed:
+                error_msg = f'<div class="error">Failed to {action}: {html.escape(", ".join(failed))}</div>'
+
+    try:
+        listing = await get_cached_workstation_list()
+        workstations = listing["workstations"]
+    except Exception as e:
+        log(f"Failed to list workstations: {e}", category='status', level='WARNING')
+        workstations = []
+        error_msg = f'<div class="error">Failed to list workstations: {html.escape(str(e))}</div>'
+
+    rows = '\n'.join(
+        STATUS_INDEX_ROW.format(
+            workstation=html.escape(ws["workstation"]),
+            state=html.escape(ws["state"]),
+            state_class=status_state_class(ws["state"]),
+            hidden='' if ws["state"] == 'STATE_RUNNING' else ' hidden',
+        )
+        for ws in workstations
+    )
+    page = STATUS_INDEX_HTML.format(
+        cluster=html.escape(', '.join(dict.fromkeys(c.cluster for c in _registry.configs))),
+        config=html.escape(', '.join(dict.fromkeys(c.config for c in _registry.configs))),
+        error=error_msg,
+        message=message,
+        rows=rows,
+        refresh_ms=int(max(STATUS_LIST_TTL, 1) * 1000),
+    )
+    return web.Response(text=page, content_type='text/html')
+
+
+async def handle_api_workstations(request):
+    """全WorkstationをJSONで返す（If-None-Match が一致すれば 304）"""
+    try:
+        listing = await get_cached_workstation_list()
+    except Exception as e:
+        log(f"Failed to list workstations: {e}", category='status', level='WARNING')
+        return web.json_response({"error": str(e)}, status=502)
+    headers = {'ETag': listing["etag"], 'Cache-Control': 'no-cache'}
+    if request.headers.get('If-None-Match') == listing["etag"]:
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=listing["body"], content_type='application/json', headers=headers)
+
+
+async def handle_api_workstations_batch(request):
+    """
+    一括開始/停止: POST /api/workstations/{start|stop}
+    本文 {"workstations": ["name", ...]}、Workstationごとの結果を返す
+    """
+    if is_cross_site(request):
+        return web.json_response({"error": "Cross-site request rejected"}, status=403)
+    action = request.match_info['action']
+    if action not in ('start', 'stop'):
+        return web.json_response({"error": f"Unknown action: {action}"}, status=404)
+    try:
+        names = (await request.json())["workstations"]
+    except (ValueError, KeyError, TypeError):
+        return web.json_response({"error": 'Body must be {"workstations": [...]}'}, status=400)
+    if not isinstance(names, list) or not all(isinstance(name, str) and name for name in names):
+        return web.json_response({"error": "workstations must be a list of names"}, status=400)
+    if len(names) > BATCH_MAX:
+        return web.json_response({"error": f"At most {BATCH_MAX} workstations per request"}, status=400)
+    try:
+        results = await batch_workstation_action(action, list(dict.fromkeys(names)))
+    except Exception as e:
+        log(f"Batch {action} failed: {e}", category='status', level='WARNING')
+        return web.json_response({"error": str(e)}, status=502)
+    return web.json_response({"action": action, "results": results})
+
+
+async def health_check(request):
+    """ヘルスチェックエンドポイント"""
+    return web.Response(text="OK")
+
+
+async def readiness_check(request):
+    """起動/レディネスプローブ（GCPトークン・SSLコンテキスト・登録簿の最初の一覧の準備ができるまで 503）"""
+    if _startup["ready"] is None:
+        return web.Response(status=503, text="Starting")
+    return web.Response(text="READY")
+
+
+def process_age() -> float:
+    """プロセス開始（exec）からの経過秒数（/proc から取得。取得できなければ None）"""
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+async def warm_credentials():
+    """
+    ポートを開いた直後にバックグラウンドで上流の認証情報を準備
+    - SSLコンテキスト（CAバンドルの読み込み）はスレッドで作成
+    - GCPトークンを取得（失敗したら間隔を延ばして再試行）
+    - 登録簿の最初の一覧を待つ（最大 REGISTRY_READY_TIMEOUT 秒）
+    完了したら /ready が 200 を返し、起動の各段階の時間を記録する
+    """
+    await asyncio.to_thread(get_ssl_context)
+    delay = 0.5
+    while STARTUP_PREFETCH_TOKEN:
+        try:
+            await get_gcp_access_token()
+            break
+        except Exception as e:
+            log(f"Startup token prefetch failed: {e}; retrying in {delay:.1f}s", category='token', level='WARNING')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 10)
+    if REGISTRY_ENABLED and REGISTRY_REFRESH_INTERVAL > 0:
+        # 再起動直後の再接続が、登録簿にない名前の問い合わせ（上限あり）に集中しないよう最初の一覧を待つ
+        try:
+            await asyncio.wait_for(_registry.filled.wait(), REGISTRY_READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            log(f"Workstation registry not filled after {REGISTRY_READY_TIMEOUT:g}s; serving anyway",
+                category='status', level='WARNING')
+    _startup["ready"] = time.monotonic()
+
+    phases = {"import": _import_finished, "bind": _startup["bound"], "ready": _startup["ready"]}
+    for phase, at in phases.items():
+        if at is not None:
+            STARTUP_SECONDS.set(at - _boot_started, (phase,))
+    age = process_age()
+    if age is not None:
+        STARTUP_SECONDS.set(age, ('process',))
+    timings = {f"{phase}_ms": round((at - _boot_started) * 1000) for phase, at in phases.items() if at is not None}
+    log("Ready: " + ", ".join(f"{k} {v}" for k, v in timings.items())
+        + (f" (process age {age * 1000:.0f}ms)" if age is not None else ""), **timings)
+
+
+async def on_startup_credentials(app):
+    """認証情報の事前準備を開始（ポートの待ち受けは待たせない）"""
+    app[STARTUP_KEY] = asyncio.create_task(warm_credentials())
+
+
+async def on_cleanup_credentials(app):
+    task = app.get(STARTUP_KEY)
+    if task is not None and not task.done():
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+def bind_socket(reuse_port: bool = False) -> socket.socket:
+    """
+    待ち受けソケットを先に作成
+    アプリの初期化より前にポートを開き、その間の接続はバックログで待たせる
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('0.0.0.0', PORT))
+    sock.listen(1024)
+    sock.setblocking(False)
+    _startup["bound"] = time.monotonic()
+    return sock
+
+
+class AdmissionRejected(Exception):
+    """受付制御で拒否（503 + Retry-After を返す）"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class AdmissionController:
+    """
+    キー（Workstation名 + IAPユーザー）ごとの同時実行数の制御
+    - 全体の上限とキーごとの上限の両方を満たすときだけ即時に受け付ける
+    - 受け付けられないリクエストはキーごとの待ち行列に入り、空きが出たらキーを順番に回して1件ずつ受け付ける
+      （1つのキーが大量に待っていても、他のキーの待ち時間は増えない）
+    - 待ち行列が上限を超えたとき・待ち時間が上限を超えたときは AdmissionRejected
+    """
+
+    def __init__(self, kind: str, max_active: int, per_key: int, queue_limit: int, timeout: float):
+        self.kind = kind
+        self.max_active = max_active
+        self.per_key = per_key
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self.active = 0
+        self.active_by_key = {}  # {key: 実行中の件数}
+        self.waiters = {}  # {key: deque(Future)}
+        self.rotation = deque()  # 待ちのあるキー（この順に受け付ける）
+
+    def _can_run(self, key) -> bool:
+        return self.active < self.max_active and self.active_by_key.get(key, 0) < self.per_key
+
+    def _grant(self, key):
+        self.active += 1
+        self.active_by_key[key] = self.active_by_key.get(key, 0) + 1
+
+    def queued(self) -> int:
+        return sum(len(w) for w in self.waiters.values())
+
+    async def acquire(self, key) -> float:
+        """受け付けられるまで待ち、待った秒数を返す"""
+        if not self.waiters.get(key) and self._can_run(key):
+            self._grant(key)
+            return 0.0
+        waiters = self.waiters.setdefault(key, deque())
+        if len(waiters) >= self.queue_limit:
+            raise AdmissionRejected('queue_full' if self.queue_limit else 'limit')
+        if not waiters:
+            self.rotation.append(key)
+        future = asyncio.get_running_loop().create_future()
+        waiters.append(future)
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self._forget(key, future)
+            raise AdmissionRejected('timeout') from None
+        except asyncio.CancelledError:
+            # クライアントの切断など。受け付けと同時にキャンセルされた場合は枠を返す
+            if future.done() and not future.cancelled():
+                self.release(key)
+            else:
+                self._forget(key, future)
+            raise
+        return time.monotonic() - start
+
+    def _forget(self, key, future):
+        waiters = self.waiters.get(key)
+        if waiters and future in waiters:
+            waiters.remove(future)
+        if not waiters:
+            self.waiters.pop(key, None)
+            if key in self.rotation:
+                self.rotation.remove(key)
+
+    def release(self, key):
+        self.active -= 1
+        count = self.active_by_key[key] - 1
+        if count:
+            self.active_by_key[key] = count
+        else:
+            del self.active_by_key[key]
+        self._dispatch()
+
+    def _dispatch(self):
+        """空いた枠を待ちのあるキーに順番に割り当てる（キーごとの上限に達しているキーは飛ばす）"""
+        skipped = 0
+        while self.rotation and self.active < self.max_active and skipped < len(self.rotation):
+            key = self.rotation[0]
+            self.rotation.rotate(-1)
+            if self.active_by_key.get(key, 0) >= self.per_key:
+                skipped += 1
+                continue
+            skipped = 0
+            waiters = self.waiters[key]
+            future = waiters.popleft()
+            if not waiters:
+                del self.waiters[key]
+                self.rotation.remove(key)
+            if not future.done():
+                self._grant(key)
+                future.set_result(None)
+
+
+class BandwidthShare:
+    """
+    ストリーミング送信の帯域を転送中のキーで均等に分ける（トークンバケット）
+    BANDWIDTH_LIMIT が 0 なら何もしない
+    開いているだけで送っていないキー（アイドルのWebSocketなど）は頭数に入れない
+    """
+
+    # 直近この秒数内に送ったキーだけを「転送中」として数える
+    ACTIVE_WINDOW = 1.0
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.buckets = {}  # {key: {"tokens": float, "updated": float, "used": float, "streams": int}}
+
+    def open(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = {"tokens": 0.0, "updated": time.monotonic(), "used": 0.0, "streams": 0}
+        bucket["streams"] += 1
+
+    def close(self, key):
+        bucket = self.buckets[key]
+        bucket["streams"] -= 1
+        if not bucket["streams"]:
+            del self.buckets[key]
+
+    async def consume(self, key, size: int, label: str):
+        """size バイト送る前に呼ぶ。キーの取り分を超えていればその分だけ待つ"""
+        if not self.limit:
+            return
+        bucket = self.buckets[key]
+        now = time.monotonic()
+        bucket["used"] = now
+        active = sum(1 for b in self.buckets.values() if now - b["used"] < self.ACTIVE_WINDOW)
+        rate = self.limit / active
+        # 一度に溜められるのは約0.1秒分（長く止まっていたストリームが一気に送らないように）
+        burst = max(rate * 0.1, STREAM_CHUNK_SIZE)
+        bucket["tokens"] = min(burst, bucket["tokens"] + (now - bucket["updated"]) * rate) - size
+        bucket["updated"] = now
+        if bucket["tokens"] < 0:
+            delay = -bucket["tokens"] / rate
+            BANDWIDTH_DELAY.inc((label,), delay)
+            await asyncio.sleep(delay)
+
+
+_http_admission = AdmissionController('http', ADMISSION_MAX_ACTIVE, ADMISSION_PER_KEY,
+                                      ADMISSION_QUEUE_PER_KEY, ADMISSION_QUEUE_TIMEOUT)
+# WebSocketは長時間つながるため待たせず、上限を超えたら即503
+_websocket_admission = AdmissionController('websocket', ADMISSION_MAX_WEBSOCKETS, ADMISSION_WEBSOCKETS_PER_KEY,
+                                           0, 0)
+_bandwidth = BandwidthShare(BANDWIDTH_LIMIT)
+
+
+def admission_key(request, ws_name: str) -> tuple:
+    """受付制御のキー（IAPのユーザーが分かればWorkstation名と組み合わせる）"""
+    return (ws_name, request.headers.get('X-Goog-Authenticated-User-Email', ''))
+
+
+def admission_rejected(kind: str, ws_name: str, reason: str) -> web.Response:
+    ADMISSION_REJECTED.inc((kind, reason))
+    log(f"Admission rejected ({kind}, {reason}) for {ws_name}", category='proxy', level='WARNING',
+        workstation=ws_name)
+    return web.Response(status=503, text="Too many requests for this workstation, retry shortly",
+                        headers={'Retry-After': str(ADMISSION_RETRY_AFTER)})
+
+
+class MemoryCharge:
+    """
+    1つの接続（HTTPリクエスト・WebSocket）が保持しているメモリの推定値
+    add() で加減算すると MemoryGovernor のサブシステムごとの合計にも反映される
+    """
+
+    __slots__ = ('governor', 'subsystem', 'workstation', 'bytes', 'started', 'last_active', 'on_idle')
+
+    def __init__(self, governor, subsystem: str, workstation: str, size: int, on_idle=None):
+        self.governor = governor
+        self.subsystem = subsystem
+        self.workstation = workstation
+        self.bytes = 0
+        self.started = self.last_active = time.monotonic()
+        self.on_idle = on_idle  # アイドルタイムアウトで閉じるときに呼ぶコルーチン関数（WebSocketのみ）
+        self.add(size)
+
+    def add(self, size: int):
+        self.bytes += size
+        self.governor.usage[self.subsystem] += size
+
+    def close(self):
+        self.governor.usage[self.subsystem] -= self.bytes
+        self.bytes = 0
+        self.governor.charges.discard(self)
+
+
+class MemoryGovernor:
+    """
+    推定メモリ使用量の集計と予算の適用
+    - HTTPリクエスト・WebSocketは MemoryCharge で接続ごとに加減算（バッファしたボディ、キューのフレーム、圧縮の状態）
+    - セッション・トークン・状態キャッシュ・レスポンスキャッシュは件数/バイト数から都度見積もる
+    - 予算の MEMORY_SHED_RATIO を超えたら大きな転送とキャッシュへの保存を、予算を超えたらすべての新規リクエストを断る
+      （実行中の転送とWebSocketは切らない）
+    - 定期的にレスポンスキャッシュを縮め（予算超過時のみ）、アイドルなWebSocketとWorkstationのクライアントを閉じる
+    """
+
+    # 1件あたりの見積もり（バイト）
+    REQUEST_BYTES = 16 * 1024  # リクエスト/レスポンスのオブジェクト、ヘッダー、パーサーのバッファ
+    STREAM_BYTES = 2 * STREAM_CHUNK_SIZE  # ストリーミング中のチャンク + 送信バッファ
+    COMPRESSOR_BYTES = 300 * 1024  # zlib の圧縮状態（wbits=15 で約260KB）+ 伸長の窓
+    WEBSOCKET_BYTES = 64 * 1024 + (2 * COMPRESSOR_BYTES if WS_COMPRESS else 0)  # ブラウザ側とWorkstation側の両方
+    SESSION_BYTES = 512
+    TOKEN_BYTES = 2048
+    STATUS_BYTES = 1024
+    REGISTRY_BYTES = 1024  # WorkstationEntry（URLとヘッダーの雛形を含む）
+    TOP_CONNECTIONS = 20  # /debug/memory に表示する接続数
+
+    def __init__(self):
+        self.budget = 0  # 0 なら無制限（on_startup_memory_governor で設定）
+        self.usage = {"http": 0, "websocket": 0}
+        self.charges = set()
+        self.level = 'ok'  # 前回の確認時のレベル（変化をログに出す）
+        self.tasks = set()
+
+    def open(self, subsystem: str, workstation: str, size: int = 0, on_idle=None) -> MemoryCharge:
+        charge = MemoryCharge(self, subsystem, workstation, size, on_idle)
+        self.charges.add(charge)
+        return charge
+
+    def breakdown(self) -> dict:
+        usage = dict(self.usage)
+        usage["sessions"] = len(_sessions) * self.SESSION_BYTES
+        usage["tokens"] = (len(_ws_token_cache) + 1) * self.TOKEN_BYTES
+        usage["status"] = len(_status_cache) * self.STATUS_BYTES + len(_workstation_list["body"] or b'')
+        usage["registry"] = (len(_registry.entries) + len(_registry.missing)) * self.REGISTRY_BYTES
+        usage["response_cache"] = _response_cache.memory_bytes()
+        return usage
+
+    def current_level(self) -> str:
+        """ok / shed（大きな転送を断る）/ over_budget（すべての新規リクエストを断る）"""
+        if not self.budget:
+            return 'ok'
+        total = sum(self.breakdown().values())
+        if total >= self.budget:
+            return 'over_budget'
+        if total >= self.budget * MEMORY_SHED_RATIO:
+            return 'shed'
+        return 'ok'
+
+    def check(self, large: bool) -> str:
+        """新規の受け付けを断る理由（受け付けられるなら None）"""
+        level = self.current_level()
+        if level == 'over_budget':
+            return level
+        if level == 'shed' and large:
+            return 'large_transfer'
+        return None
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def tick(self):
+        """使用量の確認、キャッシュの縮小、アイドル接続の回収"""
+        level = self.current_level()
+        if level != self.level:
+            log(f"Memory level changed: {self.level} -> {level}", category='memory',
+                level='INFO' if level == 'ok' else 'WARNING', budget=self.budget, usage=self.breakdown())
+            self.level = level
+        if level != 'ok':
+            # レスポンスキャッシュは取り直せるので、接続より先に手放す
+            freed = _response_cache.trim(_response_cache.memory_bytes() // 2)
+            if freed:
+                log(f"Trimmed response cache by {freed} bytes", category='memory', level='WARNING')
+
+        now = time.monotonic()
+        if WS_IDLE_TIMEOUT:
+            for charge in list(self.charges):
+                if charge.on_idle is not None and now - charge.last_active > WS_IDLE_TIMEOUT:
+                    on_idle, charge.on_idle = charge.on_idle, None
+                    IDLE_REAPED.inc(('websocket',))
+                    log(f"Closing idle WebSocket ({charge.workstation}, idle {now - charge.last_active:.0f}s)",
+                        category='memory', workstation=charge.workstation)
+                    self._spawn(on_idle())
+
+        if UPSTREAM_IDLE_TIMEOUT:
+            busy = {_registry.host(charge.workstation) for charge in self.charges}
+            for host, used in list(_ws_sessions_used.items()):
+                if now - used <= UPSTREAM_IDLE_TIMEOUT or host in busy:
+                    continue
+                del _ws_sessions_used[host]
+                session = _ws_sessions.pop(host, None)
+                if session is not None and not session.closed:
+                    IDLE_REAPED.inc(('upstream',))
+                    log(f"Closing idle upstream client for {host}", category='memory', level='DEBUG')
+                    self._spawn(session.close())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(MEMORY_CHECK_INTERVAL)
+            try:
+                self.tick()
+            except Exception as e:
+                log(f"Memory governor error: {e}", category='memory', level='ERROR',
+                    stack_trace=traceback.format_exc())
+
+    def update_metrics(self):
+        for subsystem, value in self.breakdown().items():
+            MEMORY_BYTES.set(value, (subsystem,))
+        rss = process_rss()
+        if rss is not None:
+            MEMORY_RSS.set(rss)
+
+    def snapshot(self) -> dict:
+        """/debug/memory の内容"""
+        now = time.monotonic()
+        usage = self.breakdown()
+        connections = {}
+        for charge in self.charges:
+            connections[charge.subsystem] = connections.get(charge.subsystem, 0) + 1
+        largest = sorted(self.charges, key=lambda c: c.bytes, reverse=True)[:self.TOP_CONNECTIONS]
+        return {
+            "budget": self.budget,
+            "shed_at": int(self.budget * MEMORY_SHED_RATIO),
+            "level": self.current_level(),
+            "total": sum(usage.values()),
+            "usage": usage,
+            "rss": process_rss(),
+            "container_limit": container_memory_limit(),
+            "connections": connections,
+            "largest": [
+                {"kind": c.subsystem, "workstation": c.workstation, "bytes": c.bytes,
+                 "age": round(now - c.started, 1), "idle": round(now - c.last_active, 1)}
+                for c in largest
+            ],
+            "shed": {f"{kind}/{reason}": int(n) for (kind, reason), n in MEMORY_SHED.values.items()},
+            "reaped": {kind: int(n) for (kind,), n in IDLE_REAPED.values.items()},
+        }
+
+
+_memory = MemoryGovernor()
+
+
+def process_rss() -> int:
+    """このプロセスのRSS（/proc がなければ None）"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def memory_budget() -> int:
+    """MEMORY_BUDGET の値（auto はコンテナのメモリ上限の半分をワーカー数で割る。上限が分からなければ 0 = 無制限）"""
+    if MEMORY_BUDGET.lower() != 'auto':
+        return int(MEMORY_BUDGET)
+    limit = container_memory_limit()
+    return limit // 2 // get_worker_count() if limit else 0
+
+
+def memory_rejected(kind: str, ws_name: str, reason: str) -> web.Response:
+    MEMORY_SHED.inc((kind, reason))
+    log(f"Memory budget: rejected {kind} ({reason}) for {ws_name}", category='memory', level='WARNING',
+        workstation=ws_name)
+    return web.Response(status=503, text="The proxy is low on memory, retry shortly",
+                        headers={'Retry-After': str(ADMISSION_RETRY_AFTER)})
+
+
+async def handle_debug_memory(request):
+    """推定メモリ使用量（サブシステム別・大きい接続）と予算の状態（PROFILE_TOKEN を X-Debug-Token ヘッダーで渡す）"""
+    check_debug_token(request)
+    return web.json_response(_memory.snapshot(), headers={'Cache-Control': 'no-store'})
+
+
+async def on_startup_memory_governor(app):
+    """メモリ予算を決めて、定期確認（キャッシュの縮小・アイドル接続の回収）を開始"""
+    _memory.budget = memory_budget()
+    log(f"Memory budget: {_memory.budget or 'unlimited'} (container limit: {container_memory_limit() or 'none'}, "
+        f"websocket idle timeout: {WS_IDLE_TIMEOUT or 'off'}, upstream idle timeout: {UPSTREAM_IDLE_TIMEOUT or 'off'})",
+        category='memory')
+    app[MEMORY_GOVERNOR_KEY] = asyncio.create_task(_memory.run())
+
+
+async def on_cleanup_memory_governor(app):
+    """定期確認を止め、回収中のクライアントを閉じ終えるのを待つ"""
+    task = app.get(MEMORY_GOVERNOR_KEY)
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    if _memory.tasks:
+        await asyncio.gather(*_memory.tasks, return_exceptions=True)
+
+
+class WebSocketRelay:
+    """
+    ブラウザ⇔Workstation間のWebSocket中継
+    - 方向ごとに読み込みと送信を別タスクにし、上限付きキュー（フレーム数・バイト数）でつなぐ
+      送信側が遅いとキューが埋まって読み込みが止まり、TCPのフロー制御で送信元が待たされる
+    - 片側が閉じたら、そのクローズコードを反対側に伝播
+    - 接続ごとにフレーム数・バイト数・キュー滞留時間を集計
+    - キューのバイト数と最後にメッセージを受け取った時刻をメモリ予算（MemoryGovernor）に報告
+    - トラフィックの記録が有効なら、受け取ったフレームの時刻・方向・サイズを frames に残す
+    - max_age 秒経ったら、再接続を促すコード（1012 Service Restart）で両側を閉じる
+    """
+
+    # 送信できないクローズコード（RFC 6455 7.4.1）
+    RESERVED_CLOSE_CODES = (1004, 1005, 1006, 1015)
+    # 最大寿命・終了時に閉じるコード（VS Code は 1006 と同様にすぐ再接続する）
+    RETIRE_CLOSE_CODE = 1012
+
+    def __init__(self, ws_server, ws_client, label: str = '', key: tuple = None, max_age: float = 0):
+        self.label = label
+        self.key = key  # 帯域の取り分のキー（Workstation→ブラウザ方向に適用）
+        self.upstream = self._direction('up', ws_server, ws_client)
+        self.downstream = self._direction('down', ws_client, ws_server)
+        self.close_code = None  # 中継側から閉じる場合に両側へ送るコード
+        self.charge = _memory.open('websocket', label, MemoryGovernor.WEBSOCKET_BYTES, on_idle=self.close_idle)
+        self.started = time.monotonic()
+        # [接続からのミリ秒, 方向 (0: ブラウザ→Workstation, 1: 逆), バイト数, テキストなら1]
+        self.frames = [] if _capture.alias(label) is not None else None
+        self.frames_dropped = 0
+        self.max_age = max_age
+        self.closing = None  # 中継側から閉じているタスク（最大寿命・終了時）
+
+    def _direction(self, name: str, source, dest) -> dict:
+        return {
+            "name": name,
+            "metric_labels": (workstation_label(self.label), name),
+            "shaped": name == 'down' and self.key is not None,
+            "source": source,
+            "dest": dest,
+            "queue": asyncio.Queue(maxsize=WS_QUEUE_FRAMES),
+            "queued_bytes": 0,
+            "space": asyncio.Event(),
+            "close_code": None,
+            "close_reason": '',
+            "frames": 0,
+            "bytes": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
+        }
+
+    async def _read(self, d: dict):
+        source = d["source"]
+        queue = d["queue"]
+        while True:
+            msg = await source.receive()
+            if msg.type in (WSMsgType.TEXT, WSMsgType.BINARY):
+                size = len(msg.data)
+                # バイト数の上限（1フレームが上限を超える場合はキューが空になるまで待つ）
+                while d["queued_bytes"] and d["queued_bytes"] + size > WS_QUEUE_BYTES:
+                    d["space"].clear()
+                    await d["space"].wait()
+                d["queued_bytes"] += size
+                now = time.monotonic()
+                self.charge.add(size)
+                self.charge.last_active = now
+                item = (msg.type, msg.data, now)
+                if self.frames is not None:
+                    if len(self.frames) < CAPTURE_WS_FRAMES:
+                        self.frames.append([round((now - self.started) * 1000), int(d["name"] == 'down'), size,
+                                            int(msg.type == WSMsgType.TEXT)])
+                    else:
+                        self.frames_dropped += 1
+                if queue.full():
+                    await queue.put(item)
+                else:
+                    queue.put_nowait(item)
+            elif msg.type == WSMsgType.CLOSE:
+                d["close_code"] = msg.data
+                d["close_reason"] = msg.extra or ''
+                break
+            elif msg.type == WSMsgType.ERROR:
+                log(f"WebSocket {d['name']} error ({self.label}): {source.exception()}", category='websocket', level='WARNING')
+                d["close_code"] = 1011
+                break
+            elif msg.type in (WSMsgType.CLOSING, WSMsgType.CLOSED):
+                d["close_code"] = source.close_code
+                break
+        await queue.put(None)
+
+    async def _write(self, d: dict):
+        dest = d["dest"]
+        queue = d["queue"]
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            msg_type, data, enqueued = item
+            if d["shaped"]:
+                await _bandwidth.consume(self.key, len(data), d["metric_labels"][0])
+            # aiohttp は送信バッファが上限を超えたときだけ drain するので、小さいフレームが続いても毎回は待たない
+            if msg_type == WSMsgType.TEXT:
+                await dest.send_str(data)
+            else:
+                await dest.send_bytes(data)
+            latency = time.monotonic() - enqueued
+            d["frames"] += 1
+            d["bytes"] += len(data)
+            WS_BYTES.inc(d["metric_labels"], len(data))
+            d["latency_total"] += latency
+            d["latency_max"] = max(d["latency_max"], latency)
+            d["queued_bytes"] -= len(data)
+            self.charge.add(-len(data))
+            d["space"].set()
+
+    async def _pump(self, d: dict):
+        """1方向の中継（読み込みと送信を並行実行、どちらかが失敗したら両方止める）"""
+        tasks = [asyncio.create_task(self._read(d)), asyncio.create_task(self._write(d))]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors:
+            if d["close_code"] is None:
+                d["close_code"] = 1011
+            log(f"WebSocket {d['name']} relay error ({self.label}): {errors[0]!r}", category='websocket', level='WARNING')
+
+    def _sendable_close_code(self, code) -> int:
+        if code is None or code == 1005:
+            return 1000
+        if code in self.RESERVED_CLOSE_CODES or not 1000 <= code < 5000:
+            return 1011
+        return code
+
+    async def run(self):
+        """どちらかが閉じるまで中継し、クローズコードを反対側に伝播"""
+        tasks = {
+            asyncio.create_task(self._pump(self.upstream)): self.upstream,
+            asyncio.create_task(self._pump(self.downstream)): self.downstream,
+        }
+        expiry = None
+        if self.max_age:
+            expiry = asyncio.get_running_loop().call_later(self.max_age, self.retire, 'max_age')
+        _ws_relays.add(self)
+        if _ws_drain is not None:
+            # 終了処理の開始後にハンドシェイクが終わったものはすぐ閉じる
+            self.retire('drain')
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            finished = tasks[next(iter(done))]
+            code = self.close_code or self._sendable_close_code(finished["close_code"])
+            # 反対側を閉じると、その読み込み側は CLOSING を受け取って終了する
+            await finished["dest"].close(code=code, message=finished["close_reason"].encode()[:123])
+            if pending:
+                await asyncio.wait(pending, timeout=5)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if expiry is not None:
+                expiry.cancel()
+            _ws_relays.discard(self)
+            self.charge.close()
+            WS_LIFETIME.observe(time.monotonic() - self.started)
+
+    async def close_from_proxy(self, code: int, reason: str):
+        """ブラウザ側を code で閉じる（Workstation側には run() が同じコードを伝播）"""
+        self.close_code = code
+        self.upstream["close_reason"] = reason
+        await self.upstream["source"].close(code=code, message=reason.encode())
+
+    async def close_idle(self):
+        """アイドルタイムアウト: 1001 で閉じる"""
+        await self.close_from_proxy(1001, 'Idle timeout')
+
+    def retire(self, reason: str):
+        """最大寿命（max_age）・終了時（drain）: 1012 で閉じてクライアントに再接続させる"""
+        if self.closing is not None or self.close_code is not None:
+            return
+        WS_RETIRED.inc((reason,))
+        log(f"Retiring WebSocket ({self.label}, {reason}, open {time.monotonic() - self.started:.0f}s)",
+            category='websocket', level='DEBUG', workstation=self.label)
+        self.closing = asyncio.create_task(
+            self.close_from_proxy(self.RETIRE_CLOSE_CODE, 'Server draining' if reason == 'drain' else 'Max age'))
+
+    def summary(self) -> str:
+        """接続ごとの集計"""
+        parts = []
+        for d in (self.upstream, self.downstream):
+            avg_ms = d["latency_total"] / d["frames"] * 1000 if d["frames"] else 0
+            parts.append(
+                f"{d['name']}: {d['frames']} frames, {d['bytes']} bytes, "
+                f"queue latency avg {avg_ms:.1f}ms max {d['latency_max'] * 1000:.1f}ms, "
+                f"close code {d['close_code']}"
+            )
+        return '; '.join(parts)
+
+
+_ws_relays = set()  # 中継中の WebSocketRelay（終了時に少しずつ閉じる）
+_ws_drain = None  # drain_websockets() のタスク
+
+
+def websocket_max_age() -> float:
+    """接続ごとの寿命（WS_MAX_AGE から最大 WS_MAX_AGE_JITTER の割合だけランダムに短くする）"""
+    if not WS_MAX_AGE:
+        return 0
+    return WS_MAX_AGE * (1 - min(max(WS_MAX_AGE_JITTER, 0), 1) * random.random())
+
+
+def drain_websockets():
+    """
+    終了時: 中継中のWebSocketを WS_DRAIN_PERIOD 秒に散らして 1012 で閉じる
+    （新しいリビジョンへの再接続が一度に集中しないように。何度呼んでも1回だけ実行する）
+    """
+    global _ws_drain
+    if _ws_drain is None:
+        _ws_drain = asyncio.ensure_future(_drain_websockets())
+    return asyncio.shield(_ws_drain)
+
+
+async def _drain_websockets():
+    relays = list(_ws_relays)
+    if not relays:
+        return
+    random.shuffle(relays)
+    log(f"Draining {len(relays)} WebSocket(s) over {WS_DRAIN_PERIOD:g}s", category='websocket')
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    for i, relay in enumerate(relays):
+        delay = start + WS_DRAIN_PERIOD * i / len(relays) - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if relay in _ws_relays:
+            relay.retire('drain')
+
+
+async def on_shutdown_websockets(app):
+    """終了時（SIGTERM、待ち受けを閉じた後）にWebSocketを少しずつ閉じる"""
+    await drain_websockets()
+
+
+class HandshakeLimiter:
+    """
+    WorkstationごとのWebSocketハンドシェイクの速度制限（トークンバケット）
+    上限を超えたものは順番に待たせ、WS_HANDSHAKE_MAX_WAIT 秒より長く待つことになるものは断る
+    """
+
+    def __init__(self, rate: float, burst: int, max_wait: float):
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.buckets = {}  # {workstation_name: (トークン数, time.monotonic())} トークン数が負なら待っている数
+
+    def reserve(self, key: str):
+        """待つべき秒数を返す（断る場合は None）"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        tokens, at = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - at) * self.rate)
+        wait = (1 - tokens) / self.rate if tokens < 1 else 0.0
+        if wait > self.max_wait:
+            self.buckets[key] = (tokens, now)
+            return None
+        if key not in self.buckets and len(self.buckets) >= 4096:
+            # 満タンに戻ったバケットは初期状態と同じなので捨てる
+            self.buckets = {k: (t, a) for k, (t, a) in self.buckets.items()
+                            if t + (now - a) * self.rate < self.burst}
+        self.buckets[key] = (tokens - 1, now)
+        return wait
+
+
+_handshake_limiter = HandshakeLimiter(WS_HANDSHAKE_RATE, WS_HANDSHAKE_BURST, WS_HANDSHAKE_MAX_WAIT)
+
+
+@web.middleware
+async def session_middleware(request, handler):
+    """セッション管理ミドルウェア（静的リソースルーティング用）"""
+    response = await handler(request)
+    apply_session_cookie(request, response)
+    return response
+
+
+def apply_session_cookie(request, response):
+    """
+    新規/更新されたセッションのCookieをレスポンスに付与
+    ストリーミングレスポンスはハンドラー内でprepareされるため、prepare前に呼び出す
+    """
+    value = request.get('session_cookie')
+    if value and not response.prepared:
+        response.set_cookie('session', value, httponly=True, max_age=SESSION_DURATION)
 
 
 async def handle_websocket(request):
     """WebSocketプロキシ"""
-    log(f"WebSocket connection request: {request.path}")
+    log(f"WebSocket connection request: {request.path}", category='websocket', level='DEBUG')
 
     # パスからWorkstation名を抽出
     ws_name, actual_path = parse_workstation_path(request.path)
@@ -423,35 +3808,75 @@ async def handle_websocket(request):
         ws_name = get_last_workstation(request)
         actual_path = request.path  # パスはそのまま使用
         if ws_name is None:
-            log("WebSocket: Workstation name not found in path or session")
+            log("WebSocket: Workstation name not found in path or session", category='websocket', level='WARNING')
             return web.Response(status=400, text="Workstation name required. Use /ws/{name}/...")
 
-    # Workstationホスト名を動的に構築
-    workstation_host = f"{ws_name}.{CLUSTER_HOSTNAME}"
+    try:
+        entry = await _registry.resolve(ws_name)
+    except RegistryThrottled:
+        return registry_throttled(ws_name)
+    if entry is None:
+        return web.Response(status=404, text=f"Workstation '{ws_name}' not found")
+    request['workstation'] = ws_name
+    request['workstation_entry'] = entry
+    request['websocket'] = True
+
+    reason = _memory.check(large=False)
+    if reason is not None:
+        return memory_rejected('websocket', ws_name, reason)
+    if AUTOSTART_ENABLED:
+        # ハンドシェイク前に待つ（開始できなければ 503 を返し、IDEの再接続に任せる）
+        response = await ensure_running(request, ws_name)
+        if response is not None:
+            return response
+    # 再接続が集中しても、Workstationへのハンドシェイク（とトークン取得）はWorkstationごとに一定の速度まで
+    wait = _handshake_limiter.reserve(ws_name)
+    if wait is None:
+        WS_HANDSHAKES.inc(('rejected',))
+        return admission_rejected('websocket', ws_name, 'handshake_rate')
+    if wait:
+        WS_HANDSHAKES.inc(('delayed',))
+        WS_HANDSHAKE_DELAY.observe(wait)
+        await asyncio.sleep(wait)
+    else:
+        WS_HANDSHAKES.inc(('immediate',))
+    key = admission_key(request, ws_name)
+    if ADMISSION_ENABLED:
+        try:
+            await _websocket_admission.acquire(key)
+        except AdmissionRejected as e:
+            return admission_rejected('websocket', ws_name, e.reason)
+    try:
+        return await relay_websocket(request, ws_name, actual_path, key)
+    finally:
+        if ADMISSION_ENABLED:
+            _websocket_admission.release(key)
+
 
-    ws_server = web.WebSocketResponse()
+async def relay_websocket(request, ws_name: str, actual_path: str, key: tuple):
+    """ブラウザとのWebSocketを確立し、Workstationに接続して中継（受付制御の内側で実行）"""
+    entry = request['workstation_entry']
+    workstation_host = entry.host
+    ws_server = web.WebSocketResponse(max_msg_size=WS_MAX_MSG_SIZE, compress=WS_COMPRESS)
     await ws_server.prepare(request)
-    log("WebSocket server prepared")
+    log("WebSocket server prepared", category='websocket', level='DEBUG')
 
     try:
         # Workstationアクセストークン取得
-        token = await get_workstation_access_token(ws_name)
-        log(f"Got workstation token for WebSocket ({ws_name})")
+        with timed('token'):
+            token = await get_workstation_access_token(ws_name)
+        log(f"Got workstation token for WebSocket ({ws_name})", category='websocket', level='DEBUG')
 
         # Workstationへの接続URL
         path = actual_path
         if request.query_string:
             path = f"{path}?{request.query_string}"
-        ws_url = f"wss://{workstation_host}{path}"
-        log(f"Connecting to WebSocket: {ws_url}")
-
-        # ヘッダー準備（元のリクエストからCookie等を転送）
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Host": workstation_host,
-            # Originを正しいWorkstationホストに設定（重要）
-            "Origin": f"https://{workstation_host}",
-        }
+        ws_url = f"{entry.ws_base_url}{path}"
+        log(f"Connecting to WebSocket: {ws_url}", category='websocket', level='DEBUG')
+
+        # ヘッダー準備（Host と、正しいWorkstationホストの Origin（重要）は登録簿の雛形から。元のリクエストからCookie等を転送）
+        headers = dict(entry.ws_headers)
+        headers["Authorization"] = f"Bearer {token}"
 
         # Cookieを転送
         if 'Cookie' in request.headers:
@@ -462,84 +3887,505 @@ async def handle_websocket(request):
             if h in request.headers:
                 headers[h] = request.headers[h]
 
-        log(f"WebSocket headers: {list(headers.keys())}")
-
-        ssl_context = ssl.create_default_context()
-        timeout = aiohttp.ClientTimeout(total=3600)
+        if log_enabled('websocket', 'DEBUG'):
+            log(f"WebSocket headers: {list(headers.keys())}", category='websocket', level='DEBUG')
 
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            log("Attempting WebSocket connection to workstation...")
-            async with session.ws_connect(
-                ws_url,
-                headers=headers,
-                ssl=ssl_context,
-                heartbeat=30
-            ) as ws_client:
-                log("WebSocket connected to workstation!")
-
-                async def forward_to_client():
-                    try:
-                        async for msg in ws_client:
-                            if msg.type == WSMsgType.TEXT:
-                                await ws_server.send_str(msg.data)
-                            elif msg.type == WSMsgType.BINARY:
-                                await ws_server.send_bytes(msg.data)
-                            elif msg.type in (WSMsgType.CLOSE, WSMsgType.CLOSED):
-                                log("WebSocket client closed")
-                                break
-                            elif msg.type == WSMsgType.ERROR:
-                                log(f"WebSocket client error: {ws_client.exception()}")
-                                break
-                    except Exception as e:
-                        log(f"Error forwarding to client: {e}")
-
-                async def forward_to_server():
-                    try:
-                        async for msg in ws_server:
-                            if msg.type == WSMsgType.TEXT:
-                                await ws_client.send_str(msg.data)
-                            elif msg.type == WSMsgType.BINARY:
-                                await ws_client.send_bytes(msg.data)
-                            elif msg.type in (WSMsgType.CLOSE, WSMsgType.CLOSED):
-                                log("WebSocket server closed")
-                                break
-                            elif msg.type == WSMsgType.ERROR:
-                                log(f"WebSocket server error: {ws_server.exception()}")
-                                break
-                    except Exception as e:
-                        log(f"Error forwarding to server: {e}")
-
-                # 両方向のプロキシを並行実行
-                done, pending = await asyncio.wait(
-                    [
-                        asyncio.create_task(forward_to_client()),
-                        asyncio.create_task(forward_to_server())
-                    ],
-                    return_when=asyncio.FIRST_COMPLETED
-                )
+        session = get_workstation_session(workstation_host)
+        log("Attempting WebSocket connection to workstation...", category='websocket', level='DEBUG')
+        async with session.ws_connect(
+            ws_url,
+            headers=headers,
+            heartbeat=WS_HEARTBEAT,
+            max_msg_size=WS_MAX_MSG_SIZE,
+            compress=15 if WS_COMPRESS else 0,
+        ) as ws_client:
+            log("WebSocket connected to workstation!", category='websocket', level='DEBUG')
+            _running_seen[ws_name] = time.monotonic()
 
-                # 残りのタスクをキャンセル
-                for task in pending:
-                    task.cancel()
-                    try:
-                        await task
-                    except asyncio.CancelledError:
-                        pass
+            relay = WebSocketRelay(ws_server, ws_client, ws_name, key, max_age=websocket_max_age())
+            WS_ACTIVE.inc()
+            _bandwidth.open(key)
+            try:
+                await relay.run()
+            finally:
+                _bandwidth.close(key)
+                WS_ACTIVE.dec()
+                log(f"WebSocket relay stats ({ws_name}): {relay.summary()}", category='websocket', workstation=ws_name)
+                _capture.websocket(ws_name, actual_path, relay)
 
     except aiohttp.WSServerHandshakeError as e:
-        log(f"WebSocket handshake error: {e}")
+        _running_seen.pop(ws_name, None)
+        log(f"WebSocket handshake error: {e}", category='websocket', level='WARNING', workstation=ws_name)
     except Exception as e:
-        log(f"WebSocket error: {e}")
-        import traceback
-        traceback.print_exc()
+        _running_seen.pop(ws_name, None)
+        log(f"WebSocket error: {e}", category='websocket', level='ERROR', workstation=ws_name,
+            stack_trace=traceback.format_exc())
     finally:
         if not ws_server.closed:
             await ws_server.close()
-        log("WebSocket connection closed")
+        log("WebSocket connection closed", category='websocket', level='DEBUG')
 
     return ws_server
 
 
+async def read_request_body(request):
+    """
+    リクエストボディを取得
+    小さいボディ (STREAM_BUFFER_THRESHOLD以下) は bytes、それ以外は StreamReader をそのまま返す
+    ボディがなければ None
+    """
+    if not request.body_exists:
+        return None
+    if request.content_length is not None and request.content_length <= STREAM_BUFFER_THRESHOLD:
+        body = await request.read()
+        return body if body else None
+    return request.content
+
+
+def should_stream_response(request, resp) -> bool:
+    """上流レスポンスをストリーミングで返すべきか判定"""
+    if request.method == 'HEAD' or resp.status in (204, 304):
+        return False
+    if resp.content_type == 'text/event-stream':
+        return True
+    # Content-Lengthがない（chunked / long-poll）場合は逐次転送
+    if resp.content_length is None:
+        return True
+    return resp.content_length > STREAM_BUFFER_THRESHOLD
+
+
+async def iter_upstream_body(resp, prefix: list):
+    """上流レスポンスの本文をチャンクごとに返す（prefix はキャッシュの取得で先に読んだ分）"""
+    for chunk in prefix:
+        yield chunk
+    async for chunk in resp.content.iter_chunked(STREAM_CHUNK_SIZE):
+        yield chunk
+
+
+def copy_response_headers(resp, ws_name: str, workstation_host: str) -> CIMultiDict:
+    """上流レスポンスのヘッダーをコピー（Content-Encodingは上流の値をそのまま転送）"""
+    response_headers = CIMultiDict()
+    for key, value in resp.headers.items():
+        if key.lower() not in ('transfer-encoding', 'content-length'):
+            # Locationヘッダーの書き換え
+            if key.lower() == 'location':
+                if workstation_host in value:
+                    value = value.replace(f"https://{workstation_host}", f"/ws/{ws_name}")
+                # Google認証ページへのリダイレクトも抑制
+                if "workstations.cloud.google.com" in value:
+                    log(f"Blocked redirect to: {value}", category='proxy', level='WARNING')
+                    continue
+            response_headers.add(key, value)
+    return response_headers
+
+
+def choose_response_encoding(request, resp) -> str:
+    """
+    上流レスポンスをプロキシ側で圧縮する場合のエンコーディングを決定
+    圧縮しない場合は None
+    """
+    if not RESPONSE_COMPRESSION or request.method == 'HEAD' or resp.status != 200:
+        return None
+    # 上流で圧縮済みならそのまま転送（パススルー）
+    if resp.headers.get('Content-Encoding', 'identity').lower() != 'identity':
+        return None
+    if 'no-transform' in resp.headers.get('Cache-Control', ''):
+        return None
+    # SSEはイベント単位で届く必要があるため圧縮しない
+    content_type = resp.content_type
+    if content_type == 'text/event-stream' or not content_type.startswith(COMPRESSIBLE_TYPES):
+        return None
+    if resp.content_length is not None and resp.content_length < COMPRESSION_MIN_SIZE:
+        return None
+
+    accepted = set()
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        coding, _, params = item.strip().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(coding.strip().lower())
+    if 'br' in accepted and get_brotli() is not None:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+_brotli = False  # get_brotli() で読み込むまで False
+
+
+def get_brotli():
+    """brotli モジュール（オプション: インストールされていればbrで圧縮。起動を遅くしないよう最初に使うときに読み込む）"""
+    global _brotli
+    if _brotli is False:
+        try:
+            import brotli
+        except ImportError:
+            brotli = None
+        _brotli = brotli
+    return _brotli
+
+
+def get_compression_executor() -> ThreadPoolExecutor:
+    """圧縮用スレッドプールを取得（zlib/brotliはGILを解放するためイベントループを止めない）"""
+    global _compression_executor
+    if _compression_executor is None:
+        _compression_executor = ThreadPoolExecutor(
+            max_workers=COMPRESSION_THREADS,
+            thread_name_prefix='compress',
+        )
+    return _compression_executor
+
+
+class ResponseCompressor:
+    """レスポンスボディをチャンク単位で圧縮（圧縮処理はスレッドプールで実行）"""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = get_brotli().Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def _compress_sync(self, data: bytes, finish: bool) -> bytes:
+        if self.encoding == 'br':
+            out = self._compressor.process(data) if data else b''
+            return out + (self._compressor.finish() if finish else self._compressor.flush())
+        out = self._compressor.compress(data) if data else b''
+        return out + self._compressor.flush(zlib.Z_FINISH if finish else zlib.Z_SYNC_FLUSH)
+
+    async def compress(self, data: bytes, finish: bool = False) -> bytes:
+        """
+        データを圧縮して返す
+        finish=False の場合は同期フラッシュし、ストリーミング中も受信側で逐次展開できるようにする
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_compression_executor(), self._compress_sync, data, finish)
+
+
+def apply_compression_headers(response_headers: CIMultiDict, encoding: str):
+    """プロキシ側で圧縮したレスポンスのヘッダーを調整"""
+    response_headers['Content-Encoding'] = encoding
+    vary = response_headers.get('Vary')
+    if not vary:
+        response_headers['Vary'] = 'Accept-Encoding'
+    elif 'accept-encoding' not in vary.lower() and vary.strip() != '*':
+        response_headers['Vary'] = f"{vary}, Accept-Encoding"
+    # 圧縮後のボディは上流とバイト単位で一致しないため、強いETagは弱いETagに変換
+    etag = response_headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        response_headers['ETag'] = f"W/{etag}"
+
+
+class CacheBypass(Exception):
+    """
+    キャッシュ対象外のレスポンス（通常のプロキシ処理にフォールバック）
+    entry: 保存はしないが読み終えた本文（同時に待っていた同じWorkstationへのリクエストにもそのまま返す）
+    workstation: entry を取得したWorkstation（取得には最初のリクエストのトークンとCookieを使っている）
+    """
+
+    def __init__(self, entry: dict = None, workstation: str = None):
+        super().__init__()
+        self.entry = entry
+        self.workstation = workstation
+
+
+def release_cache_upstream(request):
+    """キャッシュの取得から引き渡されたが使われなかった上流レスポンスを閉じる"""
+    upstream = request.pop('cache_upstream', None)
+    if upstream is not None:
+        upstream[0].release()
+
+
+class ResponseCache:
+    """
+    静的リソース用レスポンスキャッシュ
+    - メモリ: バイト数上限付きLRU
+    - ディスク (CACHE_DIR設定時): メモリから追い出されたエントリを保存
+    エントリは {"status", "headers", "body", "etag", "last_modified", "fresh_until", "size"} のdict
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: str = '', disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()  # {key: entry}
+        self._bytes = 0
+        self._disk_index = OrderedDict()  # {key: size}
+        self._disk_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "revalidated": 0, "coalesced": 0,
+                      "stores": 0, "evictions": 0, "disk_hits": 0, "bypass": 0}
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, hashlib.sha256(key.encode()).hexdigest())
+
+    async def get(self, key: str):
+        """エントリを取得（メモリ → ディスクの順）"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return entry
+        if key in self._disk_index:
+            loop = asyncio.get_running_loop()
+            entry = await loop.run_in_executor(None, self._read_disk, key)
+            if entry is not None:
+                self.stats["disk_hits"] += 1
+                self.put(key, entry)
+            return entry
+        return None
+
+    def put(self, key: str, entry: dict):
+        """エントリを保存し、上限を超えたら古いものから追い出す"""
+        if entry["size"] > CACHE_MAX_ENTRY_BYTES:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old["size"]
+        self._entries[key] = entry
+        self._bytes += entry["size"]
+        self.trim(self.max_bytes)
+
+    def trim(self, max_bytes: int) -> int:
+        """メモリ上のエントリを max_bytes 以下になるまで古いものから追い出し、減ったバイト数を返す"""
+        before = self._bytes
+        while self._bytes > max_bytes and self._entries:
+            old_key, old_entry = self._entries.popitem(last=False)
+            self._bytes -= old_entry["size"]
+            self.stats["evictions"] += 1
+            if self.disk_dir:
+                self._spill_to_disk(old_key, old_entry)
+        return before - self._bytes
+
+    def memory_bytes(self) -> int:
+        return self._bytes
+
+    def _spill_to_disk(self, key: str, entry: dict):
+        """メモリから追い出したエントリをディスクへ（インデックス更新はループ上、ファイルI/Oはスレッドプール）"""
+        self._disk_bytes += entry["size"] - self._disk_index.pop(key, 0)
+        self._disk_index[key] = entry["size"]
+        removed = []
+        while self._disk_bytes > self.disk_max_bytes and self._disk_index:
+            old_key, size = self._disk_index.popitem(last=False)
+            self._disk_bytes -= size
+            removed.append(old_key)
+        if key in self._disk_index:
+            asyncio.get_running_loop().run_in_executor(None, self._write_disk, key, entry, removed)
+
+    def _read_disk(self, key: str):
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                meta_len = int.from_bytes(f.read(4), 'big')
+                meta = json.loads(f.read(meta_len))
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        meta["headers"] = CIMultiDict(meta["headers"])
+        meta["body"] = body
+        return meta
+
+    def _write_disk(self, key: str, entry: dict, removed: list):
+        for old_key in removed:
+            try:
+                os.remove(self._disk_path(old_key))
+            except OSError:
+                pass
+        meta = {k: v for k, v in entry.items() if k != "body"}
+        meta["headers"] = list(entry["headers"].items())
+        data = json.dumps(meta).encode()
+        try:
+            with open(self._disk_path(key), 'wb') as f:
+                f.write(len(data).to_bytes(4, 'big'))
+                f.write(data)
+                f.write(entry["body"])
+        except OSError as e:
+            log(f"Failed to write cache entry to disk: {e}", category='cache', level='WARNING')
+
+    def summary(self) -> dict:
+        """統計情報"""
+        return dict(self.stats, entries=len(self._entries), bytes=self._bytes,
+                    disk_entries=len(self._disk_index), disk_bytes=self._disk_bytes)
+
+
+_response_cache = ResponseCache(CACHE_MAX_BYTES, CACHE_DIR, CACHE_DISK_MAX_BYTES)
+
+
+def get_cache_key(request, config, actual_path: str) -> str:
+    """
+    キャッシュキーを生成
+    バージョン付きの静的パスは同じConfig（WorkstationConfig）内で共有、Accept-Encodingの違いは別エントリ
+    対象外のリクエストは None
+    """
+    if not RESPONSE_CACHE or request.method != 'GET' or 'Range' in request.headers:
+        return None
+    if not CACHE_PATH_PATTERN.match(actual_path):
+        return None
+    accept = request.headers.get('Accept-Encoding', '').lower()
+    encodings = ','.join(e for e in ('br', 'gzip') if e in accept)
+    path = f"{actual_path}?{request.query_string}" if request.query_string else actual_path
+    return f"{config.key}|{path}|{encodings}"
+
+
+def parse_freshness(cache_control: str) -> float:
+    """
+    Cache-Controlから鮮度（秒）を取得
+    保存不可の場合は None、毎回再検証が必要な場合は 0
+    """
+    directives = {}
+    for item in cache_control.lower().split(','):
+        name, _, value = item.strip().partition('=')
+        directives[name] = value.strip('"')
+    if 'no-store' in directives or 'private' in directives:
+        return None
+    if 'no-cache' in directives:
+        return 0
+    for name in ('s-maxage', 'max-age'):
+        if directives.get(name, '').isdigit():
+            return int(directives[name])
+    return 0
+
+
+async def fetch_cacheable(session, target_url: str, headers: dict, request, cache_key: str,
+                          cached: dict, ws_name: str, workstation_host: str) -> dict:
+    """
+    キャッシュ対象のリソースを上流から取得（既存エントリがあれば条件付きリクエストで再検証）
+    保存できないレスポンスは CacheBypass
+    """
+    headers = {k: v for k, v in headers.items()
+               if k.lower() not in ('if-none-match', 'if-modified-since', 'range', 'if-range')}
+    if cached is not None:
+        if cached["etag"]:
+            headers['If-None-Match'] = cached["etag"]
+        if cached["last_modified"]:
+            headers['If-Modified-Since'] = cached["last_modified"]
+
+    upstream_start = time.monotonic()
+    resp = await session.get(target_url, headers=headers, allow_redirects=False)
+    handed_off = False
+    try:
+        UPSTREAM_TTFB.observe(time.monotonic() - upstream_start, (workstation_label(ws_name),))
+        if CAPTURE_ENABLED:
+            request['upstream_ttfb'] = time.monotonic() - upstream_start
+        freshness = parse_freshness(resp.headers.get('Cache-Control', ''))
+
+        if resp.status == 304 and cached is not None:
+            _response_cache.stats["revalidated"] += 1
+            entry = dict(cached, fresh_until=time.time() + (freshness or 0))
+            _response_cache.put(cache_key, entry)
+            return entry
+
+        etag = resp.headers.get('ETag')
+        last_modified = resp.headers.get('Last-Modified')
+        # no-store/private・Set-Cookie 付きは他のリクエストと共有できない
+        shared = freshness is not None and 'Set-Cookie' not in resp.headers
+        cacheable = shared and resp.status == 200 and bool(freshness or etag or last_modified)
+
+        # 共有できない・大きすぎるレスポンスは、開いたままこのリクエスト（request）の通常のプロキシ処理に引き渡す
+        # （同時に待っていたリクエストはそれぞれ自分で取得する）
+        chunks = []
+        if shared and (resp.content_length is None or resp.content_length <= CACHE_MAX_ENTRY_BYTES):
+            size = 0
+            async for chunk in resp.content.iter_chunked(STREAM_CHUNK_SIZE):
+                size += len(chunk)
+                chunks.append(chunk)
+                if size > CACHE_MAX_ENTRY_BYTES:
+                    break
+            shared = size <= CACHE_MAX_ENTRY_BYTES
+        else:
+            shared = False
+        if not shared:
+            request['cache_upstream'] = (resp, chunks)
+            handed_off = True
+            raise CacheBypass()
+        body = b''.join(chunks)
+
+        response_headers = copy_response_headers(resp, ws_name, workstation_host)
+        encoding = choose_response_encoding(request, resp)
+        if encoding and len(body) >= COMPRESSION_MIN_SIZE:
+            body = await ResponseCompressor(encoding).compress(body, finish=True)
+            apply_compression_headers(response_headers, encoding)
+
+        entry = {
+            "status": resp.status,
+            "headers": response_headers,
+            "body": body,
+            "etag": etag,
+            "last_modified": last_modified,
+            "fresh_until": time.time() + freshness,
+            "size": len(body) + sum(len(k) + len(v) for k, v in response_headers.items()),
+        }
+        if not cacheable:
+            raise CacheBypass(entry, ws_name)
+        # メモリ予算に近づいている間はキャッシュに保存せず、このリクエストにだけ返す
+        if _memory.current_level() == 'ok':
+            _response_cache.put(cache_key, entry)
+            _response_cache.stats["stores"] += 1
+        return entry
+    finally:
+        if not handed_off:
+            resp.release()
+
+
+async def get_cached_response(session, target_url: str, headers: dict, request, cache_key: str,
+                              ws_name: str, workstation_host: str):
+    """
+    キャッシュからレスポンスを返す（期限切れは再検証、ミスは上流から取得）
+    同じキーの同時ミスは1回の上流リクエストにまとめる
+    キャッシュ対象外の場合は None（取得済みの上流レスポンスは request['cache_upstream'] に引き渡す）
+    """
+    cached = await _response_cache.get(cache_key)
+    if cached is not None and time.time() < cached["fresh_until"]:
+        _response_cache.stats["hits"] += 1
+        status = "HIT"
+        entry = cached
+    else:
+        flight_key = f"cache:{cache_key}"
+        if flight_key in _inflight:
+            _response_cache.stats["coalesced"] += 1
+        else:
+            _response_cache.stats["misses"] += 1
+        try:
+            entry = await single_flight(flight_key, lambda: fetch_cacheable(
+                session, target_url, headers, request, cache_key, cached, ws_name, workstation_host))
+            status = "REVALIDATED" if cached is not None and entry["body"] is cached["body"] else "MISS"
+        except CacheBypass as e:
+            _response_cache.stats["bypass"] += 1
+            # 保存されない本文は別のWorkstation向けの内容かもしれないので、同じWorkstationへのリクエストにだけ返す
+            if e.entry is None or e.workstation != ws_name:
+                return None
+            entry = e.entry
+            status = "BYPASS"
+        except asyncio.CancelledError:
+            # 取得は他の待機者のために続くため、このリクエストに引き渡される上流レスポンスは終わった時点で閉じる
+            task = _inflight.get(flight_key)
+            if task is not None:
+                task.add_done_callback(lambda _: release_cache_upstream(request))
+            else:
+                release_cache_upstream(request)
+            raise
+
+    response_headers = CIMultiDict(entry["headers"])
+    response_headers['X-Proxy-Cache'] = status
+
+    # クライアントの条件付きリクエスト
+    client_etag = request.headers.get('If-None-Match')
+    if client_etag and client_etag == response_headers.get('ETag'):
+        for key in ('Content-Encoding', 'Content-Type'):
+            response_headers.popall(key, None)
+        return web.Response(status=304, headers=response_headers)
+
+    return web.Response(status=entry["status"], headers=response_headers, body=entry["body"])
+
+
+async def on_cleanup_compression(app):
+    """圧縮用スレッドプールを停止"""
+    global _compression_executor
+    if _compression_executor is not None:
+        _compression_executor.shutdown(wait=False)
+        _compression_executor = None
+
+
 async def handle_request(request):
     """HTTPリクエストプロキシ"""
 
@@ -549,31 +4395,79 @@ async def handle_request(request):
 
     # パスからWorkstation名を抽出
     ws_name, actual_path = parse_workstation_path(request.path)
+    from_path = ws_name is not None
 
     # /ws/{name}/ 以外のパスの場合、セッションから最後のWorkstation名を取得
-    if ws_name is None:
+    if not from_path:
         ws_name = get_last_workstation(request)
         actual_path = request.path  # パスはそのまま使用
         if ws_name is None:
             return web.Response(status=400, text="Workstation name required. Use /ws/{name}/...")
-    else:
+
+    # 登録簿にない名前はWorkstationに問い合わせずに 404
+    try:
+        entry = await _registry.resolve(ws_name)
+    except RegistryThrottled:
+        return registry_throttled(ws_name)
+    if entry is None:
+        return web.Response(status=404, text=f"Workstation '{ws_name}' not found")
+    if from_path:
         # Workstation名をセッションに保存
         set_last_workstation(request, ws_name)
 
-    # Workstationホスト名を動的に構築
-    workstation_host = f"{ws_name}.{CLUSTER_HOSTNAME}"
+    workstation_host = entry.host
+    request['workstation'] = ws_name
+    request['workstation_entry'] = entry
+    report_warmup_use(ws_name)
 
-    log(f"HTTP {request.method} {request.path} -> {workstation_host}{actual_path}")
+    log(f"HTTP {request.method} {request.path} -> {workstation_host}{actual_path}", category='proxy', level='DEBUG')
+
+    # メモリ予算に近づいたら大きなアップロードから断る
+    reason = _memory.check(large=(request.content_length or 0) > MEMORY_LARGE_TRANSFER)
+    if reason is not None:
+        return memory_rejected('http', ws_name, reason)
+    if AUTOSTART_ENABLED:
+        response = await ensure_running(request, ws_name)
+        if response is not None:
+            return response
+    charge = request['memory'] = _memory.open('http', ws_name, MemoryGovernor.REQUEST_BYTES)
+    key = admission_key(request, ws_name)
+    try:
+        if not ADMISSION_ENABLED:
+            return await forward_request(request, ws_name, actual_path, key)
+        try:
+            with timed('admission'):
+                waited = await _http_admission.acquire(key)
+        except AdmissionRejected as e:
+            return admission_rejected('http', ws_name, e.reason)
+        ADMISSION_WAIT.observe(waited, (workstation_label(ws_name),))
+        try:
+            return await forward_request(request, ws_name, actual_path, key)
+        finally:
+            _http_admission.release(key)
+    finally:
+        # バッファしたボディは返した後に送信されるが、送信中の分は見積もりに含めない
+        charge.close()
+
+
+async def forward_request(request, ws_name: str, actual_path: str, key: tuple):
+    """Workstationへリクエストを転送（受付制御の内側で実行）"""
+    entry = request['workstation_entry']
+    workstation_host = entry.host
+    label = workstation_label(ws_name)
+    timing = request.get('timing')
+    charge = request['memory']
 
     try:
         # Workstationアクセストークン取得
-        token = await get_workstation_access_token(ws_name)
+        with timed('token'):
+            token = await get_workstation_access_token(ws_name)
 
         # プロキシ先URL
         path = actual_path
         if request.query_string:
             path = f"{path}?{request.query_string}"
-        target_url = f"https://{workstation_host}{path}"
+        target_url = f"{entry.base_url}{path}"
 
         # ヘッダー準備
         headers = {}
@@ -583,66 +4477,345 @@ async def handle_request(request):
 
         headers['Authorization'] = f"Bearer {token}"
         headers['Host'] = workstation_host
+        if timing is not None:
+            # トレースコンテキストを伝播（親はこのプロキシのクライアントスパン）
+            headers['traceparent'] = timing.traceparent()
 
-        # リクエストボディ
-        body = await request.read()
+        # リクエストボディ（小さい場合のみバッファリング、それ以外はストリーミング）
+        body = await read_request_body(request)
+        if body is not None and not isinstance(body, bytes) and request.content_length is not None:
+            headers['Content-Length'] = str(request.content_length)
+        if body is not None:
+            HTTP_BYTES.inc((label, 'up'), len(body) if isinstance(body, bytes) else request.content_length or 0)
+            charge.add(len(body) if isinstance(body, bytes) else MemoryGovernor.STREAM_BYTES)
 
-        ssl_context = ssl.create_default_context()
-        timeout = aiohttp.ClientTimeout(total=3600)
+        session = get_workstation_session(workstation_host)
 
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.request(
+        # 静的リソースはキャッシュから返す
+        cache_key = get_cache_key(request, entry.config, actual_path)
+        if cache_key is not None:
+            # ミス時はWorkstationからの取得を含む
+            with timed('cache'):
+                response = await get_cached_response(
+                    session, target_url, headers, request, cache_key, ws_name, workstation_host)
+            if response is not None:
+                HTTP_BYTES.inc((label, 'down'), response.content_length or 0)
+                return response
+
+        # キャッシュ対象外と分かった上流レスポンスはそのまま使う（もう一度取得しない。TTFBは記録済み）
+        upstream = request.pop('cache_upstream', None)
+        if upstream is not None:
+            resp, prefix = upstream
+            upstream_start = headers_received = time.monotonic()
+        else:
+            prefix = []
+            upstream_start = time.monotonic()
+            resp = await session.request(
                 method=request.method,
                 url=target_url,
                 headers=headers,
-                data=body if body else None,
-                ssl=ssl_context,
+                data=body,
                 allow_redirects=False
-            ) as resp:
-                # レスポンスヘッダー
-                response_headers = {}
-                for key, value in resp.headers.items():
-                    if key.lower() not in ('transfer-encoding', 'content-encoding', 'content-length'):
-                        # Locationヘッダーの書き換え
-                        if key.lower() == 'location':
-                            if workstation_host in value:
-                                value = value.replace(f"https://{workstation_host}", f"/ws/{ws_name}")
-                            # Google認証ページへのリダイレクトも抑制
-                            if "workstations.cloud.google.com" in value:
-                                log(f"Blocked redirect to: {value}")
-                                continue
-                        response_headers[key] = value
-
-                # レスポンスボディ
-                body = await resp.read()
+            )
+            headers_received = time.monotonic()
+            UPSTREAM_TTFB.observe(headers_received - upstream_start, (label,))
+            if CAPTURE_ENABLED:
+                request['upstream_ttfb'] = headers_received - upstream_start
+        async with resp:
+            if resp.status < 500:
+                _running_seen[ws_name] = headers_received
+            if timing is not None:
+                timing.add('ttfb', timing.marks.get('headers_sent', upstream_start), headers_received)
+            response_headers = copy_response_headers(resp, ws_name, workstation_host)
 
+            # 上流が無圧縮の場合のみプロキシ側で圧縮
+            encoding = choose_response_encoding(request, resp)
+            compressor = None
+            if encoding:
+                compressor = ResponseCompressor(encoding)
+                charge.add(MemoryGovernor.COMPRESSOR_BYTES)
+
+            # 小さいレスポンスはバッファリングしてそのまま返す
+            if not should_stream_response(request, resp):
+                body = b''.join(prefix) + await resp.read()
+                charge.add(len(body))
+                if timing is not None:
+                    finished = time.monotonic()
+                    timing.add('transfer', headers_received, finished, bytes=len(body))
+                    timing.add('upstream', upstream_start, finished, status=resp.status)
+                if compressor and len(body) >= COMPRESSION_MIN_SIZE:
+                    with timed('compress', encoding=encoding):
+                        body = await compressor.compress(body, finish=True)
+                    apply_compression_headers(response_headers, encoding)
+                HTTP_BYTES.inc((label, 'down'), len(body))
                 return web.Response(
                     status=resp.status,
                     headers=response_headers,
                     body=body
                 )
 
+            # 大きい/長さ不明（chunked, SSE, long-poll）のレスポンスはストリーミング
+            # メモリ予算に近づいたら大きなダウンロードを新規に始めない（SSE・long-pollは長さ不明なので対象外）
+            if resp.content_length is not None and resp.content_length > MEMORY_LARGE_TRANSFER:
+                reason = _memory.check(large=True)
+                if reason is not None:
+                    return memory_rejected('download', ws_name, reason)
+            charge.add(MemoryGovernor.STREAM_BYTES)
+            if compressor:
+                apply_compression_headers(response_headers, encoding)
+            stream = web.StreamResponse(status=resp.status, headers=response_headers)
+            apply_session_cookie(request, stream)
+            apply_server_timing(request, stream)
+            await stream.prepare(request)
+            _bandwidth.open(key)
+            try:
+                async for chunk in iter_upstream_body(resp, prefix):
+                    if compressor:
+                        chunk = await compressor.compress(chunk)
+                    await _bandwidth.consume(key, len(chunk), label)
+                    # write() はクライアント側の送信バッファが空くまで待つ（バックプレッシャー）
+                    await stream.write(chunk)
+                    HTTP_BYTES.inc((label, 'down'), len(chunk))
+                if compressor:
+                    chunk = await compressor.compress(b'', finish=True)
+                    await stream.write(chunk)
+                    HTTP_BYTES.inc((label, 'down'), len(chunk))
+                await stream.write_eof()
+            except (ConnectionResetError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # ヘッダー送信後はエラーレスポンスを返せないため、接続を切る
+                # （そのまま返すと最後のチャンクが送られ、途中までの内容が完全なレスポンスに見える）
+                log(f"Streaming aborted for {workstation_host}{actual_path}: {e!r}", category='proxy', level='WARNING')
+                if request.transport is not None:
+                    request.transport.abort()
+            finally:
+                _bandwidth.close(key)
+                if timing is not None:
+                    finished = time.monotonic()
+                    timing.add('transfer', headers_received, finished, bytes=stream.body_length)
+                    timing.add('upstream', upstream_start, finished, status=resp.status)
+            return stream
+
     except Exception as e:
-        log(f"Proxy error: {e}")
-        import traceback
-        traceback.print_exc()
+        # 停止した可能性があるので、自動開始が有効なら次のリクエストで状態を確認する
+        _running_seen.pop(ws_name, None)
+        log(f"Proxy error: {e}", category='proxy', level='ERROR', workstation=ws_name,
+            stack_trace=traceback.format_exc())
         return web.Response(status=502, text=f"Proxy Error: {e}")
 
 
+def available_cpus() -> int:
+    """コンテナで使えるCPU数（cgroupのCPU上限があればそれに従う）"""
+    count = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            count = min(count, max(1, -(-int(quota) // int(period))))
+    except (OSError, ValueError):
+        pass
+    return count
+
+
+def container_memory_limit() -> int:
+    """コンテナのメモリ上限（cgroup v2 の memory.max、v1 の memory.limit_in_bytes）。上限がなければ 0"""
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # v1 の無制限は非常に大きな値
+        return int(value) if value.isdigit() and int(value) < 1 << 60 else 0
+    return 0
+
+
+def get_worker_count() -> int:
+    if WORKERS.lower() == 'auto':
+        return available_cpus()
+    return max(1, int(WORKERS))
+
+
+async def handle_broker_token(request):
+    """ワーカーにトークンを配布（期限が近ければ先に更新。同時要求は1回の取得にまとめる）"""
+    name = request.match_info.get('name')
+    if name is None:
+        cache_name, key, fetch = 'gcp', "gcp", fetch_gcp_access_token
+        get_cache = lambda: _gcp_token_cache
+    else:
+        _ws_token_last_used[name] = time.time()
+        if 'config' in request.query:
+            # ワーカーの登録簿で決まったConfig（スーパーバイザーは一覧を取得しない）
+            try:
+                _registry.add(name, _registry.configs[int(request.query['config'])])
+            except (ValueError, IndexError):
+                return web.Response(status=400, text="invalid config")
+        cache_name, key, fetch = 'workstation', f"ws:{name}", lambda: fetch_workstation_access_token(name)
+        get_cache = lambda: _ws_token_cache.get(name, {"token": None, "expires": 0})
+
+    cache = get_cache()
+    if cache["token"] and cache["expires"] - time.time() > TOKEN_REFRESH_AHEAD:
+        TOKEN_CACHE.inc((cache_name, 'hit'))
+    else:
+        TOKEN_CACHE.inc((cache_name, 'miss'))
+        try:
+            await single_flight(key, fetch)
+        except Exception as e:
+            return web.Response(status=502, text=str(e))
+        cache = get_cache()
+    return web.json_response({"token": cache["token"], "expires": cache["expires"]})
+
+
+def create_broker_app():
+    """スーパーバイザー側のトークンブローカー（Unixソケットで待ち受け）"""
+    app = web.Application()
+    app.on_startup.append(on_startup_sessions)
+    app.on_startup.append(on_startup_token_refresher)
+    app.on_cleanup.append(on_cleanup_token_refresher)
+    app.on_cleanup.append(on_cleanup_sessions)
+    app.router.add_route('GET', '/token/gcp', handle_broker_token)
+    app.router.add_route('GET', '/token/workstation/{name}', handle_broker_token)
+    return app
+
+
+async def supervise_workers(count: int):
+    """
+    ワーカーモード: 同じポートを SO_REUSEPORT で共有するワーカープロセスを count 個起動
+    - トークンはこのプロセスが取得・更新し、Unixソケット経由でワーカーに配布
+    - 異常終了したワーカーは再起動（起動直後に落ち続ける場合は間隔を延ばす）
+    - SIGTERM/SIGINT でワーカーに SIGTERM を送り、WORKER_SHUTDOWN_TIMEOUT 待って残りを強制終了
+    """
+    broker_socket = os.path.join(tempfile.mkdtemp(prefix='proxy-'), 'tokens.sock')
+    runner = web.AppRunner(create_broker_app(), access_log=None)
+    await runner.setup()
+    await web.UnixSite(runner, broker_socket).start()
+
+    env = {**os.environ, 'TOKEN_BROKER_SOCKET': broker_socket}
+    if SESSION_MODE == 'memory':
+        # メモリ上のセッションはワーカー間で共有できないので署名付きCookieにする
+        env['SESSION_MODE'] = 'cookie'
+        log("Worker mode: using signed cookie sessions so that all workers see the same routing")
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+
+    processes = {}
+
+    async def run_worker(worker_id: int):
+        failures = 0
+        while not stopping.is_set():
+            started = time.monotonic()
+            # -m で起動するとコンパイル済みのバイトコード（__pycache__）が使われる
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, '-m', 'proxy',
+                env={**env, 'WORKER_ID': str(worker_id)},
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+            )
+            processes[worker_id] = process
+            log(f"Worker {worker_id} started (pid {process.pid})")
+            code = await process.wait()
+            if stopping.is_set():
+                break
+            failures = failures + 1 if time.monotonic() - started < 10 else 0
+            delay = min(2 ** failures, 30) if failures else 0
+            log(f"Worker {worker_id} exited with code {code}; restarting in {delay}s", level='WARNING')
+            try:
+                await asyncio.wait_for(stopping.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    tasks = [asyncio.create_task(run_worker(i)) for i in range(count)]
+    await stopping.wait()
+
+    log(f"Stopping {count} worker(s)")
+    for process in processes.values():
+        if process.returncode is None:
+            process.terminate()
+    done, pending = await asyncio.wait(tasks, timeout=WORKER_SHUTDOWN_TIMEOUT)
+    if pending:
+        for process in processes.values():
+            if process.returncode is None:
+                process.kill()
+        await asyncio.gather(*pending, return_exceptions=True)
+    await runner.cleanup()
+    log("All workers stopped")
+
+
 def create_app():
-    app = web.Application(middlewares=[session_middleware])
+    middlewares = [access_log_middleware]
+    if METRICS_ENABLED:
+        middlewares.append(metrics_middleware)
+    if TIMING_ENABLED:
+        middlewares.append(timing_middleware)
+    if CAPTURE_ENABLED:
+        middlewares.append(capture_middleware)
+    app = web.Application(middlewares=middlewares + [session_middleware])
+    app.on_startup.append(on_startup_sessions)
+    app.on_startup.append(on_startup_credentials)
+    app.on_startup.append(on_startup_token_refresher)
+    app.on_startup.append(on_startup_registry)
+    app.on_startup.append(on_startup_span_exporter)
+    app.on_startup.append(on_startup_capture)
+    app.on_startup.append(on_startup_loop_monitor)
+    app.on_startup.append(on_startup_memory_governor)
+    app.on_cleanup.append(on_cleanup_credentials)
+    app.on_cleanup.append(on_cleanup_token_refresher)
+    app.on_cleanup.append(on_cleanup_registry)
+    app.on_cleanup.append(on_cleanup_autostarts)
+    app.on_cleanup.append(on_cleanup_status_watchers)
+    app.on_cleanup.append(on_cleanup_warmups)
+    app.on_cleanup.append(on_cleanup_span_exporter)
+    app.on_cleanup.append(on_cleanup_capture)
+    app.on_cleanup.append(on_cleanup_loop_monitor)
+    app.on_cleanup.append(on_cleanup_memory_governor)
+    app.on_cleanup.append(on_cleanup_sessions)
+    app.on_cleanup.append(on_cleanup_compression)
+    app.on_shutdown.append(on_shutdown_websockets)
     app.router.add_route('GET', '/health', health_check)
+    app.router.add_route('GET', '/ready', readiness_check)
+    if METRICS_ENABLED:
+        app.router.add_route('GET', '/metrics', handle_metrics)
+    app.router.add_route('GET', '/debug/memory', handle_debug_memory)
+    app.router.add_route('GET', '/debug/profile', handle_debug_profile)
+    app.router.add_route('GET', '/api/workstations', handle_api_workstations)
+    app.router.add_route('POST', '/api/workstations/{action}', handle_api_workstations_batch)
+    app.router.add_route('GET', '/status/', handle_status_index)
+    app.router.add_route('POST', '/status/', handle_status_index)
+    app.router.add_route('GET', '/status/{name}/events', handle_status_events)
     app.router.add_route('*', '/status/{name}', handle_status)
     app.router.add_route('*', '/{path:.*}', handle_request)
     return app
 
 
-if __name__ == '__main__':
+def main():
+    if TOKEN_BROKER_SOCKET:
+        # スーパーバイザーから起動されたワーカー
+        sock = bind_socket(reuse_port=True)
+        log(f"Worker {WORKER_ID} starting on port {PORT}")
+        web.run_app(create_app(), sock=sock, access_log=None, print=None)
+        return
+
     log(f"Starting proxy server on port {PORT}")
-    log(f"Cluster hostname: {CLUSTER_HOSTNAME}")
-    log(f"Project: {PROJECT_ID}, Region: {REGION}")
-    log(f"Cluster: {CLUSTER_NAME}, Config: {CONFIG_NAME}")
+    log(f"Project: {PROJECT_ID}")
+    for config in _registry.configs:
+        log(f"Config {config.index}: {config.key} (region {config.region}, hostname {config.hostname})")
     log(f"Authentication: IAP (Identity-Aware Proxy)")
+    log(f"Session mode: {SESSION_MODE}")
+    workers = get_worker_count()
+    if (SESSION_MODE == 'cookie' or workers > 1) and not SESSION_SECRET:
+        # プロセスごとのランダム鍵では他のワーカー・インスタンスが発行したCookieを検証できず、ルーティングが揃わない
+        log("SESSION_SECRET is required for cookie sessions and worker mode (WORKERS > 1)", level='ERROR')
+        sys.exit(1)
     log("Usage: /ws/{workstation_name}/...")
-    app = create_app()
-    web.run_app(app, host='0.0.0.0', port=PORT)
+    if workers > 1:
+        log(f"Worker mode: {workers} workers (available CPUs: {available_cpus()})")
+        asyncio.run(supervise_workers(workers))
+        return
+    sock = bind_socket()
+    # アクセスログは access_log_middleware で出力する
+    web.run_app(create_app(), sock=sock, access_log=None, print=None)
+
+
+if __name__ == '__main__':
+    main()
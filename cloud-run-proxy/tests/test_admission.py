@@ -0,0 +1,68 @@
+"""AdmissionController: 空いた枠を待ちのあるキーに順番に割り当てる"""
+
+import asyncio
+
+import pytest
+
+import proxy
+
+
+def test_round_robin_between_keys():
+    async def main():
+        admission = proxy.AdmissionController('http', 1, 1, 10, 5)
+        await admission.acquire('x')
+        granted = []
+
+        async def request(key, label):
+            await admission.acquire(key)
+            granted.append(label)
+
+        tasks = []
+        for key, label in [('a', 'a1'), ('a', 'a2'), ('a', 'a3'), ('b', 'b1')]:
+            tasks.append(asyncio.create_task(request(key, label)))
+            await asyncio.sleep(0)
+        assert admission.queued() == 4
+
+        # 受け付けられたものから1件ずつ終える
+        admission.release('x')
+        for key in ['a', 'b', 'a', 'a']:
+            await asyncio.sleep(0)
+            admission.release(key)
+        await asyncio.gather(*tasks)
+        # a が3件待っていても b は2番目に受け付けられる
+        assert granted == ['a1', 'b1', 'a2', 'a3']
+        assert admission.active == 0 and not admission.waiters and not admission.rotation
+    asyncio.run(main())
+
+
+def test_per_key_limit_skips_busy_key():
+    async def main():
+        admission = proxy.AdmissionController('http', 3, 1, 10, 5)
+        await admission.acquire('a')
+        await admission.acquire('b')
+        waiting = asyncio.create_task(admission.acquire('a'))
+        await asyncio.sleep(0)
+        # 全体には空きがあっても a は上限なので待つ
+        assert not waiting.done()
+        admission.release('b')
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        admission.release('a')
+        await waiting
+        assert admission.active_by_key == {'a': 1}
+    asyncio.run(main())
+
+
+def test_queue_limit_and_timeout():
+    async def main():
+        admission = proxy.AdmissionController('http', 1, 1, 1, 0.05)
+        await admission.acquire('a')
+        waiting = asyncio.create_task(admission.acquire('a'))
+        await asyncio.sleep(0)
+        with pytest.raises(proxy.AdmissionRejected):
+            await admission.acquire('a')
+        with pytest.raises(proxy.AdmissionRejected):
+            await waiting
+        # 待ちきれなかったリクエストは待ち行列から消える
+        assert admission.queued() == 0 and not admission.rotation
+    asyncio.run(main())
@@ -0,0 +1,112 @@
+"""Workstation登録簿: 見つからなかった名前のキャッシュ（REGISTRY_NEGATIVE_TTL）と問い合わせの上限"""
+
+import asyncio
+
+import pytest
+
+import proxy
+
+
+class FakeAPI:
+    """Configごとの get の代わり（{config.key: {name: state}}）"""
+
+    def __init__(self, workstations: dict):
+        self.workstations = workstations
+        self.probes = []
+
+    async def probe(self, config, name, headers):
+        self.probes.append((config.key, name))
+        return self.workstations.get(config.key, {}).get(name)
+
+
+@pytest.fixture
+def api(monkeypatch):
+    async def token():
+        return 'gcp-token'
+    monkeypatch.setattr(proxy, 'get_gcp_access_token', token)
+    monkeypatch.setattr(proxy, 'REGISTRY_ENABLED', True)
+    monkeypatch.setattr(proxy, 'REGISTRY_NEGATIVE_TTL', 30)
+    monkeypatch.setattr(proxy, 'REGISTRY_MISS_RATE', 5)
+    monkeypatch.setattr(proxy, 'REGISTRY_MISS_BURST', 20)
+    return FakeAPI({'c1/cfg1': {'alice': 'STATE_RUNNING'}, 'c2/cfg2': {'bob': 'STATE_STOPPED'}})
+
+
+def make_registry(api) -> proxy.WorkstationRegistry:
+    registry = proxy.WorkstationRegistry(proxy.parse_workstation_configs('c1/cfg1@h1.test, c2/cfg2@h2.test'))
+    registry.probe = api.probe
+    return registry
+
+
+def test_finds_name_in_any_config(api):
+    async def main():
+        registry = make_registry(api)
+        entry = await registry.resolve('bob')
+        assert entry.host == 'bob.h2.test'
+        assert entry.state == 'STATE_STOPPED'
+        # 2回目は登録簿を引くだけ
+        probes = len(api.probes)
+        assert await registry.resolve('bob') is entry
+        assert len(api.probes) == probes
+    asyncio.run(main())
+
+
+def test_missing_name_is_cached(api, monkeypatch):
+    async def main():
+        registry = make_registry(api)
+        assert await registry.resolve('nobody') is None
+        assert len(api.probes) == 2  # 全Configを1回ずつ
+        assert await registry.resolve('nobody') is None
+        assert len(api.probes) == 2
+
+        # 期限が切れたら問い合わせ直す
+        registry.missing['nobody'] = 0
+        assert await registry.resolve('nobody') is None
+        assert len(api.probes) == 4
+    asyncio.run(main())
+
+
+def test_added_name_clears_missing(api):
+    async def main():
+        registry = make_registry(api)
+        assert await registry.resolve('carol') is None
+        registry.merge(registry.configs[0], [('carol', 'STATE_RUNNING')])
+        entry = await registry.resolve('carol')
+        assert entry is not None and entry.host == 'carol.h1.test'
+        assert 'carol' not in registry.missing
+    asyncio.run(main())
+
+
+def test_unknown_names_are_throttled(api, monkeypatch):
+    monkeypatch.setattr(proxy, 'REGISTRY_MISS_RATE', 0.001)
+    monkeypatch.setattr(proxy, 'REGISTRY_MISS_BURST', 3)
+
+    async def main():
+        registry = make_registry(api)
+        for i in range(3):
+            assert await registry.resolve(f'scan{i}') is None
+        with pytest.raises(proxy.RegistryThrottled):
+            await registry.resolve('scan3')
+        # 上限を超えても、登録簿にある名前と「なし」とわかっている名前はそのまま返す
+        registry.add('alice', registry.configs[0])
+        assert (await registry.resolve('alice')).host == 'alice.h1.test'
+        assert await registry.resolve('scan0') is None
+        # 上限による拒否は「なし」として覚えない
+        assert 'scan3' not in registry.missing
+    asyncio.run(main())
+
+
+def test_concurrent_lookups_share_one_probe(api, monkeypatch):
+    monkeypatch.setattr(proxy, 'REGISTRY_MISS_BURST', 1)
+
+    async def main():
+        registry = make_registry(api)
+        entries = await asyncio.gather(*[registry.resolve('alice') for _ in range(5)])
+        assert all(entry is entries[0] for entry in entries)
+        assert len(api.probes) == 2
+    asyncio.run(main())
+
+
+def test_throttled_response_is_503():
+    response = proxy.registry_throttled('scan')
+    assert response.status == 503
+    assert response.headers['Retry-After'] == str(proxy.ADMISSION_RETRY_AFTER)
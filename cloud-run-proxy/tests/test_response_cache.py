@@ -0,0 +1,111 @@
+"""レスポンスキャッシュ: 再検証（304）と、保存しないレスポンスの同時リクエストへの共有（BYPASS）"""
+
+import asyncio
+import collections
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer, make_mocked_request
+
+import proxy
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    cache = proxy.ResponseCache(1024 * 1024)
+    monkeypatch.setattr(proxy, '_response_cache', cache)
+    return cache
+
+
+def make_upstream(hits: collections.Counter) -> web.Application:
+    async def revalidate(request):
+        hits['revalidate'] += 1
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304, headers={'ETag': '"v1"', 'Cache-Control': 'max-age=0'})
+        return web.Response(text='body-v1', headers={'ETag': '"v1"', 'Cache-Control': 'max-age=0'})
+
+    async def missing(request):
+        hits['missing'] += 1
+        await asyncio.sleep(0.1)
+        return web.Response(status=404, text='not here')
+
+    async def private(request):
+        hits['private'] += 1
+        await asyncio.sleep(0.1)
+        return web.Response(text='private', headers={'Cache-Control': 'no-store'})
+
+    app = web.Application()
+    app.router.add_get('/revalidate', revalidate)
+    app.router.add_get('/missing', missing)
+    app.router.add_get('/private', private)
+    return app
+
+
+async def run_with_upstream(test):
+    hits = collections.Counter()
+    server = TestServer(make_upstream(hits))
+    await server.start_server()
+    try:
+        async with aiohttp.ClientSession() as session:
+            async def get(path: str, ws_name: str = 'alice', request=None):
+                request = request or make_mocked_request('GET', f'/ws/{ws_name}{path}')
+                return await proxy.get_cached_response(
+                    session, str(server.make_url(path)), {}, request, f'test|{path}', ws_name, server.host)
+            await test(get, hits)
+    finally:
+        await server.close()
+
+
+def test_revalidate_with_etag(cache):
+    async def test(get, hits):
+        first = await get('/revalidate')
+        assert first.headers['X-Proxy-Cache'] == 'MISS'
+        assert first.body == b'body-v1'
+        # max-age=0 なので2回目は If-None-Match で再検証し、上流の 304 でキャッシュの本文を返す
+        second = await get('/revalidate')
+        assert second.headers['X-Proxy-Cache'] == 'REVALIDATED'
+        assert second.status == 200 and second.body == b'body-v1'
+        assert hits['revalidate'] == 2
+        assert cache.stats['revalidated'] == 1
+    asyncio.run(run_with_upstream(test))
+
+
+def test_client_conditional_request_gets_304():
+    async def test(get, hits):
+        first = await get('/revalidate')
+        request = make_mocked_request('GET', '/ws/alice/revalidate', headers={'If-None-Match': first.headers['ETag']})
+        response = await get('/revalidate', request=request)
+        assert response.status == 304
+    asyncio.run(run_with_upstream(test))
+
+
+def test_bypass_shared_with_same_workstation(cache):
+    async def test(get, hits):
+        responses = await asyncio.gather(get('/missing'), get('/missing'), get('/missing', 'bob'))
+        # 保存しない 404 の本文は、同じWorkstationへの同時リクエストにだけ返す
+        for response in responses[:2]:
+            assert response.status == 404
+            assert response.headers['X-Proxy-Cache'] == 'BYPASS'
+            assert response.body == b'not here'
+        # 別のWorkstationは通常のプロキシ処理（None）で自分で取得する
+        assert responses[2] is None
+        assert hits['missing'] == 1
+        assert cache.summary()['entries'] == 0
+    asyncio.run(run_with_upstream(test))
+
+
+def test_no_store_is_handed_to_leader_only():
+    async def test(get, hits):
+        requests = [make_mocked_request('GET', '/ws/alice/private') for _ in range(3)]
+        responses = await asyncio.gather(*[get('/private', request=request) for request in requests])
+        assert responses == [None, None, None]
+        # 上流レスポンスは取得したリクエストにだけ開いたまま引き渡される
+        handed = [request for request in requests if 'cache_upstream' in request]
+        assert len(handed) == 1
+        resp, chunks = handed[0]['cache_upstream']
+        assert await resp.read() == b'private' and chunks == []
+        proxy.release_cache_upstream(handed[0])
+        assert 'cache_upstream' not in handed[0]
+        assert hits['private'] == 1
+    asyncio.run(run_with_upstream(test))
@@ -0,0 +1,42 @@
+"""署名付きセッションCookie（SESSION_MODE=cookie）の検証"""
+
+import time
+
+import pytest
+
+import proxy
+
+
+@pytest.fixture(autouse=True)
+def secret(monkeypatch):
+    monkeypatch.setattr(proxy, 'SESSION_SECRET', 'test-secret')
+
+
+def test_roundtrip():
+    value = proxy.sign_session('alice', int(time.time()) + 60)
+    assert proxy.verify_session(value) == 'alice'
+
+
+def test_expired():
+    value = proxy.sign_session('alice', int(time.time()) - 1)
+    assert proxy.verify_session(value) is None
+
+
+def test_tampered_payload():
+    value = proxy.sign_session('alice', int(time.time()) + 60)
+    forged = proxy.sign_session('mallory', int(time.time()) + 60)
+    payload, _, signature = value.partition('.')
+    assert proxy.verify_session(f"{forged.partition('.')[0]}.{signature}") is None
+    assert proxy.verify_session(payload) is None
+    assert proxy.verify_session('') is None
+
+
+def test_other_secret(monkeypatch):
+    value = proxy.sign_session('alice', int(time.time()) + 60)
+    monkeypatch.setattr(proxy, 'SESSION_SECRET', 'other-secret')
+    assert proxy.verify_session(value) is None
+
+
+def test_name_with_colon():
+    value = proxy.sign_session('a:b', int(time.time()) + 60)
+    assert proxy.verify_session(value) == 'a:b'
@@ -0,0 +1,109 @@
+"""WebSocketRelay: メッセージの中継とクローズコードの伝播"""
+
+import asyncio
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import proxy
+
+
+def make_upstream(closed: list) -> web.Application:
+    """受け取ったメッセージを返し、"close <code>" でそのコードで閉じるWorkstationの代わり（closed に受け取ったクローズコードを残す）"""
+    async def handler(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        while True:
+            msg = await ws.receive()
+            if msg.type == aiohttp.WSMsgType.TEXT and msg.data.startswith('close '):
+                await ws.close(code=int(msg.data.split()[1]), message=b'bye')
+            elif msg.type == aiohttp.WSMsgType.TEXT:
+                await ws.send_str(f"echo:{msg.data}")
+            elif msg.type == aiohttp.WSMsgType.BINARY:
+                await ws.send_bytes(msg.data[::-1])
+            elif msg.type == aiohttp.WSMsgType.CLOSE:
+                # 相手から受け取ったクローズコード（ws.close_code は自動で返したコードになる）
+                closed.append(msg.data)
+                return ws
+            else:
+                return ws
+
+    app = web.Application()
+    app.router.add_get('/', handler)
+    return app
+
+
+def make_frontend(upstream_url: str) -> web.Application:
+    """ブラウザからの接続を upstream_url に中継するプロキシの代わり"""
+    async def handler(request):
+        ws_server = web.WebSocketResponse()
+        await ws_server.prepare(request)
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(upstream_url) as ws_client:
+                await proxy.WebSocketRelay(ws_server, ws_client, label='test').run()
+        return ws_server
+
+    app = web.Application()
+    app.router.add_get('/', handler)
+    return app
+
+
+async def run_with_relay(test):
+    closed = []
+    upstream = TestServer(make_upstream(closed))
+    await upstream.start_server()
+    # TestServer は切断時にハンドラーをキャンセルするので、プロキシ側は web.run_app と同じ設定で起動する
+    frontend = web.AppRunner(make_frontend(str(upstream.make_url('/'))))
+    await frontend.setup()
+    site = web.TCPSite(frontend, '127.0.0.1', 0)
+    await site.start()
+    host, port = frontend.addresses[0][:2]
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(f"http://{host}:{port}/") as ws:
+                await test(ws, closed)
+    finally:
+        await frontend.cleanup()
+        await upstream.close()
+
+
+def test_relays_messages():
+    async def test(ws, closed):
+        await ws.send_str('hello')
+        assert await ws.receive_str(timeout=5) == 'echo:hello'
+        await ws.send_bytes(b'abc')
+        assert await ws.receive_bytes(timeout=5) == b'cba'
+    asyncio.run(run_with_relay(test))
+
+
+def test_upstream_close_code_reaches_client():
+    async def test(ws, closed):
+        await ws.send_str('close 4001')
+        msg = await ws.receive(timeout=5)
+        assert msg.type == aiohttp.WSMsgType.CLOSE
+        assert msg.data == 4001
+        assert msg.extra == 'bye'
+    asyncio.run(run_with_relay(test))
+
+
+def test_client_close_code_reaches_upstream():
+    async def test(ws, closed):
+        await ws.send_str('ping')
+        await ws.receive_str(timeout=5)
+        await ws.close(code=4002)
+        for _ in range(50):
+            if closed:
+                break
+            await asyncio.sleep(0.1)
+        assert closed == [4002]
+    asyncio.run(run_with_relay(test))
+
+
+def test_unsendable_close_codes():
+    relay = proxy.WebSocketRelay.__new__(proxy.WebSocketRelay)
+    assert relay._sendable_close_code(None) == 1000
+    assert relay._sendable_close_code(1005) == 1000
+    assert relay._sendable_close_code(1006) == 1011
+    assert relay._sendable_close_code(999) == 1011
+    assert relay._sendable_close_code(4001) == 4001
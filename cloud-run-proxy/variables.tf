@@ -32,8 +32,44 @@ variable "cluster_hostname" {
   type        = string
 }
 
+variable "workstation_configs" {
+  description = "Workstation configs to route to, as '[region/]cluster/config@hostname' (empty: the default cluster and config on cluster_hostname)"
+  type        = list(string)
+  default     = []
+}
+
 variable "iap_users" {
   description = "List of users/groups to grant Cloud Run invoker role. Format: 'user:email@example.com' or 'group:group@example.com'"
   type        = list(string)
   default     = []
 }
+
+variable "session_mode" {
+  description = "Session store mode: 'memory' (per instance) or 'cookie' (HMAC-signed cookie, works across instances)"
+  type        = string
+  default     = "memory"
+}
+
+variable "session_secret_id" {
+  description = "Secret Manager secret ID holding the HMAC key for signed session cookies (required for session_mode = 'cookie' or more than one worker)"
+  type        = string
+  default     = ""
+}
+
+variable "cpu" {
+  description = "CPU limit for the Cloud Run container (e.g., \"1\", \"2\", \"4\")"
+  type        = string
+  default     = "1"
+}
+
+variable "workers" {
+  description = "Number of proxy worker processes, or 'auto' to match the container CPU limit. More than one worker forces signed cookie sessions and needs session_secret_id"
+  type        = string
+  default     = "1"
+}
+
+variable "autostart" {
+  description = "Start a stopped workstation on the first request to it and hold requests until it is running"
+  type        = bool
+  default     = false
+}